@@ -0,0 +1,56 @@
+"""Per-service hourly profiles: consumption and injection by month and hour of the day
+
+Revision ID: hourly_profiles
+Revises: rollups
+Create Date: 2026-10-18 00:00:00.000000
+
+The profiles are backfilled from the existing records. From then on they are kept
+up to date with the other rollups by the ingestion path, or rebuilt with
+`python -m app.utils.rollups`.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic
+revision = 'hourly_profiles'
+down_revision = 'rollups'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('service_hourly_profiles',
+                    sa.Column('id_service', sa.Integer(), nullable=False),
+                    sa.Column('year', sa.Integer(), nullable=False),
+                    sa.Column('month', sa.Integer(), nullable=False),
+                    sa.Column('hour', sa.Integer(), nullable=False),
+                    sa.Column('records', sa.Integer(), nullable=True),
+                    sa.Column('consumption', sa.Float(), nullable=True),
+                    sa.Column('injection', sa.Float(), nullable=True),
+                    sa.ForeignKeyConstraint(['id_service'], ['services.id_service'], ),
+                    sa.PrimaryKeyConstraint('id_service', 'year', 'month', 'hour')
+                    )
+
+    # Backfill from the existing records
+    if op.get_bind().dialect.name == 'sqlite':
+        year = "CAST(strftime('%Y', r.record_timestamp) AS INTEGER)"
+        month = "CAST(strftime('%m', r.record_timestamp) AS INTEGER)"
+        hour = "CAST(strftime('%H', r.record_timestamp) AS INTEGER)"
+    else:
+        year = "CAST(extract(year FROM r.record_timestamp) AS INTEGER)"
+        month = "CAST(extract(month FROM r.record_timestamp) AS INTEGER)"
+        hour = "CAST(extract(hour FROM r.record_timestamp) AS INTEGER)"
+
+    op.execute(
+        "INSERT INTO service_hourly_profiles (id_service, year, month, hour, records, consumption, injection) "
+        f"SELECT r.id_service, {year}, {month}, {hour}, count(r.id_record), sum(c.value), sum(i.value) "
+        "FROM records r "
+        "LEFT OUTER JOIN consumption c ON r.id_record = c.id_record "
+        "LEFT OUTER JOIN injection i ON r.id_record = i.id_record "
+        "WHERE r.record_timestamp IS NOT NULL AND r.id_service IS NOT NULL "
+        f"GROUP BY r.id_service, {year}, {month}, {hour}"
+    )
+
+
+def downgrade():
+    op.drop_table('service_hourly_profiles')
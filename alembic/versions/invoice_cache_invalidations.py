@@ -0,0 +1,34 @@
+"""Log of invoice cache invalidations shared by every worker
+
+Revision ID: invoice_cache_invalidations
+Revises: hourly_profiles
+Create Date: 2026-10-18 00:00:00.000000
+
+Every transaction that makes cached invoices stale writes the tags it invalidates
+here; each worker applies the rows it hasn't seen before serving from its cache.
+Rows older than INVOICE_CACHE_TTL are purged as new ones are written.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic
+revision = 'invoice_cache_invalidations'
+down_revision = 'hourly_profiles'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('invoice_cache_invalidations',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('created_at', sa.DateTime(), nullable=True),
+                    sa.Column('tags', sa.Text(), nullable=False),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_invoice_cache_invalidations_created_at'), 'invoice_cache_invalidations',
+                    ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_invoice_cache_invalidations_created_at'), table_name='invoice_cache_invalidations')
+    op.drop_table('invoice_cache_invalidations')
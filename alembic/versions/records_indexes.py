@@ -0,0 +1,143 @@
+"""Billing query indexes and optional monthly partitioning of records
+
+Revision ID: records_indexes
+Revises: initial
+Create Date: 2026-10-18 00:00:00.000000
+
+Adds the (id_service, record_timestamp) index every billing query filters on and a
+record_timestamp index on xm_data_hourly_per_agent.
+
+On PostgreSQL, `records` can also be range partitioned by month:
+
+    alembic -x partition_records=true upgrade head
+
+Partitions are created for every month with data plus the next 12 months, and a
+default partition catches anything outside them. A partitioned table can only have
+primary keys that include the partition key, so the primary key becomes
+(id_record, record_timestamp) and the consumption/injection foreign keys to
+records.id_record are dropped.
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic
+revision = 'records_indexes'
+down_revision = 'initial'
+branch_labels = None
+depends_on = None
+
+# Months created ahead of the latest record when partitioning
+FUTURE_PARTITIONS = 12
+
+
+def partition_records_requested():
+    value = context.get_x_argument(as_dictionary=True).get('partition_records', 'false')
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def is_records_partitioned(bind):
+    if bind.dialect.name != 'postgresql':
+        return False
+    return bind.execute(sa.text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'records'::regclass)"
+    )).scalar()
+
+
+def add_months(year, month, months):
+    index = year * 12 + month - 1 + months
+    return index // 12, index % 12 + 1
+
+
+def partition_records(bind):
+    """Replace records with a copy range partitioned by month on record_timestamp"""
+    op.drop_constraint('consumption_id_record_fkey', 'consumption', type_='foreignkey')
+    op.drop_constraint('injection_id_record_fkey', 'injection', type_='foreignkey')
+    op.drop_index(op.f('ix_records_id_record'), table_name='records')
+    op.execute("ALTER TABLE records RENAME TO records_unpartitioned")
+    op.execute("ALTER TABLE records_unpartitioned RENAME CONSTRAINT records_pkey TO records_unpartitioned_pkey")
+
+    op.execute("""
+        CREATE TABLE records (
+            id_record INTEGER NOT NULL,
+            id_service INTEGER,
+            record_timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            CONSTRAINT records_pkey PRIMARY KEY (id_record, record_timestamp),
+            CONSTRAINT records_id_service_fkey FOREIGN KEY (id_service) REFERENCES services (id_service)
+        ) PARTITION BY RANGE (record_timestamp)
+    """)
+
+    first, last = bind.execute(sa.text(
+        "SELECT min(record_timestamp), max(record_timestamp) FROM records_unpartitioned"
+    )).one()
+    if first is None:
+        year, month = bind.execute(sa.text(
+            "SELECT extract(year FROM now())::int, extract(month FROM now())::int"
+        )).one()
+        first_month, months = (year, month), FUTURE_PARTITIONS
+    else:
+        first_month = (first.year, first.month)
+        months = (last.year - first.year) * 12 + last.month - first.month + 1 + FUTURE_PARTITIONS
+
+    for offset in range(months):
+        year, month = add_months(*first_month, offset)
+        next_year, next_month = add_months(year, month, 1)
+        op.execute(
+            f"CREATE TABLE records_{year}_{month:02d} PARTITION OF records "
+            f"FOR VALUES FROM ('{year}-{month:02d}-01') TO ('{next_year}-{next_month:02d}-01')"
+        )
+    op.execute("CREATE TABLE records_default PARTITION OF records DEFAULT")
+
+    op.execute(
+        "INSERT INTO records (id_record, id_service, record_timestamp) "
+        "SELECT id_record, id_service, record_timestamp FROM records_unpartitioned "
+        "WHERE record_timestamp IS NOT NULL"
+    )
+    op.drop_table('records_unpartitioned')
+    op.create_index(op.f('ix_records_id_record'), 'records', ['id_record'], unique=False)
+
+
+def unpartition_records():
+    """Move records back to a regular table with its original keys"""
+    op.drop_index(op.f('ix_records_id_record'), table_name='records')
+    op.execute("ALTER TABLE records RENAME TO records_partitioned")
+    op.execute("ALTER TABLE records_partitioned RENAME CONSTRAINT records_pkey TO records_partitioned_pkey")
+
+    op.create_table('records',
+                    sa.Column('id_record', sa.Integer(), nullable=False),
+                    sa.Column('id_service', sa.Integer(), nullable=True),
+                    sa.Column('record_timestamp', sa.DateTime(), nullable=True),
+                    sa.ForeignKeyConstraint(['id_service'], ['services.id_service'], name='records_id_service_fkey'),
+                    sa.PrimaryKeyConstraint('id_record')
+                    )
+    op.execute(
+        "INSERT INTO records (id_record, id_service, record_timestamp) "
+        "SELECT id_record, id_service, record_timestamp FROM records_partitioned"
+    )
+    op.execute("DROP TABLE records_partitioned CASCADE")
+
+    op.create_index(op.f('ix_records_id_record'), 'records', ['id_record'], unique=False)
+    op.create_foreign_key('consumption_id_record_fkey', 'consumption', 'records', ['id_record'], ['id_record'])
+    op.create_foreign_key('injection_id_record_fkey', 'injection', 'records', ['id_record'], ['id_record'])
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    if partition_records_requested() and bind.dialect.name == 'postgresql':
+        partition_records(bind)
+
+    # Create indexes
+    op.create_index(op.f('ix_records_id_service_record_timestamp'), 'records',
+                    ['id_service', 'record_timestamp'], unique=False)
+    op.create_index(op.f('ix_xm_data_hourly_per_agent_record_timestamp'), 'xm_data_hourly_per_agent',
+                    ['record_timestamp'], unique=False)
+
+
+def downgrade():
+    bind = op.get_bind()
+
+    op.drop_index(op.f('ix_xm_data_hourly_per_agent_record_timestamp'), table_name='xm_data_hourly_per_agent')
+    op.drop_index(op.f('ix_records_id_service_record_timestamp'), table_name='records')
+
+    if is_records_partitioned(bind):
+        unpartition_records()
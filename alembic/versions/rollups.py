@@ -0,0 +1,73 @@
+"""Monthly per-service and hourly system-wide rollups
+
+Revision ID: rollups
+Revises: records_indexes
+Create Date: 2026-10-18 00:00:00.000000
+
+The rollups are backfilled from the existing records. From then on they are kept
+up to date by the ingestion path, or rebuilt with `python -m app.utils.rollups`.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic
+revision = 'rollups'
+down_revision = 'records_indexes'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('service_monthly_rollups',
+                    sa.Column('id_service', sa.Integer(), nullable=False),
+                    sa.Column('year', sa.Integer(), nullable=False),
+                    sa.Column('month', sa.Integer(), nullable=False),
+                    sa.Column('records', sa.Integer(), nullable=True),
+                    sa.Column('consumption', sa.Float(), nullable=True),
+                    sa.Column('injection', sa.Float(), nullable=True),
+                    sa.ForeignKeyConstraint(['id_service'], ['services.id_service'], ),
+                    sa.PrimaryKeyConstraint('id_service', 'year', 'month')
+                    )
+
+    op.create_table('system_hourly_rollups',
+                    sa.Column('hour_timestamp', sa.DateTime(), nullable=False),
+                    sa.Column('records', sa.Integer(), nullable=True),
+                    sa.Column('consumption', sa.Float(), nullable=True),
+                    sa.Column('injection', sa.Float(), nullable=True),
+                    sa.PrimaryKeyConstraint('hour_timestamp')
+                    )
+
+    # Backfill from the existing records
+    if op.get_bind().dialect.name == 'sqlite':
+        year = "CAST(strftime('%Y', r.record_timestamp) AS INTEGER)"
+        month = "CAST(strftime('%m', r.record_timestamp) AS INTEGER)"
+        hour = "strftime('%Y-%m-%d %H:00:00.000000', r.record_timestamp)"
+    else:
+        year = "CAST(extract(year FROM r.record_timestamp) AS INTEGER)"
+        month = "CAST(extract(month FROM r.record_timestamp) AS INTEGER)"
+        hour = "date_trunc('hour', r.record_timestamp)"
+
+    readings = (
+        "FROM records r "
+        "LEFT OUTER JOIN consumption c ON r.id_record = c.id_record "
+        "LEFT OUTER JOIN injection i ON r.id_record = i.id_record "
+        "WHERE r.record_timestamp IS NOT NULL"
+    )
+
+    op.execute(
+        "INSERT INTO service_monthly_rollups (id_service, year, month, records, consumption, injection) "
+        f"SELECT r.id_service, {year}, {month}, count(r.id_record), sum(c.value), sum(i.value) "
+        f"{readings} AND r.id_service IS NOT NULL "
+        f"GROUP BY r.id_service, {year}, {month}"
+    )
+    op.execute(
+        "INSERT INTO system_hourly_rollups (hour_timestamp, records, consumption, injection) "
+        f"SELECT {hour}, count(r.id_record), sum(c.value), sum(i.value) "
+        f"{readings} "
+        f"GROUP BY {hour}"
+    )
+
+
+def downgrade():
+    op.drop_table('system_hourly_rollups')
+    op.drop_table('service_monthly_rollups')
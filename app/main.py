@@ -1,19 +1,32 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.routes.items import router as items_router
 from app.routes.users import router as users_router
-from app.models.models import Base
-# Fix the import to use the app.database module
-from app.database import engine
+from app.routes.metrics import router as metrics_router
+from app.database import init_database, dispose_database
+from app.utils.invoice_batch import shutdown_invoice_pools
+from app.utils.profiling import ProfilingMiddleware
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Engines are created here rather than at import; the schema is managed with Alembic
+    init_database()
+    yield
+    shutdown_invoice_pools()
+    await dispose_database()
 
-# Create tables in the database
-Base.metadata.create_all(bind=engine)
 
 app = FastAPI(
     title="Energy Billing API",
     description="API for calculating and analyzing energy billing",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -25,9 +38,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Server-Timing header and /metrics data for every request
+app.add_middleware(ProfilingMiddleware)
+
 # Include routers
 app.include_router(items_router, prefix="/api/v1", tags=["Energy Billing"])
 app.include_router(users_router, prefix="/api/v1", tags=["Users"])
+app.include_router(metrics_router, tags=["Monitoring"])
 
 @app.get("/")
 def read_root():
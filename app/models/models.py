@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Float, DateTime, ForeignKey, PrimaryKeyConstraint
+from sqlalchemy import Column, Integer, Float, DateTime, ForeignKey, PrimaryKeyConstraint, Index, Text
 from sqlalchemy.orm import relationship
 from datetime import datetime
 
@@ -25,6 +25,10 @@ class Record(Base):
     injection = relationship("Injection", back_populates="record", uselist=False)
     consumption = relationship("Consumption", back_populates="record", uselist=False)
 
+    __table_args__ = (
+        Index('ix_records_id_service_record_timestamp', 'id_service', 'record_timestamp'),
+    )
+
 
 class Service(Base):
     __tablename__ = "services"
@@ -69,5 +73,47 @@ class XmDataHourlyPerAgent(Base):
     __tablename__ = "xm_data_hourly_per_agent"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    record_timestamp = Column(DateTime)
-    value = Column(Float)
\ No newline at end of file
+    record_timestamp = Column(DateTime, index=True)
+    value = Column(Float)
+
+
+class ServiceMonthlyRollup(Base):
+    __tablename__ = "service_monthly_rollups"
+
+    id_service = Column(Integer, ForeignKey("services.id_service"), primary_key=True)
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    records = Column(Integer)
+    consumption = Column(Float)
+    injection = Column(Float)
+
+
+class ServiceHourlyProfile(Base):
+    """Consumption and injection of a service in a month by hour of the day (0 to 23)"""
+    __tablename__ = "service_hourly_profiles"
+
+    id_service = Column(Integer, ForeignKey("services.id_service"), primary_key=True)
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    hour = Column(Integer, primary_key=True)
+    records = Column(Integer)
+    consumption = Column(Float)
+    injection = Column(Float)
+
+
+class SystemHourlyRollup(Base):
+    __tablename__ = "system_hourly_rollups"
+
+    hour_timestamp = Column(DateTime, primary_key=True)
+    records = Column(Integer)
+    consumption = Column(Float)
+    injection = Column(Float)
+
+
+class InvoiceCacheInvalidation(Base):
+    """Invoice cache tags invalidated by a committed transaction, one per line"""
+    __tablename__ = "invoice_cache_invalidations"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    tags = Column(Text, nullable=False)
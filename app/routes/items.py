@@ -1,16 +1,31 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from typing import List, Optional, Union
 from datetime import datetime
+from sqlalchemy.exc import IntegrityError
 
 # Fix the import to use app.database
-from app.database import get_db
+from app.database import get_session, get_read_session, run_db, DbSession, SessionLocal, ReplicaSessionLocal
 from app.schemas.database import (
     InvoiceCalculationRequest,
+    InvoiceBatchRequest,
+    TariffSimulationRequest,
     InvoiceCalculationResponse,
+    InvoiceHistoryResponse,
+    TariffSimulationResponse,
     ClientStatisticsResponse,
+    ClientStatisticsColumnarResponse,
+    ClientHourlyProfileResponse,
+    ClientHourlyProfileColumnarResponse,
+    PortfolioStatisticsResponse,
+    PortfolioStatisticsColumnarResponse,
     SystemLoadResponse,
-    ConceptResponse
+    SystemLoadColumnarResponse,
+    SystemLoadSeriesResponse,
+    SystemLoadSeriesColumnarResponse,
+    ConceptResponse,
+    ReadingIngestionResponse,
+    InvoiceCacheStatsResponse
 )
 from app.utils.calculations import (
     calculate_all_concepts,
@@ -19,16 +34,42 @@ from app.utils.calculations import (
     calculate_EE1,
     calculate_EE2,
     get_client_statistics,
-    get_system_load
+    get_invoice_history,
+    get_service_hourly_profile,
+    get_system_load,
+    iter_portfolio_statistics,
+    get_system_load_series,
+    iter_system_load_series
+)
+from app.utils.invoice_batch import calculate_invoices, get_service_filter, iter_invoices_ndjson
+from app.utils.ingestion import ReadingBuffer, get_reading_parser, ingest_readings
+from app.utils.invoice_cache import invoice_cache
+from app.utils.simulation import simulate_tariffs
+from app.utils.serialization import (
+    LAYOUTS,
+    columnar_client_statistics,
+    columnar_hourly_profile,
+    columnar_system_load,
+    columnar_system_load_series,
+    iter_portfolio_statistics_json,
+    iter_system_load_series_json
+)
+from app.utils.dates import RESOLUTIONS, count_buckets, next_bucket
+from app.config import (
+    INVOICE_HISTORY_MAX_MONTHS,
+    PORTFOLIO_PAGE_SIZE,
+    PORTFOLIO_MAX_PAGE_SIZE,
+    SIMULATION_MAX_SCENARIOS,
+    SYSTEM_LOAD_STREAM_BUCKETS
 )
 
 router = APIRouter()
 
 
 @router.post("/calculate-invoice", response_model=InvoiceCalculationResponse)
-def calculate_invoice(
+async def calculate_invoice(
         request: InvoiceCalculationRequest,
-        db: Session = Depends(get_db)
+        db: DbSession = Depends(get_session)
 ):
     """
     Calculate the invoice for a client and a specific month.
@@ -36,49 +77,361 @@ def calculate_invoice(
     This endpoint calculates EA, EC, EE1, and EE2 concepts and returns the total invoice.
     """
     try:
-        result = calculate_all_concepts(db, request.client_id, request.year, request.month)
-        return result
+        result = await run_db(db, calculate_all_concepts, request.client_id, request.year, request.month)
+        # Built by the calculation layer in the response shape, so it's serialized without re-validation
+        return ORJSONResponse(result)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to calculate invoice: {str(e)}")
 
 
-@router.get("/client-statistics/{client_id}", response_model=ClientStatisticsResponse)
-def client_statistics(
+@router.get("/clients/{client_id}/invoices", response_model=InvoiceHistoryResponse)
+async def invoice_history(
         client_id: int,
-        db: Session = Depends(get_db)
+        from_month: str = Query(..., alias="from"),
+        to_month: str = Query(..., alias="to"),
+        db: DbSession = Depends(get_session)
+):
+    """
+    Calculate the invoices of a client for a range of months.
+
+    from and to (YYYY-MM) are both included. Every month in the range is returned, in
+    order, with the same concepts as /calculate-invoice, computed in a single pass over
+    the range.
+    """
+    try:
+        start = datetime.strptime(from_month, "%Y-%m")
+        end = datetime.strptime(to_month, "%Y-%m")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid month format. Use YYYY-MM")
+    if end < start:
+        raise HTTPException(status_code=400, detail="to must not be before from")
+    if count_buckets(start, next_bucket(end, "month"), "month") > INVOICE_HISTORY_MAX_MONTHS:
+        raise HTTPException(
+            status_code=400, detail=f"The range can span at most {INVOICE_HISTORY_MAX_MONTHS} months"
+        )
+
+    try:
+        result = await run_db(db, get_invoice_history, client_id, start, end)
+        return ORJSONResponse(result)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to calculate invoices: {str(e)}")
+
+
+@router.post("/calculate-invoices")
+def calculate_invoices_batch(request: InvoiceBatchRequest):
+    """
+    Calculate the invoices of many clients for a specific month.
+
+    Clients can be selected by ID, market or voltage level; all clients are invoiced when
+    no filter is given. Invoices are streamed as newline delimited JSON, one per line.
+    """
+    if not 1 <= request.month <= 12:
+        raise HTTPException(status_code=400, detail="Invalid month. Use a value between 1 and 12")
+
+    def generate():
+        # The session lives as long as the stream, not the request handler
+        db = SessionLocal()
+        try:
+            invoices = calculate_invoices(
+                db,
+                request.year,
+                request.month,
+                client_ids=request.client_ids,
+                id_market=request.id_market,
+                voltage_level=request.voltage_level
+            )
+            yield from iter_invoices_ndjson(invoices)
+        finally:
+            db.close()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+@router.post("/simulate-tariffs", response_model=TariffSimulationResponse)
+async def simulate_tariffs_endpoint(
+        request: TariffSimulationRequest,
+        db: DbSession = Depends(get_read_session)
+):
+    """
+    Estimate the impact of candidate tariffs on a month's invoices, without storing them.
+
+    Each scenario lists tariffs (id_market, voltage_level, cdi and the G, T, D, R, C, P
+    components; CU defaults to their sum) replacing the current ones with the same key;
+    tariffs it doesn't list stay as they are. Every service with a tariff is re-priced,
+    or those selected by ID, market or voltage level. The response has the current and
+    simulated totals per concept and, unless include_services is false, each service's
+    current total and its simulated total and delta per scenario, in client_ids order.
+    """
+    if not 1 <= request.month <= 12:
+        raise HTTPException(status_code=400, detail="Invalid month. Use a value between 1 and 12")
+    if not 1 <= len(request.scenarios) <= SIMULATION_MAX_SCENARIOS:
+        raise HTTPException(
+            status_code=400, detail=f"Give between 1 and {SIMULATION_MAX_SCENARIOS} scenarios"
+        )
+    names = [scenario.name for scenario in request.scenarios]
+    if len(set(names)) != len(names):
+        raise HTTPException(status_code=400, detail="Scenario names must be unique")
+
+    try:
+        result = await run_db(
+            db,
+            simulate_tariffs,
+            request.year,
+            request.month,
+            [scenario.model_dump() for scenario in request.scenarios],
+            client_ids=request.client_ids,
+            id_market=request.id_market,
+            voltage_level=request.voltage_level,
+            include_services=request.include_services
+        )
+        return ORJSONResponse(result)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to simulate tariffs: {str(e)}")
+
+
+@router.post("/readings", response_model=ReadingIngestionResponse)
+async def ingest_readings_endpoint(request: Request):
+    """
+    Store meter readings sent as NDJSON (one JSON object per line) or CSV (with a header line).
+
+    Each reading has id_service, record_timestamp, consumption and injection, and optionally
+    id_record; readings without one get the next free ID. The body is parsed as it arrives
+    and written in batches, each in its own transaction that also updates the rollups.
+    """
+    try:
+        parser = get_reading_parser(request.headers.get("content-type"))
+    except ValueError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+
+    buffer = ReadingBuffer()
+    try:
+        await ingest_readings(request.stream(), parser, buffer)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"{e}. {buffer.stored} readings were stored before the error")
+    except IntegrityError as e:
+        raise HTTPException(status_code=409, detail=f"Readings conflict with stored records: {e.orig}. "
+                                                    f"{buffer.stored} readings were stored before the error")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to store readings: {str(e)}. "
+                                                    f"{buffer.stored} readings were stored before the error")
+
+    return {"readings": buffer.stored, "batches": buffer.batches}
+
+
+@router.get("/readings/export")
+def export_readings_endpoint(
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+        client_id: Optional[List[int]] = Query(None),
+        format: str = "arrow"
+):
+    """
+    Export readings (records joined with consumption and injection) as an Arrow IPC stream or a Parquet file.
+
+    Readings from start_date up to, but not including, end_date (YYYY-MM-DD) are streamed
+    ordered by service and time; client_id can be repeated to export several clients.
+    Served from the read replica when one is configured.
+    """
+    # pyarrow (and the pandas it loads) is only imported by the endpoints that use it
+    from app.utils.columnar import FILE_FORMATS, iter_readings_file
+
+    if format not in FILE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format. Use one of: {', '.join(FILE_FORMATS)}")
+    try:
+        start = datetime.strptime(start_date, "%Y-%m-%d") if start_date else None
+        end = datetime.strptime(end_date, "%Y-%m-%d") if end_date else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+
+    def generate():
+        # The session lives as long as the stream, not the request handler
+        db = ReplicaSessionLocal()
+        try:
+            yield from iter_readings_file(db, format, start, end, client_id)
+        finally:
+            db.close()
+
+    media_type = "application/vnd.apache.arrow.stream" if format == "arrow" else "application/vnd.apache.parquet"
+    extension = FILE_FORMATS[format][1]
+    return StreamingResponse(generate(), media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="readings.{extension}"'
+    })
+
+
+@router.get("/invoice-cache/stats", response_model=InvoiceCacheStatsResponse)
+def invoice_cache_stats():
+    """
+    Get the hit, miss and invalidation counters of the closed-month invoice cache.
+
+    Counters are kept per worker process; entries are those of the configured backend.
+    """
+    return invoice_cache.stats()
+
+
+@router.get("/client-statistics/{client_id}",
+            response_model=Union[ClientStatisticsResponse, ClientStatisticsColumnarResponse])
+async def client_statistics(
+        client_id: int,
+        layout: str = "rows",
+        db: DbSession = Depends(get_read_session)
 ):
     """
     Get consumption and injection statistics for a client.
 
     Returns monthly statistics and averages for consumption, injection, and net energy.
+    With layout=columnar, monthly_statistics has one list per field instead of one object
+    per month. Served from the read replica when one is configured.
     """
+    if layout not in LAYOUTS:
+        raise HTTPException(status_code=400, detail=f"Invalid layout. Use one of: {', '.join(LAYOUTS)}")
     try:
-        result = get_client_statistics(db, client_id)
-        return result
+        result = await run_db(db, get_client_statistics, client_id)
+        if layout == "columnar":
+            result = columnar_client_statistics(result)
+        return ORJSONResponse(result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get client statistics: {str(e)}")
 
 
-@router.get("/system-load", response_model=SystemLoadResponse)
-def system_load(
+@router.get("/client-profile/{client_id}",
+            response_model=Union[ClientHourlyProfileResponse, ClientHourlyProfileColumnarResponse])
+async def client_hourly_profile(
+        client_id: int,
+        year: int,
+        month: int,
+        layout: str = "rows",
+        db: DbSession = Depends(get_read_session)
+):
+    """
+    Get a client's consumption and injection for a month by hour of the day.
+
+    Read from the precomputed hourly profiles, so the cost doesn't depend on the number of
+    readings. Hours without readings are 0. With layout=columnar, hourly_profile has one
+    list per field. Served from the read replica when one is configured.
+    """
+    if layout not in LAYOUTS:
+        raise HTTPException(status_code=400, detail=f"Invalid layout. Use one of: {', '.join(LAYOUTS)}")
+    if not 1 <= month <= 12:
+        raise HTTPException(status_code=400, detail="Invalid month. Use a value between 1 and 12")
+    try:
+        result = await run_db(db, get_service_hourly_profile, client_id, year, month)
+        if layout == "columnar":
+            result = columnar_hourly_profile(result)
+        return ORJSONResponse(result)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get client profile: {str(e)}")
+
+
+@router.get("/portfolio-statistics",
+            response_model=Union[PortfolioStatisticsResponse, PortfolioStatisticsColumnarResponse])
+def portfolio_statistics(
+        client_id: Optional[List[int]] = Query(None),
+        id_market: Optional[int] = None,
+        voltage_level: Optional[int] = None,
+        after: Optional[int] = None,
+        limit: int = PORTFOLIO_PAGE_SIZE,
+        layout: str = "rows"
+):
+    """
+    Get consumption and injection statistics for many clients at once.
+
+    Clients can be selected by ID, market or voltage level; all clients are included when
+    no filter is given. Each client has the same fields as /client-statistics. Results come
+    in pages of up to limit clients ordered by ID: pass the returned next_after as after to
+    get the next page. The page is streamed from the read replica when one is configured.
+    """
+    if layout not in LAYOUTS:
+        raise HTTPException(status_code=400, detail=f"Invalid layout. Use one of: {', '.join(LAYOUTS)}")
+    if not 1 <= limit <= PORTFOLIO_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"Invalid limit. Use a value between 1 and {PORTFOLIO_MAX_PAGE_SIZE}")
+
+    service_filter = get_service_filter(client_id, id_market, voltage_level)
+
+    def generate():
+        # The session lives as long as the stream, not the request handler
+        db = ReplicaSessionLocal()
+        try:
+            statistics = iter_portfolio_statistics(db, service_filter, after, limit)
+            yield from iter_portfolio_statistics_json(statistics, limit, layout)
+        finally:
+            db.close()
+
+    return StreamingResponse(generate(), media_type="application/json")
+
+
+@router.get("/system-load", response_model=Union[
+    SystemLoadResponse, SystemLoadColumnarResponse, SystemLoadSeriesResponse, SystemLoadSeriesColumnarResponse
+])
+async def system_load(
         date_str: Optional[str] = None,
-        db: Session = Depends(get_db)
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+        resolution: str = "hour",
+        layout: str = "rows",
+        db: DbSession = Depends(get_read_session)
 ):
     """
     Get system load by hour based on consumption data.
 
-    If no date is provided, today's date is used.
+    If no date is provided, today's date is used. With start_date and end_date (YYYY-MM-DD),
+    the load from start_date up to, but not including, end_date is returned instead, by hour,
+    day or month (resolution), with a load of 0 for buckets without readings. Rows layouts
+    longer than SYSTEM_LOAD_STREAM_BUCKETS buckets are streamed.
+
+    With layout=columnar, hourly_loads (or loads) has one list per field instead of one object
+    per bucket. Served from the read replica when one is configured.
     """
+    if layout not in LAYOUTS:
+        raise HTTPException(status_code=400, detail=f"Invalid layout. Use one of: {', '.join(LAYOUTS)}")
+    if resolution not in RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"Invalid resolution. Use one of: {', '.join(RESOLUTIONS)}")
+
+    if start_date or end_date:
+        if not (start_date and end_date):
+            raise HTTPException(status_code=400, detail="start_date and end_date must be given together")
+        try:
+            start = datetime.strptime(start_date, "%Y-%m-%d")
+            end = datetime.strptime(end_date, "%Y-%m-%d")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+        if end <= start:
+            raise HTTPException(status_code=400, detail="end_date must be after start_date")
+
+        if layout == "rows" and count_buckets(start, end, resolution) > SYSTEM_LOAD_STREAM_BUCKETS:
+            def generate():
+                # The session lives as long as the stream, not the request handler
+                stream_db = ReplicaSessionLocal()
+                try:
+                    yield from iter_system_load_series_json(
+                        start, end, resolution, iter_system_load_series(stream_db, start, end, resolution)
+                    )
+                finally:
+                    stream_db.close()
+
+            return StreamingResponse(generate(), media_type="application/json")
+
+        try:
+            result = await run_db(db, get_system_load_series, start, end, resolution)
+            if layout == "columnar":
+                result = columnar_system_load_series(result)
+            return ORJSONResponse(result)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to get system load: {str(e)}")
+
     try:
         if date_str:
             target_date = datetime.strptime(date_str, "%Y-%m-%d")
         else:
             target_date = datetime.now()
 
-        result = get_system_load(db, target_date)
-        return result
+        result = await run_db(db, get_system_load, target_date)
+        if layout == "columnar":
+            result = columnar_system_load(result)
+        return ORJSONResponse(result)
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
     except Exception as e:
@@ -86,23 +439,23 @@ def system_load(
 
 
 @router.get("/calculate-ea/{client_id}", response_model=ConceptResponse)
-def calculate_ea_endpoint(
+async def calculate_ea_endpoint(
         client_id: int,
         year: int,
         month: int,
-        db: Session = Depends(get_db)
+        db: DbSession = Depends(get_session)
 ):
     """
     Calculate EA (Active Energy) for a client and a specific month.
     """
     try:
-        quantity, rate, total = calculate_EA(db, client_id, year, month)
-        return {
+        quantity, rate, total = await run_db(db, calculate_EA, client_id, year, month)
+        return ORJSONResponse({
             "concept": "EA",
             "quantity": quantity,
             "rate": rate,
             "total": total
-        }
+        })
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -110,23 +463,23 @@ def calculate_ea_endpoint(
 
 
 @router.get("/calculate-ec/{client_id}", response_model=ConceptResponse)
-def calculate_ec_endpoint(
+async def calculate_ec_endpoint(
         client_id: int,
         year: int,
         month: int,
-        db: Session = Depends(get_db)
+        db: DbSession = Depends(get_session)
 ):
     """
     Calculate EC (Energy Excess Commercialization) for a client and a specific month.
     """
     try:
-        quantity, rate, total = calculate_EC(db, client_id, year, month)
-        return {
+        quantity, rate, total = await run_db(db, calculate_EC, client_id, year, month)
+        return ORJSONResponse({
             "concept": "EC",
             "quantity": quantity,
             "rate": rate,
             "total": total
-        }
+        })
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -134,23 +487,23 @@ def calculate_ec_endpoint(
 
 
 @router.get("/calculate-ee1/{client_id}", response_model=ConceptResponse)
-def calculate_ee1_endpoint(
+async def calculate_ee1_endpoint(
         client_id: int,
         year: int,
         month: int,
-        db: Session = Depends(get_db)
+        db: DbSession = Depends(get_session)
 ):
     """
     Calculate EE1 (Energy Excess type 1) for a client and a specific month.
     """
     try:
-        quantity, rate, total = calculate_EE1(db, client_id, year, month)
-        return {
+        quantity, rate, total = await run_db(db, calculate_EE1, client_id, year, month)
+        return ORJSONResponse({
             "concept": "EE1",
             "quantity": quantity,
             "rate": rate,
             "total": total
-        }
+        })
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -158,23 +511,23 @@ def calculate_ee1_endpoint(
 
 
 @router.get("/calculate-ee2/{client_id}", response_model=ConceptResponse)
-def calculate_ee2_endpoint(
+async def calculate_ee2_endpoint(
         client_id: int,
         year: int,
         month: int,
-        db: Session = Depends(get_db)
+        db: DbSession = Depends(get_session)
 ):
     """
     Calculate EE2 (Energy Excess type 2) for a client and a specific month.
     """
     try:
-        quantity, rate, total = calculate_EE2(db, client_id, year, month)
-        return {
+        quantity, rate, total = await run_db(db, calculate_EE2, client_id, year, month)
+        return ORJSONResponse({
             "concept": "EE2",
             "quantity": quantity,
             "rate": rate,
             "total": total
-        }
+        })
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -0,0 +1,16 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from app.utils.profiling import metrics
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    """
+    Get request and calculation metrics in the Prometheus text format.
+
+    Counters are kept per worker process, so scrape every worker (or aggregate them).
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
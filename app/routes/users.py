@@ -2,17 +2,22 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 
 # Fix the import to use app.database
-from app.database import get_db
+from app.database import get_session, run_db, DbSession
 from app.models.models import Service
 
 router = APIRouter()
 
+
+def get_service(db: Session, client_id: int):
+    return db.query(Service).filter(Service.id_service == client_id).first()
+
+
 @router.get("/users/{client_id}")
-def read_user(client_id: int, db: Session = Depends(get_db)):
+async def read_user(client_id: int, db: DbSession = Depends(get_session)):
     """
     Get basic information about a client (service).
     """
-    service = db.query(Service).filter(Service.id_service == client_id).first()
+    service = await run_db(db, get_service, client_id)
     if service is None:
         raise HTTPException(status_code=404, detail="Client not found")
     return {
@@ -2,18 +2,57 @@ from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
 
+
 # Request models
 class InvoiceCalculationRequest(BaseModel):
     client_id: int
     month: int
     year: int
 
+
+class InvoiceBatchRequest(BaseModel):
+    month: int
+    year: int
+    client_ids: Optional[List[int]] = None
+    id_market: Optional[int] = None
+    voltage_level: Optional[int] = None
+
+
+class TariffCandidate(BaseModel):
+    id_market: int
+    voltage_level: int
+    cdi: Optional[int] = None
+    G: float
+    T: float
+    D: float
+    R: float
+    C: float
+    P: float
+    CU: Optional[float] = None
+
+
+class TariffScenario(BaseModel):
+    name: str
+    tariffs: List[TariffCandidate]
+
+
+class TariffSimulationRequest(BaseModel):
+    month: int
+    year: int
+    scenarios: List[TariffScenario]
+    client_ids: Optional[List[int]] = None
+    id_market: Optional[int] = None
+    voltage_level: Optional[int] = None
+    include_services: bool = True
+
+
 # Response models
 class ConceptCalculation(BaseModel):
     quantity: float
     tariff: float
     total: float
 
+
 class InvoiceCalculationResponse(BaseModel):
     client_id: int
     month: int
@@ -24,14 +63,85 @@ class InvoiceCalculationResponse(BaseModel):
     EE2: ConceptCalculation
     total: float
 
+
+class InvoiceHistoryResponse(BaseModel):
+    client_id: int
+    invoices: List[InvoiceCalculationResponse]
+
+
+class ConceptTotals(BaseModel):
+    EA: float
+    EC: float
+    EE1: float
+    EE2: float
+    total: float
+
+
+class TariffScenarioResult(BaseModel):
+    name: str
+    unmatched_tariffs: int
+    totals: ConceptTotals
+    deltas: ConceptTotals
+    delta_percent: Optional[float]
+    service_totals: Optional[List[float]]
+    service_deltas: Optional[List[float]]
+
+
+class TariffSimulationResponse(BaseModel):
+    year: int
+    month: int
+    services: int
+    services_without_tariff: int
+    current: ConceptTotals
+    client_ids: Optional[List[int]]
+    current_service_totals: Optional[List[float]]
+    scenarios: List[TariffScenarioResult]
+
+
 class HourlySystemLoad(BaseModel):
     hour: int
     load: float
 
+
 class SystemLoadResponse(BaseModel):
     date: datetime
     hourly_loads: List[HourlySystemLoad]
 
+
+class HourlySystemLoadColumns(BaseModel):
+    hour: List[int]
+    load: List[float]
+
+
+class SystemLoadColumnarResponse(BaseModel):
+    date: datetime
+    hourly_loads: HourlySystemLoadColumns
+
+
+class SystemLoadPoint(BaseModel):
+    timestamp: datetime
+    load: float
+
+
+class SystemLoadSeriesResponse(BaseModel):
+    start: datetime
+    end: datetime
+    resolution: str
+    loads: List[SystemLoadPoint]
+
+
+class SystemLoadPointColumns(BaseModel):
+    timestamp: List[datetime]
+    load: List[float]
+
+
+class SystemLoadSeriesColumnarResponse(BaseModel):
+    start: datetime
+    end: datetime
+    resolution: str
+    loads: SystemLoadPointColumns
+
+
 class ClientStatistic(BaseModel):
     month: int
     year: int
@@ -39,6 +149,7 @@ class ClientStatistic(BaseModel):
     injection: float
     net: float
 
+
 class ClientStatisticsResponse(BaseModel):
     client_id: int
     monthly_statistics: List[ClientStatistic]
@@ -46,8 +157,75 @@ class ClientStatisticsResponse(BaseModel):
     average_injection: float
     average_net: float
 
+
+class ClientStatisticColumns(BaseModel):
+    month: List[int]
+    year: List[int]
+    consumption: List[float]
+    injection: List[float]
+    net: List[float]
+
+
+class ClientStatisticsColumnarResponse(BaseModel):
+    client_id: int
+    monthly_statistics: ClientStatisticColumns
+    average_consumption: float
+    average_injection: float
+    average_net: float
+
+
+class HourlyProfile(BaseModel):
+    hour: int
+    consumption: float
+    injection: float
+
+
+class ClientHourlyProfileResponse(BaseModel):
+    client_id: int
+    year: int
+    month: int
+    hourly_profile: List[HourlyProfile]
+
+
+class HourlyProfileColumns(BaseModel):
+    hour: List[int]
+    consumption: List[float]
+    injection: List[float]
+
+
+class ClientHourlyProfileColumnarResponse(BaseModel):
+    client_id: int
+    year: int
+    month: int
+    hourly_profile: HourlyProfileColumns
+
+
+class PortfolioStatisticsResponse(BaseModel):
+    clients: List[ClientStatisticsResponse]
+    next_after: Optional[int]
+
+
+class PortfolioStatisticsColumnarResponse(BaseModel):
+    clients: List[ClientStatisticsColumnarResponse]
+    next_after: Optional[int]
+
+
 class ConceptResponse(BaseModel):
     concept: str
     quantity: float
     rate: float
-    total: float
\ No newline at end of file
+    total: float
+
+
+class ReadingIngestionResponse(BaseModel):
+    readings: int
+    batches: int
+
+
+class InvoiceCacheStatsResponse(BaseModel):
+    backend: str
+    entries: int
+    hits: int
+    misses: int
+    hit_ratio: float
+    invalidations: int
@@ -0,0 +1,147 @@
+"""
+Billing math on plain values, without a database.
+
+Everything here takes tariffs, totals and hourly arrays and returns numbers, so it can be
+run in worker processes, on data held in memory (what-if recalculations, benchmarks) or
+vectorized later. app.utils.calculations loads the inputs from the database.
+"""
+from collections import namedtuple
+from typing import Dict, Tuple
+import numpy as np
+
+HOURS_PER_DAY = 24
+
+TariffRates = namedtuple("TariffRates", ["id_market", "cdi", "voltage_level", "G", "T", "D", "R", "C", "P", "CU"])
+
+# Everything the invoice of a service for a month depends on. hourly_injections is the
+# month's injection by hour of the day; hourly_injections and hourly_rates are only used
+# when total_injection exceeds total_consumption (EE2), hourly_rates may be None otherwise.
+InvoiceInputs = namedtuple("InvoiceInputs", [
+    "client_id",
+    "year",
+    "month",
+    "tariff",
+    "total_consumption",
+    "total_injection",
+    "hourly_injections",
+    "hourly_rates",
+])
+
+Concept = namedtuple("Concept", ["quantity", "rate", "total"])
+
+
+def sequential_sum(values: np.ndarray) -> float:
+    """
+    Sum values one after another, in order.
+
+    np.sum uses pairwise summation, which can differ in the last digits from the
+    running sums the rest of the billing code uses.
+    """
+    if len(values) == 0:
+        return 0
+    return float(np.add.accumulate(values)[-1])
+
+
+def bucket_by_hour(hours: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Sum values into the 24 hours of the day, ignoring missing (NaN) values"""
+    values = np.where(np.isnan(values), 0.0, values)
+    return np.bincount(hours.astype(np.int64), weights=values, minlength=HOURS_PER_DAY)
+
+
+def allocate_hourly_excess(hourly_injections: np.ndarray, total_consumption: float) -> np.ndarray:
+    """
+    Allocate the injection that exceeds the month's consumption to the hours of the day.
+
+    Hours are walked in order accumulating injection; once the accumulated injection
+    passes the consumption threshold, each hour's excess is allocated to it and the
+    threshold moves up by that amount. Hours before the first crossing are skipped
+    with a single vectorized comparison; the threshold update itself is kept as a
+    running value so results are identical to the original per-hour allocation.
+    """
+    excess = np.zeros(HOURS_PER_DAY)
+    accumulated = np.cumsum(hourly_injections)
+
+    crossed = np.flatnonzero(accumulated > total_consumption)
+    if not crossed.size:
+        return excess
+
+    threshold = total_consumption
+    for hour in range(crossed[0], HOURS_PER_DAY):
+        if accumulated[hour] > threshold:
+            hour_excess = min(hourly_injections[hour], accumulated[hour] - threshold)
+            if hour_excess > 0:
+                excess[hour] = hour_excess
+                threshold += hour_excess  # Update threshold for next hour
+
+    return excess
+
+
+def price_hourly_excess(excess: np.ndarray, rates: np.ndarray, quantity: float) -> Tuple[float, float]:
+    """Price the hourly excess, returning the total and the average rate"""
+    total = sequential_sum(excess * rates)
+    rate = total / quantity if quantity > 0 else 0
+    return rate, total
+
+
+def compute_EA(inputs: InvoiceInputs) -> Concept:
+    """Compute EA (Active Energy)"""
+    cu_rate = inputs.tariff.CU
+    return Concept(inputs.total_consumption, cu_rate, inputs.total_consumption * cu_rate)
+
+
+def compute_EC(inputs: InvoiceInputs) -> Concept:
+    """Compute EC (Energy Excess Commercialization)"""
+    c_rate = inputs.tariff.C
+    return Concept(inputs.total_injection, c_rate, inputs.total_injection * c_rate)
+
+
+def compute_EE1(inputs: InvoiceInputs) -> Concept:
+    """Compute EE1 (Energy Excess type 1)"""
+    # Calculate EE1 quantity: min(total_injection, total_consumption)
+    ee1_quantity = min(inputs.total_injection, inputs.total_consumption)
+
+    # Tariff for EE1 is negative CU
+    ee1_rate = -inputs.tariff.CU
+    return Concept(ee1_quantity, ee1_rate, ee1_quantity * ee1_rate)
+
+
+def compute_EE2(inputs: InvoiceInputs) -> Concept:
+    """Compute EE2 (Energy Excess type 2)"""
+    total_consumption = inputs.total_consumption
+    total_injection = inputs.total_injection
+
+    # Only calculate EE2 if injection exceeds consumption
+    if total_injection <= total_consumption:
+        return Concept(0.0, 0.0, 0.0)
+
+    if inputs.hourly_rates is None:
+        raise ValueError("Hourly rates are needed to price the excess injection")
+
+    ee2_quantity = total_injection - total_consumption
+
+    # Allocate the excess to the hours of the day, then price it at each hour's rate
+    excess_by_hour = allocate_hourly_excess(inputs.hourly_injections, total_consumption)
+    ee2_rate, total_ee2 = price_hourly_excess(excess_by_hour, inputs.hourly_rates, ee2_quantity)
+
+    return Concept(ee2_quantity, ee2_rate, total_ee2)
+
+
+def compute_invoice(inputs: InvoiceInputs) -> Dict:
+    """Compute every concept and the total of an invoice"""
+    concepts = {
+        "EA": compute_EA(inputs),
+        "EC": compute_EC(inputs),
+        "EE1": compute_EE1(inputs),
+        "EE2": compute_EE2(inputs),
+    }
+
+    invoice = {
+        "client_id": inputs.client_id,
+        "month": inputs.month,
+        "year": inputs.year,
+    }
+    for name, concept in concepts.items():
+        invoice[name] = {"quantity": concept.quantity, "tariff": concept.rate, "total": concept.total}
+    invoice["total"] = concepts["EA"].total + concepts["EC"].total + concepts["EE1"].total + concepts["EE2"].total
+
+    return invoice
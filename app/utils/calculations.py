@@ -1,329 +1,238 @@
+"""
+Data access for the billing math in app.utils.billing: loads the inputs of an invoice
+from the database and hands them to the pure computation.
+"""
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from datetime import datetime, timedelta
-import calendar
-from typing import Tuple, Dict, List
-from app.models.models import Service, Consumption, Injection, Record, Tariff, XmDataHourlyPerAgent
+from sqlalchemy import func, select
+from datetime import datetime
+from itertools import groupby
+from typing import Iterator, List, Optional, Tuple, Dict
+import numpy as np
+
+from app.models.models import Service, ServiceHourlyProfile, ServiceMonthlyRollup, SystemHourlyRollup
+from app.utils.billing import (
+    HOURS_PER_DAY,
+    Concept,
+    InvoiceInputs,
+    TariffRates,
+    compute_EA,
+    compute_EC,
+    compute_EE1,
+    compute_EE2,
+    compute_invoice
+)
+from app.utils.dates import check_month, iter_buckets, next_bucket, truncate
+from app.utils.prices import get_hourly_rates, get_monthly_hourly_rates
+from app.utils.tariffs import tariff_resolver
+from app.utils.rollups import get_hourly_profiles, get_service_month_totals, time_bucket
+from app.utils.invoice_cache import invoice_cache, get_invoice_tags
+from app.utils.profiling import profiled
+
+
+@profiled
+def get_service_tariff(db: Session, service: Service) -> TariffRates:
+    """Get the tariff that applies to a service"""
+    tariff = tariff_resolver.resolve(db, service)
 
+    if not tariff:
+        raise ValueError("Tariff not found for the given service parameters")
 
-def get_month_date_range(year: int, month: int) -> Tuple[datetime, datetime]:
-    """Get the start and end dates for a specific month"""
-    first_day = datetime(year, month, 1)
-    last_day = datetime(year, month, calendar.monthrange(year, month)[1], 23, 59, 59)
-    return first_day, last_day
+    return tariff
 
 
-def calculate_EA(db: Session, client_id: int, year: int, month: int) -> Tuple[float, float, float]:
-    """Calculate EA (Active Energy)"""
-    first_day, last_day = get_month_date_range(year, month)
+@profiled
+def load_invoice_inputs(db: Session, client_id: int, year: int, month: int) -> Tuple[Service, InvoiceInputs]:
+    """
+    Load everything needed to invoice a client for a month, with the client's service.
+
+    The service, its tariff and the month's totals are fetched once, so all concepts
+    can be derived from the same snapshot. Totals come from the monthly rollup; the
+    hourly injection profile and the hourly rates are only read when EE2 needs them.
+    """
+    check_month(month)
 
     # Get service for the client
     service = db.query(Service).filter(Service.id_service == client_id).first()
     if not service:
         raise ValueError(f"Client with ID {client_id} not found")
 
-    # Get sum of consumption
-    total_consumption = db.query(func.sum(Consumption.value)).join(
-        Record
-    ).filter(
-        Record.id_service == client_id,
-        Record.record_timestamp >= first_day,
-        Record.record_timestamp <= last_day
-    ).scalar() or 0
-
-    # Get tariff
-    voltage_level = service.voltage_level
-    cdi = service.cir if voltage_level not in [2, 3] else 0  # cdi doesn't matter if voltage_level is 2 or 3
-
-    tariff = db.query(Tariff).filter(
-        Tariff.id_market == service.id_market,
-        Tariff.voltage_level == voltage_level
-    )
-
-    if voltage_level not in [2, 3]:
-        tariff = tariff.filter(Tariff.cdi == cdi)
-
-    tariff = tariff.first()
+    tariff = get_service_tariff(db, service)
 
-    if not tariff:
-        raise ValueError("Tariff not found for the given service parameters")
-
-    cu_rate = tariff.CU
-    total_ea = total_consumption * cu_rate
-
-    return total_consumption, cu_rate, total_ea
+    total_consumption, total_injection = get_service_month_totals(db, client_id, year, month)
 
+    hourly_injections = np.zeros(HOURS_PER_DAY)
+    hourly_rates = None
+    if total_injection > total_consumption:
+        hourly_injections = get_hourly_injections(db, client_id, year, month)
+        hourly_rates = get_hourly_rates(db, year, month)
+
+    return service, InvoiceInputs(
+        client_id=client_id,
+        year=year,
+        month=month,
+        tariff=tariff,
+        total_consumption=total_consumption,
+        total_injection=total_injection,
+        hourly_injections=hourly_injections,
+        hourly_rates=hourly_rates
+    )
 
-def calculate_EC(db: Session, client_id: int, year: int, month: int) -> Tuple[float, float, float]:
-    """Calculate EC (Energy Excess Commercialization)"""
-    first_day, last_day = get_month_date_range(year, month)
 
-    # Get service for the client
-    service = db.query(Service).filter(Service.id_service == client_id).first()
-    if not service:
-        raise ValueError(f"Client with ID {client_id} not found")
+def get_hourly_injections(db: Session, client_id: int, year: int, month: int) -> np.ndarray:
+    """Get a client's injection for the month by hour of the day from its hourly profile"""
+    profiles = get_hourly_profiles(db, [client_id], year, month)
+    return profiles.get(client_id, np.zeros(HOURS_PER_DAY))
 
-    # Get sum of injection
-    total_injection = db.query(func.sum(Injection.value)).join(
-        Record
-    ).filter(
-        Record.id_service == client_id,
-        Record.record_timestamp >= first_day,
-        Record.record_timestamp <= last_day
-    ).scalar() or 0
-
-    # Get tariff
-    voltage_level = service.voltage_level
-    cdi = service.cir if voltage_level not in [2, 3] else 0  # cdi doesn't matter if voltage_level is 2 or 3
-
-    tariff = db.query(Tariff).filter(
-        Tariff.id_market == service.id_market,
-        Tariff.voltage_level == voltage_level
-    )
 
-    if voltage_level not in [2, 3]:
-        tariff = tariff.filter(Tariff.cdi == cdi)
+def get_invoice_concept(invoice: Dict, concept: str) -> Concept:
+    """Get the quantity, rate and total of a concept from a built invoice"""
+    values = invoice[concept]
+    return Concept(values["quantity"], values["tariff"], values["total"])
 
-    tariff = tariff.first()
 
-    if not tariff:
-        raise ValueError("Tariff not found for the given service parameters")
+@profiled
+def calculate_EA(db: Session, client_id: int, year: int, month: int) -> Tuple[float, float, float]:
+    """Calculate EA (Active Energy)"""
+    if invoice_cache.caches(year, month):
+        return get_invoice_concept(calculate_all_concepts(db, client_id, year, month), "EA")
+    return compute_EA(load_invoice_inputs(db, client_id, year, month)[1])
 
-    c_rate = tariff.C
-    total_ec = total_injection * c_rate
 
-    return total_injection, c_rate, total_ec
+@profiled
+def calculate_EC(db: Session, client_id: int, year: int, month: int) -> Tuple[float, float, float]:
+    """Calculate EC (Energy Excess Commercialization)"""
+    if invoice_cache.caches(year, month):
+        return get_invoice_concept(calculate_all_concepts(db, client_id, year, month), "EC")
+    return compute_EC(load_invoice_inputs(db, client_id, year, month)[1])
 
 
+@profiled
 def calculate_EE1(db: Session, client_id: int, year: int, month: int) -> Tuple[float, float, float]:
     """Calculate EE1 (Energy Excess type 1)"""
-    first_day, last_day = get_month_date_range(year, month)
+    if invoice_cache.caches(year, month):
+        return get_invoice_concept(calculate_all_concepts(db, client_id, year, month), "EE1")
+    return compute_EE1(load_invoice_inputs(db, client_id, year, month)[1])
 
-    # Get service for the client
-    service = db.query(Service).filter(Service.id_service == client_id).first()
-    if not service:
-        raise ValueError(f"Client with ID {client_id} not found")
 
-    # Get sum of consumption and injection
-    total_consumption = db.query(func.sum(Consumption.value)).join(
-        Record
-    ).filter(
-        Record.id_service == client_id,
-        Record.record_timestamp >= first_day,
-        Record.record_timestamp <= last_day
-    ).scalar() or 0
+@profiled
+def calculate_EE2(db: Session, client_id: int, year: int, month: int) -> Tuple[float, float, float]:
+    """Calculate EE2 (Energy Excess type 2)"""
+    if invoice_cache.caches(year, month):
+        return get_invoice_concept(calculate_all_concepts(db, client_id, year, month), "EE2")
+    return compute_EE2(load_invoice_inputs(db, client_id, year, month)[1])
 
-    total_injection = db.query(func.sum(Injection.value)).join(
-        Record
-    ).filter(
-        Record.id_service == client_id,
-        Record.record_timestamp >= first_day,
-        Record.record_timestamp <= last_day
-    ).scalar() or 0
 
-    # Calculate EE1 quantity: min(total_injection, total_consumption)
-    ee1_quantity = min(total_injection, total_consumption)
+@profiled
+def calculate_all_concepts(db: Session, client_id: int, year: int, month: int) -> Dict:
+    """
+    Calculate all energy concepts for a client in a specific month.
 
-    # Get tariff
-    voltage_level = service.voltage_level
-    cdi = service.cir if voltage_level not in [2, 3] else 0  # cdi doesn't matter if voltage_level is 2 or 3
+    Invoices of closed months are served from the invoice cache.
+    """
+    check_month(month)
 
-    tariff = db.query(Tariff).filter(
-        Tariff.id_market == service.id_market,
-        Tariff.voltage_level == voltage_level
-    )
+    if not invoice_cache.caches(year, month):
+        return compute_invoice(load_invoice_inputs(db, client_id, year, month)[1])
 
-    if voltage_level not in [2, 3]:
-        tariff = tariff.filter(Tariff.cdi == cdi)
+    def compute():
+        service, inputs = load_invoice_inputs(db, client_id, year, month)
+        return compute_invoice(inputs), get_invoice_tags(service, year, month)
 
-    tariff = tariff.first()
+    return invoice_cache.get_or_compute(db, (client_id, year, month), compute)
 
-    if not tariff:
-        raise ValueError("Tariff not found for the given service parameters")
 
-    # Tariff for EE1 is negative CU
-    ee1_rate = -tariff.CU
-    total_ee1 = ee1_quantity * ee1_rate
+@profiled
+def get_invoice_history(db: Session, client_id: int, start: datetime, end: datetime) -> Dict:
+    """
+    Calculate the invoices of a client for every month from start to end, both included.
 
-    return ee1_quantity, ee1_rate, total_ee1
+    The service and its tariff are resolved once, the monthly totals of the whole range
+    come from one rollup query, and the hourly profiles and rates EE2 needs from one
+    more query and one read of the price store for the months with excess injection. Invoices are computed directly, without going
+    through the invoice cache.
+    """
+    if end < start:
+        raise ValueError("The end of the range must not be before its start")
+    months = list(iter_buckets(start, next_bucket(end, "month"), "month"))
 
-
-def calculate_EE2(db: Session, client_id: int, year: int, month: int) -> Tuple[float, float, float]:
-    """Calculate EE2 (Energy Excess type 2)"""
-    first_day, last_day = get_month_date_range(year, month)
-
-    # Get service for the client
     service = db.query(Service).filter(Service.id_service == client_id).first()
     if not service:
         raise ValueError(f"Client with ID {client_id} not found")
 
-    # Get sum of consumption and injection
-    total_consumption = db.query(func.sum(Consumption.value)).join(
-        Record
-    ).filter(
-        Record.id_service == client_id,
-        Record.record_timestamp >= first_day,
-        Record.record_timestamp <= last_day
-    ).scalar() or 0
+    tariff = get_service_tariff(db, service)
 
-    total_injection = db.query(func.sum(Injection.value)).join(
-        Record
+    month_index = ServiceMonthlyRollup.year * 12 + ServiceMonthlyRollup.month
+    rows = db.query(
+        ServiceMonthlyRollup.year,
+        ServiceMonthlyRollup.month,
+        ServiceMonthlyRollup.consumption,
+        ServiceMonthlyRollup.injection
     ).filter(
-        Record.id_service == client_id,
-        Record.record_timestamp >= first_day,
-        Record.record_timestamp <= last_day
-    ).scalar() or 0
-
-    # Calculate EE2 quantity
-    ee2_quantity = 0
-    ee2_rate = 0
-    total_ee2 = 0
-
-    # Only calculate EE2 if injection exceeds consumption
-    if total_injection > total_consumption:
-        ee2_quantity = total_injection - total_consumption
-
-        # Get hourly injection and hourly consumption
-        hourly_injections = {}
-        hourly_consumptions = {}
-
-        # Get all records with injection for the client in the given month
-        injection_records = db.query(
-            Record.record_timestamp,
-            Injection.value
-        ).join(
-            Injection
-        ).filter(
-            Record.id_service == client_id,
-            Record.record_timestamp >= first_day,
-            Record.record_timestamp <= last_day
-        ).all()
-
-        # Get all records with consumption for the client in the given month
-        consumption_records = db.query(
-            Record.record_timestamp,
-            Consumption.value
-        ).join(
-            Consumption
+        ServiceMonthlyRollup.id_service == client_id,
+        month_index >= start.year * 12 + start.month,
+        month_index <= end.year * 12 + end.month
+    ).all()
+    totals = {
+        (int(year), int(month)): (consumption or 0.0, injection or 0.0)
+        for year, month, consumption, injection in rows
+    }
+    month_totals = [(month, *totals.get((month.year, month.month), (0.0, 0.0))) for month in months]
+
+    # Hourly profiles of the months with excess injection, the only ones EE2 needs them for
+    profiles = {}
+    excess_months = [month for month, consumption, injection in month_totals if injection > consumption]
+    if excess_months:
+        month_index = ServiceHourlyProfile.year * 12 + ServiceHourlyProfile.month
+        rows = db.query(
+            ServiceHourlyProfile.year,
+            ServiceHourlyProfile.month,
+            ServiceHourlyProfile.hour,
+            ServiceHourlyProfile.injection
         ).filter(
-            Record.id_service == client_id,
-            Record.record_timestamp >= first_day,
-            Record.record_timestamp <= last_day
+            ServiceHourlyProfile.id_service == client_id,
+            month_index.in_([month.year * 12 + month.month for month in excess_months])
         ).all()
-
-        # Organize by hour
-        for timestamp, value in injection_records:
-            hour = timestamp.hour
-            if hour not in hourly_injections:
-                hourly_injections[hour] = 0
-            hourly_injections[hour] += value
-
-        for timestamp, value in consumption_records:
-            hour = timestamp.hour
-            if hour not in hourly_consumptions:
-                hourly_consumptions[hour] = 0
-            hourly_consumptions[hour] += value
-
-        # Calculate excess by hour
-        excess_by_hour = {}
-        accumulated_injection = 0
-        consumption_threshold = total_consumption
-
-        # Sort hours for consistent processing
-        sorted_hours = sorted(hourly_injections.keys())
-
-        for hour in sorted_hours:
-            injection_value = hourly_injections.get(hour, 0)
-            accumulated_injection += injection_value
-
-            # If we've exceeded the consumption threshold, record the excess
-            if accumulated_injection > consumption_threshold:
-                excess = min(injection_value, accumulated_injection - consumption_threshold)
-                if excess > 0:
-                    excess_by_hour[hour] = excess
-                    consumption_threshold += excess  # Update threshold for next hour
-
-        # Get hourly rates from xm_data_hourly_per_agent
-        hourly_rates = {}
-        for hour in excess_by_hour.keys():
-            # Find the rate for this hour
-            hour_start = datetime(year, month, 1, hour, 0, 0)
-            hour_end = hour_start + timedelta(hours=1)
-
-            rate = db.query(XmDataHourlyPerAgent.value).filter(
-                XmDataHourlyPerAgent.record_timestamp >= hour_start,
-                XmDataHourlyPerAgent.record_timestamp < hour_end
-            ).first()
-
-            hourly_rates[hour] = rate[0] if rate else 0
-
-        # Calculate EE2 total
-        hourly_totals = {}
-        for hour, excess in excess_by_hour.items():
-            hourly_totals[hour] = excess * hourly_rates[hour]
-
-        total_ee2 = sum(hourly_totals.values())
-
-        # Calculate average rate
-        ee2_rate = total_ee2 / ee2_quantity if ee2_quantity > 0 else 0
-
-    return ee2_quantity, ee2_rate, total_ee2
-
-
-def calculate_all_concepts(db: Session, client_id: int, year: int, month: int) -> Dict:
-    """Calculate all energy concepts for a client in a specific month"""
-    ea_quantity, ea_rate, ea_total = calculate_EA(db, client_id, year, month)
-    ec_quantity, ec_rate, ec_total = calculate_EC(db, client_id, year, month)
-    ee1_quantity, ee1_rate, ee1_total = calculate_EE1(db, client_id, year, month)
-    ee2_quantity, ee2_rate, ee2_total = calculate_EE2(db, client_id, year, month)
-
-    total_invoice = ea_total + ec_total + ee1_total + ee2_total
-
-    return {
-        "client_id": client_id,
-        "month": month,
-        "year": year,
-        "EA": {
-            "quantity": ea_quantity,
-            "tariff": ea_rate,
-            "total": ea_total
-        },
-        "EC": {
-            "quantity": ec_quantity,
-            "tariff": ec_rate,
-            "total": ec_total
-        },
-        "EE1": {
-            "quantity": ee1_quantity,
-            "tariff": ee1_rate,
-            "total": ee1_total
-        },
-        "EE2": {
-            "quantity": ee2_quantity,
-            "tariff": ee2_rate,
-            "total": ee2_total
-        },
-        "total": total_invoice
-    }
-
-
+        for year, month, hour, injection in rows:
+            profiles.setdefault((year, month), np.zeros(HOURS_PER_DAY))[hour] = injection or 0.0
+
+    rates = get_monthly_hourly_rates(db, [(month.year, month.month) for month in excess_months])
+
+    invoices = []
+    for month, total_consumption, total_injection in month_totals:
+        hourly_injections = np.zeros(HOURS_PER_DAY)
+        hourly_rates = None
+        if total_injection > total_consumption:
+            hourly_injections = profiles.get((month.year, month.month), np.zeros(HOURS_PER_DAY))
+            hourly_rates = rates[(month.year, month.month)]
+
+        invoices.append(compute_invoice(InvoiceInputs(
+            client_id=client_id,
+            year=month.year,
+            month=month.month,
+            tariff=tariff,
+            total_consumption=total_consumption,
+            total_injection=total_injection,
+            hourly_injections=hourly_injections,
+            hourly_rates=hourly_rates
+        )))
+
+    return {"client_id": client_id, "invoices": invoices}
+
+
+@profiled
 def get_client_statistics(db: Session, client_id: int) -> Dict:
     """Get consumption and injection statistics for a client"""
-    # Get all records for the client
+    # Get the monthly rollups of the client
     records = db.query(
-        func.extract('year', Record.record_timestamp).label('year'),
-        func.extract('month', Record.record_timestamp).label('month'),
-        func.sum(Consumption.value).label('consumption'),
-        func.sum(Injection.value).label('injection')
-    ).outerjoin(
-        Consumption, Record.id_record == Consumption.id_record
-    ).outerjoin(
-        Injection, Record.id_record == Injection.id_record
+        ServiceMonthlyRollup.year,
+        ServiceMonthlyRollup.month,
+        ServiceMonthlyRollup.consumption,
+        ServiceMonthlyRollup.injection
     ).filter(
-        Record.id_service == client_id
-    ).group_by(
-        func.extract('year', Record.record_timestamp),
-        func.extract('month', Record.record_timestamp)
+        ServiceMonthlyRollup.id_service == client_id
+    ).order_by(
+        ServiceMonthlyRollup.year,
+        ServiceMonthlyRollup.month
     ).all()
 
     monthly_stats = []
@@ -332,8 +241,8 @@ def get_client_statistics(db: Session, client_id: int) -> Dict:
     months_count = 0
 
     for year, month, consumption, injection in records:
-        consumption = consumption or 0
-        injection = injection or 0
+        consumption = consumption or 0.0
+        injection = injection or 0.0
         net = consumption - injection
 
         monthly_stats.append({
@@ -348,9 +257,9 @@ def get_client_statistics(db: Session, client_id: int) -> Dict:
         total_injection += injection
         months_count += 1
 
-    avg_consumption = total_consumption / months_count if months_count > 0 else 0
-    avg_injection = total_injection / months_count if months_count > 0 else 0
-    avg_net = (total_consumption - total_injection) / months_count if months_count > 0 else 0
+    avg_consumption = total_consumption / months_count if months_count > 0 else 0.0
+    avg_injection = total_injection / months_count if months_count > 0 else 0.0
+    avg_net = (total_consumption - total_injection) / months_count if months_count > 0 else 0.0
 
     return {
         "client_id": client_id,
@@ -361,27 +270,175 @@ def get_client_statistics(db: Session, client_id: int) -> Dict:
     }
 
 
+def iter_portfolio_statistics(
+        db: Session,
+        service_filter: List,
+        after: Optional[int] = None,
+        limit: int = 100,
+        chunk_size: int = 10000
+) -> Iterator[Dict]:
+    """
+    Get the statistics of a page of services, shaped like get_client_statistics.
+
+    Pages are keyset paginated on id_service: the first limit selected services with an ID
+    greater than after. Monthly values and averages come from a single query over the
+    monthly rollups, the averages computed by window functions; rows are read chunk_size
+    at a time and each service is yielded once its months have been read. Services without
+    rollups get no months and averages of 0.
+    """
+    clauses = list(service_filter)
+    if after is not None:
+        clauses.append(Service.id_service > after)
+    page = select(Service.id_service).where(*clauses).order_by(Service.id_service).limit(limit).subquery()
+
+    consumption = func.coalesce(ServiceMonthlyRollup.consumption, 0.0)
+    injection = func.coalesce(ServiceMonthlyRollup.injection, 0.0)
+    query = select(
+        page.c.id_service,
+        ServiceMonthlyRollup.year,
+        ServiceMonthlyRollup.month,
+        consumption,
+        injection,
+        func.avg(consumption).over(partition_by=page.c.id_service),
+        func.avg(injection).over(partition_by=page.c.id_service),
+        func.avg(consumption - injection).over(partition_by=page.c.id_service)
+    ).select_from(
+        page
+    ).outerjoin(
+        ServiceMonthlyRollup, ServiceMonthlyRollup.id_service == page.c.id_service
+    ).order_by(
+        page.c.id_service,
+        ServiceMonthlyRollup.year,
+        ServiceMonthlyRollup.month
+    )
+    rows = db.execute(query.execution_options(yield_per=chunk_size))
+
+    for client_id, months in groupby(rows, key=lambda row: row[0]):
+        months = list(months)
+        _, _, _, _, _, avg_consumption, avg_injection, avg_net = months[0]
+        yield {
+            "client_id": client_id,
+            "monthly_statistics": [
+                {
+                    "month": int(month),
+                    "year": int(year),
+                    "consumption": consumption,
+                    "injection": injection,
+                    "net": consumption - injection
+                }
+                for _, year, month, consumption, injection, *_ in months
+                if year is not None
+            ],
+            "average_consumption": avg_consumption or 0.0,
+            "average_injection": avg_injection or 0.0,
+            "average_net": avg_net or 0.0
+        }
+
+
+@profiled
+def get_service_hourly_profile(db: Session, client_id: int, year: int, month: int) -> Dict:
+    """Get a client's consumption and injection for a month by hour of the day"""
+    rows = db.query(
+        ServiceHourlyProfile.hour,
+        ServiceHourlyProfile.consumption,
+        ServiceHourlyProfile.injection
+    ).filter(
+        ServiceHourlyProfile.id_service == client_id,
+        ServiceHourlyProfile.year == year,
+        ServiceHourlyProfile.month == month
+    ).all()
+
+    profile = [(0.0, 0.0)] * HOURS_PER_DAY
+    for hour, consumption, injection in rows:
+        profile[hour] = (consumption or 0.0, injection or 0.0)
+
+    return {
+        "client_id": client_id,
+        "year": year,
+        "month": month,
+        "hourly_profile": [
+            {"hour": hour, "consumption": consumption, "injection": injection}
+            for hour, (consumption, injection) in enumerate(profile)
+        ]
+    }
+
+
+@profiled
 def get_system_load(db: Session, date: datetime) -> Dict:
     """Get system load by hour for a specific date"""
     start_date = datetime(date.year, date.month, date.day, 0, 0, 0)
     end_date = datetime(date.year, date.month, date.day, 23, 59, 59)
 
-    # Get hourly consumption for the system
-    hourly_loads = db.query(
-        func.extract('hour', Record.record_timestamp).label('hour'),
-        func.sum(Consumption.value).label('load')
-    ).join(
-        Consumption
+    # Get hourly consumption for the system from the hourly rollups
+    rollups = db.query(
+        SystemHourlyRollup.hour_timestamp,
+        SystemHourlyRollup.consumption
     ).filter(
-        Record.record_timestamp >= start_date,
-        Record.record_timestamp <= end_date
-    ).group_by(
-        func.extract('hour', Record.record_timestamp)
+        SystemHourlyRollup.hour_timestamp >= start_date,
+        SystemHourlyRollup.hour_timestamp <= end_date,
+        SystemHourlyRollup.consumption.isnot(None)
+    ).order_by(
+        SystemHourlyRollup.hour_timestamp
     ).all()
 
+    hourly_loads = [(hour_timestamp.hour, load) for hour_timestamp, load in rollups]
+
     return {
         "date": date,
         "hourly_loads": [
             {"hour": int(hour), "load": load} for hour, load in hourly_loads
         ]
-    }
\ No newline at end of file
+    }
+
+
+def iter_system_load_series(
+        db: Session,
+        start: datetime,
+        end: datetime,
+        resolution: str = "hour",
+        chunk_size: int = 10000
+) -> Iterator[Tuple[datetime, float]]:
+    """
+    Get the system load of every bucket from the one holding start up to end, not included.
+
+    The whole window is one GROUP BY over the hourly rollups, read chunk_size rows at a
+    time; buckets without readings get a load of 0.0.
+    """
+    bucket = time_bucket(db, SystemHourlyRollup.hour_timestamp, resolution)
+
+    rows = db.query(
+        bucket,
+        func.sum(SystemHourlyRollup.consumption)
+    ).filter(
+        SystemHourlyRollup.hour_timestamp >= truncate(start, resolution),
+        SystemHourlyRollup.hour_timestamp < end,
+        SystemHourlyRollup.consumption.isnot(None)
+    ).group_by(
+        bucket
+    ).order_by(
+        bucket
+    ).yield_per(chunk_size)
+
+    loads = iter(rows)
+    row = next(loads, None)
+    for timestamp in iter_buckets(start, end, resolution):
+        # SQLite returns the bucket as text
+        if row is not None and (datetime.fromisoformat(row[0]) if isinstance(row[0], str) else row[0]) == timestamp:
+            yield timestamp, row[1]
+            row = next(loads, None)
+        else:
+            yield timestamp, 0.0
+
+
+@profiled
+def get_system_load_series(db: Session, start: datetime, end: datetime, resolution: str = "hour") -> Dict:
+    """Get the system load from start up to end, not included, by hour, day or month"""
+    return {
+        "start": start,
+        "end": end,
+        "resolution": resolution,
+        "loads": [
+            {"timestamp": timestamp, "load": load}
+            for timestamp, load in iter_system_load_series(db, start, end, resolution)
+        ]
+    }
@@ -0,0 +1,276 @@
+import io
+from datetime import datetime
+from typing import Iterator, List, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.models.models import Consumption, Injection, Record
+from app.utils.rollups import rebuild_rollups
+
+# Readings read from the database or a file at a time
+READINGS_CHUNK_SIZE = 100000
+
+# Records joined with their consumption and injection, one row per record
+READINGS_SCHEMA = pa.schema([
+    ("id_record", pa.int64()),
+    ("id_service", pa.int64()),
+    ("record_timestamp", pa.timestamp("us")),
+    ("consumption", pa.float64()),
+    ("injection", pa.float64()),
+])
+
+# Columns derived from record_timestamp to partition exports by month
+MONTH_SCHEMA = pa.schema([("year", pa.int16()), ("month", pa.int8())])
+
+PARTITIONINGS = {
+    "none": [],
+    "month": ["year", "month"],
+    "service-month": ["id_service", "year", "month"],
+}
+
+# pyarrow dataset format and file extension of each supported format
+FILE_FORMATS = {
+    "parquet": ("parquet", "parquet"),
+    "arrow": ("ipc", "arrow"),
+}
+
+
+def get_readings_query(
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        client_ids: Optional[List[int]] = None
+):
+    """Records joined with consumption and injection, ordered by service and time"""
+    query = select(
+        Record.id_record,
+        Record.id_service,
+        Record.record_timestamp,
+        Consumption.value,
+        Injection.value
+    ).outerjoin(
+        Consumption, Record.id_record == Consumption.id_record
+    ).outerjoin(
+        Injection, Record.id_record == Injection.id_record
+    ).order_by(
+        Record.id_service,
+        Record.record_timestamp,
+        Record.id_record
+    )
+
+    if start is not None:
+        query = query.where(Record.record_timestamp >= start)
+    if end is not None:
+        query = query.where(Record.record_timestamp < end)
+    if client_ids is not None:
+        query = query.where(Record.id_service.in_(client_ids))
+    return query
+
+
+def iter_reading_batches(
+        db: Session,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        client_ids: Optional[List[int]] = None,
+        chunk_size: int = READINGS_CHUNK_SIZE
+) -> Iterator[pa.RecordBatch]:
+    """Stream the readings of [start, end) as record batches of at most chunk_size rows"""
+    result = db.execute(
+        get_readings_query(start, end, client_ids).execution_options(yield_per=chunk_size)
+    )
+    for rows in result.partitions():
+        columns = list(zip(*rows))
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, READINGS_SCHEMA)],
+            schema=READINGS_SCHEMA
+        )
+
+
+def add_month_columns(batch: pa.RecordBatch) -> pa.RecordBatch:
+    timestamps = batch.column("record_timestamp")
+    return pa.RecordBatch.from_arrays(
+        batch.columns + [
+            pc.year(timestamps).cast(pa.int16()),
+            pc.month(timestamps).cast(pa.int8()),
+        ],
+        schema=pa.unify_schemas([READINGS_SCHEMA, MONTH_SCHEMA])
+    )
+
+
+def export_readings(
+        db: Session,
+        path: str,
+        file_format: str = "parquet",
+        partitioning: str = "service-month",
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        client_ids: Optional[List[int]] = None,
+        chunk_size: int = READINGS_CHUNK_SIZE
+) -> int:
+    """
+    Write readings to a directory of Parquet or Arrow IPC files.
+
+    With partitioning, files go to hive style directories, such as
+    id_service=3222/year=2023/month=9/part-0.parquet. Files with the same name are
+    overwritten, so exporting a month again replaces it. Returns the number of rows.
+    """
+    dataset_format, extension = FILE_FORMATS[file_format]
+    partition_columns = PARTITIONINGS[partitioning]
+    schema = pa.unify_schemas([READINGS_SCHEMA, MONTH_SCHEMA])
+
+    rows = 0
+
+    def batches():
+        nonlocal rows
+        for batch in iter_reading_batches(db, start, end, client_ids, chunk_size):
+            rows += batch.num_rows
+            yield add_month_columns(batch)
+
+    ds.write_dataset(
+        batches(),
+        path,
+        schema=schema,
+        format=dataset_format,
+        partitioning=ds.partitioning(
+            pa.schema([schema.field(column) for column in partition_columns]), flavor="hive"
+        ) if partition_columns else None,
+        basename_template=f"part-{{i}}.{extension}",
+        existing_data_behavior="overwrite_or_ignore",
+        max_rows_per_group=chunk_size
+    )
+    return rows
+
+
+class ChunkSink(io.RawIOBase):
+    """Write-only file collecting what a writer produced since the last drain"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_readings_file(
+        db: Session,
+        file_format: str = "arrow",
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        client_ids: Optional[List[int]] = None,
+        chunk_size: int = READINGS_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Stream readings as a single Arrow IPC stream or Parquet file, one chunk of bytes per batch"""
+    sink = ChunkSink()
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(sink, READINGS_SCHEMA)
+    else:
+        writer = pa.ipc.new_stream(sink, READINGS_SCHEMA)
+
+    try:
+        for batch in iter_reading_batches(db, start, end, client_ids, chunk_size):
+            if file_format == "parquet":
+                writer.write_batch(batch, row_group_size=chunk_size)
+            else:
+                writer.write_batch(batch)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def read_reading_batches(
+        path: str,
+        file_format: str = "parquet",
+        chunk_size: int = READINGS_CHUNK_SIZE
+) -> Iterator[pa.RecordBatch]:
+    """Read an exported file or directory back as record batches with the readings schema"""
+    dataset = ds.dataset(path, format=FILE_FORMATS[file_format][0], partitioning="hive")
+    for batch in dataset.to_batches(columns=READINGS_SCHEMA.names, batch_size=chunk_size):
+        if batch.num_rows:
+            # Partition columns come back with the type inferred from the directory names
+            yield pa.RecordBatch.from_arrays(
+                [column.cast(field.type) for column, field in zip(batch.columns, READINGS_SCHEMA)],
+                schema=READINGS_SCHEMA
+            )
+
+
+def copy_batch(db: Session, table_name: str, batch: pa.RecordBatch):
+    buffer = io.BytesIO()
+    pa_csv.write_csv(batch, buffer, pa_csv.WriteOptions(include_header=False))
+    buffer.seek(0)
+    cursor = db.connection().connection.cursor()
+    try:
+        columns = ", ".join(batch.schema.names)
+        cursor.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cursor.close()
+
+
+def write_reading_batch(db: Session, batch: pa.RecordBatch):
+    """Write a batch of readings to records, consumption and injection, in the session's transaction"""
+    tables = [
+        (Record.__table__, batch.select(["id_record", "id_service", "record_timestamp"])),
+    ]
+    for name, table in (("consumption", Consumption.__table__), ("injection", Injection.__table__)):
+        values = batch.filter(pc.is_valid(batch.column(name))).select(["id_record", name])
+        tables.append((table, values.rename_columns(["id_record", "value"])))
+
+    for table, values in tables:
+        if not values.num_rows:
+            continue
+        if db.get_bind().dialect.driver == "psycopg2":
+            copy_batch(db, table.name, values)
+        else:
+            db.execute(table.insert(), values.to_pylist())
+
+
+def import_readings(
+        db: Session,
+        path: str,
+        file_format: str = "parquet",
+        chunk_size: int = READINGS_CHUNK_SIZE,
+        update_rollups: bool = True
+) -> int:
+    """
+    Load readings exported with export_readings, committing after every chunk.
+
+    The rollups of the imported months are rebuilt at the end unless update_rollups is
+    False, for callers that rebuild them themselves. If a chunk fails, the months of the
+    chunks already committed are still rebuilt before the error is raised. Returns the
+    number of rows.
+    """
+    rows = 0
+    months = set()
+
+    try:
+        for batch in read_reading_batches(path, file_format, chunk_size):
+            write_reading_batch(db, batch)
+            db.commit()
+            rows += batch.num_rows
+
+            if update_rollups:
+                timestamps = batch.column("record_timestamp")
+                keys = pc.unique(pc.add(pc.multiply(pc.year(timestamps), 100), pc.month(timestamps)))
+                months.update(divmod(key, 100) for key in keys.to_pylist() if key is not None)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        for year, month in sorted(months):
+            rebuild_rollups(db, year, month)
+
+    return rows
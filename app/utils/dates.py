@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+from typing import Iterator, Tuple
+import calendar
+
+
+def check_month(month: int):
+    """Raise a ValueError if month isn't between 1 and 12"""
+    if not 1 <= month <= 12:
+        raise ValueError(f"Invalid month {month}. Use a value between 1 and 12")
+
+
+def get_month_date_range(year: int, month: int) -> Tuple[datetime, datetime]:
+    """Get the start and end dates for a specific month"""
+    first_day = datetime(year, month, 1)
+    last_day = datetime(year, month, calendar.monthrange(year, month)[1], 23, 59, 59)
+    return first_day, last_day
+
+
+# Bucket sizes of time series
+RESOLUTIONS = ("hour", "day", "month")
+
+
+def truncate(timestamp: datetime, resolution: str) -> datetime:
+    """Get the start of the bucket a timestamp falls in"""
+    if resolution == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    if resolution == "day":
+        return datetime(timestamp.year, timestamp.month, timestamp.day)
+    return datetime(timestamp.year, timestamp.month, 1)
+
+
+def next_bucket(bucket: datetime, resolution: str) -> datetime:
+    """Get the start of the bucket following the one starting at bucket"""
+    if resolution == "hour":
+        return bucket + timedelta(hours=1)
+    if resolution == "day":
+        return bucket + timedelta(days=1)
+    return datetime(bucket.year + bucket.month // 12, bucket.month % 12 + 1, 1)
+
+
+def count_buckets(start: datetime, end: datetime, resolution: str) -> int:
+    """Number of buckets from the one holding start up to end, not included"""
+    first = truncate(start, resolution)
+    if end <= first:
+        return 0
+    if resolution == "month":
+        last = truncate(end - timedelta(microseconds=1), resolution)
+        return (last.year - first.year) * 12 + last.month - first.month + 1
+    size = timedelta(hours=1) if resolution == "hour" else timedelta(days=1)
+    return -(-(end - first) // size)
+
+
+def iter_buckets(start: datetime, end: datetime, resolution: str) -> Iterator[datetime]:
+    """Start of every bucket from the one holding start up to end, not included"""
+    bucket = truncate(start, resolution)
+    while bucket < end:
+        yield bucket
+        bucket = next_bucket(bucket, resolution)
@@ -0,0 +1,408 @@
+import asyncio
+import csv
+import io
+import json
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque, namedtuple
+from datetime import datetime, timezone
+from typing import AsyncIterator, Callable, List, Optional
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app.config import INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL, INGEST_MAX_PENDING_BATCHES
+from app.database import SessionLocal
+from app.models.models import Consumption, Injection, Record, Service
+from app.utils.profiling import profiled
+from app.utils.rollups import update_rollups
+
+# A meter reading; consumption or injection is None when the meter didn't report it
+Reading = namedtuple("Reading", ["id_record", "id_service", "record_timestamp", "consumption", "injection"])
+
+READING_FIELDS = ("id_service", "record_timestamp", "consumption", "injection")
+
+# Advisory lock serializing record ID allocation between workers on PostgreSQL when
+# records.id_record has no sequence to draw from
+RECORD_ID_LOCK = 4201
+
+# Other databases get one writer per process; SQLite only takes one at a time anyway
+write_lock = threading.Lock()
+
+
+def parse_timestamp(value) -> datetime:
+    if not isinstance(value, str):
+        raise ValueError(f"record_timestamp must be a string, got {value!r}")
+    timestamp = datetime.fromisoformat(value)
+    # Records are stored as naive UTC timestamps
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def parse_value(value) -> Optional[float]:
+    if value is None or value == "":
+        return None
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"Reading values must be finite numbers, got {value}")
+    return value
+
+
+def parse_reading(values: dict) -> Reading:
+    """Build a reading from a JSON object or CSV row"""
+    id_record = values.get("id_record")
+    return Reading(
+        int(id_record) if id_record not in (None, "") else None,
+        int(values["id_service"]),
+        parse_timestamp(values["record_timestamp"]),
+        parse_value(values.get("consumption")),
+        parse_value(values.get("injection"))
+    )
+
+
+class LineParser(ABC):
+    """Incremental parser turning body chunks into readings, one line per reading"""
+
+    def __init__(self):
+        self.pending = b""
+        self.line_number = 0
+
+    @abstractmethod
+    def parse_line(self, line: str) -> Optional[Reading]:
+        """Parse a non-empty line, returning None if it holds no reading"""
+
+    def parse_lines(self, lines: List[bytes]) -> List[Reading]:
+        readings = []
+        for line in lines:
+            self.line_number += 1
+            line = line.decode("utf-8").strip()
+            if not line:
+                continue
+            try:
+                reading = self.parse_line(line)
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"Invalid reading on line {self.line_number}: {e!r}")
+            if reading is not None:
+                readings.append(reading)
+        return readings
+
+    def feed(self, chunk: bytes) -> List[Reading]:
+        lines = (self.pending + chunk).split(b"\n")
+        # The last line may continue in the next chunk
+        self.pending = lines.pop()
+        return self.parse_lines(lines)
+
+    def close(self) -> List[Reading]:
+        lines = [self.pending] if self.pending else []
+        self.pending = b""
+        return self.parse_lines(lines)
+
+
+class NdjsonParser(LineParser):
+    """One JSON object per line"""
+
+    def parse_line(self, line: str) -> Reading:
+        values = json.loads(line)
+        if not isinstance(values, dict):
+            raise ValueError("Each line must be a JSON object")
+        return parse_reading(values)
+
+
+class CsvParser(LineParser):
+    """CSV with a header line naming the columns"""
+
+    def __init__(self):
+        super().__init__()
+        self.header = None
+
+    def parse_line(self, line: str) -> Optional[Reading]:
+        row = next(csv.reader([line]))
+        if self.header is None:
+            missing = set(READING_FIELDS[:2]) - set(row)
+            if missing:
+                raise ValueError(f"CSV header is missing {', '.join(sorted(missing))}")
+            self.header = row
+            return None
+        return parse_reading(dict(zip(self.header, row)))
+
+
+def get_reading_parser(content_type: Optional[str]) -> LineParser:
+    """Get the parser for a request body's content type; NDJSON when none is given"""
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    if media_type in ("", "application/x-ndjson", "application/ndjson", "application/jsonl", "application/json"):
+        return NdjsonParser()
+    if media_type in ("text/csv", "application/csv"):
+        return CsvParser()
+    raise ValueError(f"Unsupported content type {content_type}. Use application/x-ndjson or text/csv")
+
+
+@profiled
+def check_services(db: Session, readings: List[Reading]):
+    service_ids = {reading.id_service for reading in readings}
+    found = {
+        row.id_service for row in db.query(Service.id_service).filter(Service.id_service.in_(service_ids))
+    }
+    missing = service_ids - found
+    if missing:
+        raise ValueError(f"Service with ID {min(missing)} not found")
+
+
+def draw_record_ids(db: Session, sequence: str, count: int) -> List[int]:
+    result = db.execute(
+        text("SELECT nextval(CAST(:sequence AS regclass)) FROM generate_series(1, :count)"),
+        {"sequence": sequence, "count": count}
+    )
+    return sorted(row[0] for row in result)
+
+
+def reserve_record_ids(db: Session, count: int, floor: int) -> Optional[List[int]]:
+    """
+    Draw count IDs above floor from the records.id_record sequence on PostgreSQL, or
+    None if the column has no sequence.
+
+    nextval doesn't wait for other transactions, so concurrent batches don't queue up
+    behind each other; IDs drawn by a batch that rolls back are skipped. Readings stored
+    with explicit IDs (the initial load, imports) leave the sequence behind, in which
+    case it is moved up to the highest stored ID once and the IDs drawn again.
+    """
+    sequence = db.execute(text("SELECT pg_get_serial_sequence('records', 'id_record')")).scalar()
+    if sequence is None:
+        return None
+
+    floor = max(floor, db.query(func.max(Record.id_record)).scalar() or 0)
+    ids = draw_record_ids(db, sequence, count)
+    if ids[0] > floor:
+        return ids
+
+    # Only ever moves the sequence forward
+    db.execute(text(
+        "SELECT setval(CAST(:sequence AS regclass), :floor) "
+        "WHERE :floor > COALESCE(pg_sequence_last_value(CAST(:sequence AS regclass)), 0)"
+    ), {"sequence": sequence, "floor": floor})
+    ids = draw_record_ids(db, sequence, count)
+    if ids[0] <= floor:
+        raise ValueError("Could not reserve record IDs above the stored ones, try again")
+    return ids
+
+
+@profiled
+def allocate_record_ids(db: Session, readings: List[Reading]) -> List[Reading]:
+    """Give readings without an id_record the next free IDs"""
+    count = sum(1 for reading in readings if reading.id_record is None)
+    if not count:
+        return readings
+
+    floor = max([0] + [reading.id_record for reading in readings if reading.id_record is not None])
+
+    ids = None
+    if db.get_bind().dialect.name == "postgresql":
+        ids = reserve_record_ids(db, count, floor)
+        if ids is None:
+            # Held until the transaction ends, so two workers can't hand out the same IDs
+            db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": RECORD_ID_LOCK})
+
+    if ids is None:
+        # The highest stored ID can't change under us: SQLite takes one writer at a time,
+        # and on PostgreSQL the lock above is held
+        last_id = max(floor, db.query(func.max(Record.id_record)).scalar() or 0)
+        ids = range(last_id + 1, last_id + count + 1)
+
+    new_ids = iter(ids)
+    return [
+        reading._replace(id_record=next(new_ids)) if reading.id_record is None else reading
+        for reading in readings
+    ]
+
+
+@profiled
+def copy_readings(db: Session, readings: List[Reading]):
+    """Write readings with COPY, in the session's transaction"""
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert("COPY records (id_record, id_service, record_timestamp) FROM STDIN", io.StringIO("".join(
+            f"{reading.id_record}\t{reading.id_service}\t{reading.record_timestamp.isoformat(' ')}\n"
+            for reading in readings
+        )))
+        cursor.copy_expert("COPY consumption (id_record, value) FROM STDIN", io.StringIO("".join(
+            f"{reading.id_record}\t{reading.consumption!r}\n"
+            for reading in readings if reading.consumption is not None
+        )))
+        cursor.copy_expert("COPY injection (id_record, value) FROM STDIN", io.StringIO("".join(
+            f"{reading.id_record}\t{reading.injection!r}\n"
+            for reading in readings if reading.injection is not None
+        )))
+    finally:
+        cursor.close()
+
+
+@profiled
+def insert_readings(db: Session, readings: List[Reading]):
+    """Write readings with one executemany per table"""
+    db.execute(Record.__table__.insert(), [
+        {"id_record": reading.id_record, "id_service": reading.id_service, "record_timestamp": reading.record_timestamp}
+        for reading in readings
+    ])
+    consumption = [
+        {"id_record": reading.id_record, "value": reading.consumption}
+        for reading in readings if reading.consumption is not None
+    ]
+    if consumption:
+        db.execute(Consumption.__table__.insert(), consumption)
+    injection = [
+        {"id_record": reading.id_record, "value": reading.injection}
+        for reading in readings if reading.injection is not None
+    ]
+    if injection:
+        db.execute(Injection.__table__.insert(), injection)
+
+
+@profiled
+def write_readings(db: Session, readings: List[Reading]) -> int:
+    """
+    Store readings and add them to the rollups in a single transaction.
+
+    Returns the number of readings stored.
+    """
+    if not readings:
+        return 0
+
+    try:
+        check_services(db, readings)
+        readings = allocate_record_ids(db, readings)
+
+        if db.get_bind().dialect.driver == "psycopg2":
+            copy_readings(db, readings)
+        else:
+            insert_readings(db, readings)
+
+        update_rollups(db, (
+            (reading.id_service, reading.record_timestamp, reading.consumption, reading.injection)
+            for reading in readings
+        ))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return len(readings)
+
+
+def write_batch(readings: List[Reading]) -> int:
+    db = SessionLocal()
+    try:
+        if db.get_bind().dialect.name == "postgresql":
+            return write_readings(db, readings)
+        with write_lock:
+            return write_readings(db, readings)
+    finally:
+        db.close()
+
+
+class ReadingBuffer:
+    """
+    Collects parsed readings and writes them in batches from a worker thread.
+
+    A batch is written when batch_size readings are buffered, or flush_interval seconds
+    after the oldest buffered reading arrived. At most max_pending batches are written at
+    a time: starting another one waits for the oldest, which stops the request body from
+    being read faster than the database takes it.
+    """
+
+    def __init__(self, write: Callable[[List[Reading]], int] = write_batch,
+                 batch_size: int = INGEST_BATCH_SIZE, flush_interval: float = INGEST_FLUSH_INTERVAL,
+                 max_pending: int = INGEST_MAX_PENDING_BATCHES):
+        self.write = write
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max(1, max_pending)
+        self.readings = []
+        self.buffered_since = None
+        self.writing = deque()
+        self.stored = 0
+        self.batches = 0
+
+    def flush_due_in(self) -> Optional[float]:
+        """Seconds until the buffered readings must be written, None when there are none"""
+        if not self.readings:
+            return None
+        return max(0.0, self.buffered_since + self.flush_interval - time.monotonic())
+
+    async def add(self, readings: List[Reading]):
+        if not readings:
+            return
+        if not self.readings:
+            self.buffered_since = time.monotonic()
+        self.readings.extend(readings)
+
+        while len(self.readings) >= self.batch_size:
+            batch = self.readings[:self.batch_size]
+            del self.readings[:self.batch_size]
+            self.buffered_since = time.monotonic()
+            await self.start_write(batch)
+
+    async def flush(self):
+        if self.readings:
+            batch, self.readings = self.readings, []
+            await self.start_write(batch)
+
+    async def start_write(self, batch: List[Reading]):
+        while len(self.writing) >= self.max_pending:
+            await self.wait_oldest()
+        self.writing.append(asyncio.ensure_future(run_in_threadpool(self.write, batch)))
+
+    async def wait_oldest(self):
+        self.stored += await self.writing.popleft()
+        self.batches += 1
+
+    async def wait(self):
+        """Wait for every batch being written; the first failure is raised once all have finished"""
+        error = None
+        while self.writing:
+            try:
+                await self.wait_oldest()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    async def close(self):
+        await self.flush()
+        await self.wait()
+
+
+async def ingest_readings(chunks: AsyncIterator[bytes], parser: LineParser, buffer: ReadingBuffer):
+    """Parse a body stream into the buffer, writing the buffered readings when they are due"""
+    chunks = chunks.__aiter__()
+    next_chunk = None
+    try:
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(chunks.__anext__())
+            # Keep waiting on the same read when the flush timer fires first
+            done, _ = await asyncio.wait({next_chunk}, timeout=buffer.flush_due_in())
+            if not done:
+                await buffer.flush()
+                continue
+
+            chunk_read, next_chunk = next_chunk, None
+            try:
+                chunk = chunk_read.result()
+            except StopAsyncIteration:
+                break
+            await buffer.add(parser.feed(chunk))
+
+        await buffer.add(parser.close())
+        await buffer.close()
+    except BaseException:
+        if next_chunk is not None:
+            next_chunk.cancel()
+        # Let the batches in flight finish so buffer.stored is accurate
+        try:
+            await buffer.wait()
+        except Exception:
+            pass
+        raise
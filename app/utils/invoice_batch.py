@@ -0,0 +1,206 @@
+from sqlalchemy.orm import Session
+from sqlalchemy import select
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Union
+import multiprocessing
+import threading
+import numpy as np
+import orjson
+
+from app.config import INVOICE_WORKERS, INVOICE_PARTITION_SIZE
+
+from app.models.models import Service, ServiceMonthlyRollup
+from app.utils.billing import HOURS_PER_DAY, InvoiceInputs, compute_invoice
+from app.utils.dates import check_month
+from app.utils.prices import get_hourly_rates
+from app.utils.rollups import get_hourly_profiles
+from app.utils.tariffs import tariff_resolver
+
+# Number of services whose hourly injection profiles are fetched per query
+HOURLY_CHUNK_SIZE = 1000
+
+
+def get_service_filter(
+        client_ids: Optional[List[int]] = None,
+        id_market: Optional[int] = None,
+        voltage_level: Optional[int] = None
+) -> List:
+    """Build the filter clauses that select the services of a batch"""
+    clauses = []
+    if client_ids is not None:
+        clauses.append(Service.id_service.in_(client_ids))
+    if id_market is not None:
+        clauses.append(Service.id_market == id_market)
+    if voltage_level is not None:
+        clauses.append(Service.voltage_level == voltage_level)
+    return clauses
+
+
+def get_services_with_tariffs(db: Session, service_filter: List, limit: Optional[int] = None) -> List:
+    """Get the selected services together with their tariffs, the first limit of them if given"""
+    services = db.query(Service).filter(
+        *service_filter
+    ).order_by(
+        Service.id_service
+    ).limit(limit).all()
+
+    return [(service, tariff_resolver.resolve(db, service)) for service in services]
+
+
+def get_monthly_totals(db: Session, service_filter: List, year: int, month: int) -> Dict[int, tuple]:
+    """Get the month's total consumption and injection of every selected service from the rollups"""
+    totals = db.query(
+        ServiceMonthlyRollup.id_service,
+        ServiceMonthlyRollup.consumption,
+        ServiceMonthlyRollup.injection
+    ).filter(
+        ServiceMonthlyRollup.id_service.in_(select(Service.id_service).where(*service_filter)),
+        ServiceMonthlyRollup.year == year,
+        ServiceMonthlyRollup.month == month
+    ).all()
+
+    return {
+        id_service: (consumption or 0.0, injection or 0.0)
+        for id_service, consumption, injection in totals
+    }
+
+
+def get_hourly_injections(db: Session, client_ids: List[int], year: int, month: int) -> Dict[int, np.ndarray]:
+    """Get the month's injection by hour of the day for the given services from their hourly profiles"""
+    hourly_injections = {}
+    for start in range(0, len(client_ids), HOURLY_CHUNK_SIZE):
+        hourly_injections.update(get_hourly_profiles(db, client_ids[start:start + HOURLY_CHUNK_SIZE], year, month))
+    return hourly_injections
+
+
+def build_partition_invoices(items: List[Union[InvoiceInputs, Dict]]) -> List[Dict]:
+    """
+    Build the invoices of a partition of services from their loaded inputs.
+
+    Pure computation on plain values, so it can run in a worker process; items that
+    are already errors are passed through.
+    """
+    return [item if isinstance(item, dict) else compute_invoice(item) for item in items]
+
+
+_pools: Dict[int, ProcessPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+
+def get_invoice_pool(workers: int) -> ProcessPoolExecutor:
+    """Get the process pool with the given number of workers, started on first use and kept for later runs"""
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            # Spawned rather than forked, the API process has threads and open connections
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pools[workers] = pool
+        return pool
+
+
+def shutdown_invoice_pools():
+    """Stop the worker processes of every pool started so far"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown(cancel_futures=True)
+
+
+def calculate_invoices(
+        db: Session,
+        year: int,
+        month: int,
+        client_ids: Optional[List[int]] = None,
+        id_market: Optional[int] = None,
+        voltage_level: Optional[int] = None,
+        workers: int = INVOICE_WORKERS,
+        partition_size: int = INVOICE_PARTITION_SIZE
+) -> Iterator[Dict]:
+    """
+    Calculate the invoices of many services for a month.
+
+    Every selected service is priced with a fixed number of set-based queries per
+    partition of partition_size services, no matter how many services there are.
+    With workers, the invoices of each partition are built in a pool of that many
+    processes while the next partitions are loaded; the output is the same either way.
+
+    Invoices are yielded in id_service order; services that cannot be invoiced yield a
+    dict with the client_id and an error message instead.
+    """
+    check_month(month)
+
+    service_filter = get_service_filter(client_ids, id_market, voltage_level)
+
+    if client_ids is not None:
+        found = {id_service for id_service, in db.query(Service.id_service).filter(*service_filter)}
+        for client_id in sorted(set(client_ids) - found):
+            yield {"client_id": client_id, "error": f"Client with ID {client_id} not found"}
+
+    # Loaded with the first partition that has services with excess injection (EE2)
+    hourly_rates = None
+
+    def load_partitions() -> Iterator[List[Union[InvoiceInputs, Dict]]]:
+        nonlocal hourly_rates
+        last_id = None
+        while True:
+            # Services and totals are queried a partition at a time, by id_service range
+            partition_filter = service_filter if last_id is None else service_filter + [Service.id_service > last_id]
+            partition = get_services_with_tariffs(db, partition_filter, limit=partition_size)
+            if not partition:
+                return
+            first_id, last_id = partition[0][0].id_service, partition[-1][0].id_service
+            totals = get_monthly_totals(db, service_filter + [Service.id_service.between(first_id, last_id)], year, month)
+
+            # Hourly data is only needed by the services with excess injection (EE2)
+            partition_excess = [
+                id_service for id_service, (consumption, injection) in sorted(totals.items())
+                if injection > consumption
+            ]
+            hourly_injections = get_hourly_injections(db, partition_excess, year, month) if partition_excess else {}
+            if partition_excess and hourly_rates is None:
+                hourly_rates = get_hourly_rates(db, year, month)
+
+            items = []
+            for service, tariff in partition:
+                if not tariff:
+                    items.append({
+                        "client_id": service.id_service,
+                        "error": "Tariff not found for the given service parameters"
+                    })
+                    continue
+
+                total_consumption, total_injection = totals.get(service.id_service, (0.0, 0.0))
+                items.append(InvoiceInputs(
+                    client_id=service.id_service,
+                    year=year,
+                    month=month,
+                    tariff=tariff,
+                    total_consumption=total_consumption,
+                    total_injection=total_injection,
+                    hourly_injections=hourly_injections.get(service.id_service, np.zeros(HOURS_PER_DAY)),
+                    hourly_rates=hourly_rates
+                ))
+            yield items
+
+    if not workers:
+        for items in load_partitions():
+            yield from build_partition_invoices(items)
+        return
+
+    # Keep a couple of partitions per worker in flight, and yield them in order
+    pool = get_invoice_pool(workers)
+    pending = deque()
+    for items in load_partitions():
+        pending.append(pool.submit(build_partition_invoices, items))
+        if len(pending) >= workers * 2:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+
+def iter_invoices_ndjson(invoices: Iterator[Dict]) -> Iterator[str]:
+    """Serialize invoices as newline delimited JSON"""
+    for invoice in invoices:
+        yield orjson.dumps(invoice, option=orjson.OPT_SERIALIZE_NUMPY).decode() + "\n"
@@ -0,0 +1,403 @@
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+import copy
+import importlib
+import json
+import sqlite3
+import threading
+import time
+
+from app.config import INVOICE_CACHE_BACKEND, INVOICE_CACHE_SIZE, INVOICE_CACHE_TTL, INVOICE_CACHE_PATH
+from app.models.models import InvoiceCacheInvalidation, Service, Tariff
+from app.utils.tariffs import get_tariff_key, tariff_resolver
+
+# Tag invalidating every cached invoice
+ALL_INVOICES = "*"
+
+# Prefix of the tags of tariff keys
+TARIFF_TAG_PREFIX = "tariff:"
+
+# Expired rows of the invalidation log are purged every this many writes per process
+INVALIDATION_PURGE_EVERY = 1000
+
+
+def is_closed_month(year: int, month: int, now: Optional[datetime] = None) -> bool:
+    """
+    Whether the month is over, so its invoice only changes if its inputs are edited.
+    Months outside 1..12 are never closed.
+    """
+    if not 1 <= month <= 12:
+        return False
+    now = now or datetime.utcnow()
+    return (year, month) < (now.year, now.month)
+
+
+def readings_tag(client_id: int, year: int, month: int) -> str:
+    return f"readings:{client_id}:{year}:{month}"
+
+
+def month_tag(year: int, month: int) -> str:
+    return f"month:{year}:{month}"
+
+
+def service_tag(client_id: int) -> str:
+    return f"service:{client_id}"
+
+
+def tariff_tag(id_market: int, voltage_level: int, cdi: Optional[int]) -> str:
+    return TARIFF_TAG_PREFIX + "{}:{}:{}".format(*get_tariff_key(id_market, voltage_level, cdi))
+
+
+def get_invoice_tags(service: Service, year: int, month: int) -> List[str]:
+    """Tags of everything an invoice depends on, to invalidate it when any of them changes"""
+    return [
+        readings_tag(service.id_service, year, month),
+        month_tag(year, month),
+        service_tag(service.id_service),
+        tariff_tag(service.id_market, service.voltage_level, service.cir),
+    ]
+
+
+class LRUBackend:
+    """Invoices kept in this process, least recently used first out"""
+
+    name = "memory"
+    shared = False
+
+    def __init__(self, max_entries: int = INVOICE_CACHE_SIZE, ttl: float = INVOICE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._keys_by_tag: Dict[str, set] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            for tag in entry[2]:
+                keys = self._keys_by_tag[tag]
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+    def get(self, key: Tuple) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return copy.deepcopy(entry[1])
+
+    def set(self, key: Tuple, value: Dict, tags: List[str]):
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(value), tags)
+            for tag in tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def delete_tags(self, tags: Iterable[str]) -> int:
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys.update(self._keys_by_tag.get(tag, ()))
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_tag.clear()
+
+
+class SqliteBackend:
+    """
+    Invoices shared by every worker of a host through a SQLite file.
+
+    Also the reference for other shared backends (Redis and the like): a backend only
+    needs get, set, delete_tags, clear and __len__, and shared set when every worker
+    sees the same entries.
+    """
+
+    name = "sqlite"
+    shared = True
+
+    # Expired entries are purged every this many writes
+    PURGE_EVERY = 1000
+
+    def __init__(self, path: str = INVOICE_CACHE_PATH, ttl: float = INVOICE_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS invoices (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS invoice_tags (tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_invoice_tags_key ON invoice_tags (key)")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _key(key: Tuple) -> str:
+        return ":".join(str(part) for part in key)
+
+    def __len__(self):
+        return self._connect().execute(
+            "SELECT count(*) FROM invoices WHERE expires_at >= ?", (time.time(),)
+        ).fetchone()[0]
+
+    def get(self, key: Tuple) -> Optional[Dict]:
+        row = self._connect().execute(
+            "SELECT value FROM invoices WHERE key = ? AND expires_at >= ?", (self._key(key), time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: Tuple, value: Dict, tags: List[str]):
+        conn = self._connect()
+        key = self._key(key)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM invoice_tags WHERE key = ?", (key,))
+            conn.execute(
+                "INSERT OR REPLACE INTO invoices (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + self.ttl)
+            )
+            conn.executemany("INSERT OR IGNORE INTO invoice_tags (tag, key) VALUES (?, ?)", [(tag, key) for tag in tags])
+
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY == 0:
+                conn.execute("DELETE FROM invoices WHERE expires_at < ?", (time.time(),))
+                conn.execute("DELETE FROM invoice_tags WHERE key NOT IN (SELECT key FROM invoices)")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete_tags(self, tags: Iterable[str]) -> int:
+        tags = list(tags)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            keys = set()
+            # Stay under SQLite's limit of query parameters
+            for start in range(0, len(tags), 500):
+                chunk = tags[start:start + 500]
+                placeholders = ", ".join("?" for _ in chunk)
+                keys.update(row[0] for row in conn.execute(
+                    f"SELECT key FROM invoice_tags WHERE tag IN ({placeholders})", chunk
+                ))
+            conn.executemany("DELETE FROM invoices WHERE key = ?", [(key,) for key in keys])
+            conn.executemany("DELETE FROM invoice_tags WHERE key = ?", [(key,) for key in keys])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return len(keys)
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM invoices")
+        conn.execute("DELETE FROM invoice_tags")
+        conn.execute("COMMIT")
+
+
+def load_backend(spec: str):
+    """Create the backend named by INVOICE_CACHE_BACKEND, None when caching is off"""
+    if spec in ("", "none"):
+        return None
+    if spec == "memory":
+        return LRUBackend()
+    if spec == "sqlite":
+        return SqliteBackend()
+    module_name, _, factory = spec.partition(":")
+    return getattr(importlib.import_module(module_name), factory)()
+
+
+class InvoiceCache:
+    """
+    Invoices of closed months, keyed by (client_id, year, month).
+
+    Entries carry tags for the readings, service, tariff and month they were computed
+    from, and are dropped when any of them changes. The process that commits a change
+    drops them right away; other workers apply it from the invalidation log before
+    their next lookup, so a per-process backend stays correct with several workers.
+    Hit, miss and invalidation (invoices dropped) counters are per process.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.listeners: List[Callable[[Set[str]], None]] = []
+        self._generation = 0
+        self._synced_id: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def caches(self, year: int, month: int) -> bool:
+        """Whether invoices of the month are served from the cache"""
+        return self.backend is not None and is_closed_month(year, month)
+
+    def get_or_compute(self, db: Session, key: Tuple, compute: Callable[[], Tuple[Dict, List[str]]]) -> Dict:
+        """Get a cached invoice, or compute it with compute(), which returns the invoice and its tags"""
+        self.sync(db)
+        invoice = self.backend.get(key)
+        if invoice is not None:
+            with self._lock:
+                self.hits += 1
+            return invoice
+
+        with self._lock:
+            self.misses += 1
+            generation = self._generation
+
+        invoice, tags = compute()
+
+        # Don't store what was computed while an invalidation happened, it may be stale
+        self.sync(db)
+        if generation == self._generation:
+            self.backend.set(key, invoice, tags)
+        return invoice
+
+    def sync(self, db: Session):
+        """Apply the invalidations committed by other workers since the last sync"""
+        table = InvoiceCacheInvalidation
+        if self._synced_id is None:
+            # Nothing was cached or loaded before this process started
+            self._synced_id = db.query(func.max(table.id)).scalar() or 0
+            return
+
+        rows = db.query(table.id, table.tags).filter(table.id > self._synced_id).order_by(table.id).all()
+        if not rows:
+            return
+
+        tags = set()
+        for _, row_tags in rows:
+            tags.update(row_tags.split("\n"))
+        with self._lock:
+            self._synced_id = max(self._synced_id, rows[-1][0])
+        # Shared backends were already cleaned up by the worker that committed
+        self.invalidate(tags, drop=not getattr(self.backend, "shared", False))
+
+    def invalidate(self, tags: Iterable[str], drop: bool = True):
+        """
+        Drop the invoices depending on any of the tags, and the tariffs loaded in this
+        process if a tariff changed. With drop False only the local state is reset.
+        """
+        tags = set(tags)
+        if not tags:
+            return
+
+        if any(tag.startswith(TARIFF_TAG_PREFIX) for tag in tags):
+            tariff_resolver.invalidate()
+        for listener in self.listeners:
+            listener(tags)
+
+        if self.backend is None:
+            return
+        with self._lock:
+            self._generation += 1
+        if not drop:
+            return
+        if ALL_INVOICES in tags:
+            dropped = len(self.backend)
+            self.backend.clear()
+        else:
+            dropped = self.backend.delete_tags(tags)
+        with self._lock:
+            self.invalidations += dropped
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.backend.name if self.backend is not None else "none",
+            "entries": len(self.backend) if self.backend is not None else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations
+        }
+
+
+invoice_cache = InvoiceCache(load_backend(INVOICE_CACHE_BACKEND))
+
+
+_invalidation_writes = 0
+
+
+def mark_stale(db: Session, tags: Iterable[str]):
+    """
+    Invalidate the tags once the session's transaction commits: in this process right
+    after the commit, and in the other workers through the invalidation log, written in
+    the same transaction.
+    """
+    global _invalidation_writes
+
+    tags = set(tags)
+    if not tags:
+        return
+    db.info.setdefault("invoice_cache_stale", set()).update(tags)
+
+    # Through the connection, so it also works from flush events
+    connection = db.connection()
+    table = InvoiceCacheInvalidation.__table__
+    connection.execute(table.insert(), {"created_at": datetime.utcnow(), "tags": "\n".join(sorted(tags))})
+
+    # Rows older than the cache TTL only concern invoices that have expired anyway
+    _invalidation_writes += 1
+    if _invalidation_writes % INVALIDATION_PURGE_EVERY == 0:
+        connection.execute(table.delete().where(
+            table.c.created_at < datetime.utcnow() - timedelta(seconds=INVOICE_CACHE_TTL)
+        ))
+
+
+@event.listens_for(Session, "after_flush")
+def track_invoice_inputs(session, flush_context):
+    """Remember the services and tariffs inserted, updated or deleted through the ORM"""
+    tags = set()
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, Service):
+            tags.add(service_tag(instance.id_service))
+        elif isinstance(instance, Tariff):
+            tags.add(tariff_tag(instance.id_market, instance.voltage_level, instance.cdi))
+            # An edited key also affects the services of the key it had before
+            state = inspect(instance)
+            old = [state.attrs[name].history.deleted for name in ("id_market", "voltage_level", "cdi")]
+            if any(old):
+                current = (instance.id_market, instance.voltage_level, instance.cdi)
+                tags.add(tariff_tag(*(values[0] if values else value for values, value in zip(old, current))))
+    if tags:
+        mark_stale(session, tags)
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_invoices_on_commit(session):
+    tags = session.info.pop("invoice_cache_stale", None)
+    if tags:
+        invoice_cache.invalidate(tags)
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_invoice_inputs(session):
+    session.info.pop("invoice_cache_stale", None)
@@ -0,0 +1,218 @@
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+import hashlib
+import json
+import os
+import threading
+import time
+import numpy as np
+
+from app.config import XM_PRICE_STORE_PATH, XM_PRICE_REFRESH_INTERVAL
+from app.database import SessionLocal
+from app.models.models import XmDataHourlyPerAgent
+from app.utils.billing import HOURS_PER_DAY
+from app.utils.invoice_cache import mark_stale, month_tag
+from app.utils.profiling import profiled
+
+try:
+    import fcntl
+except ImportError:  # Windows: refreshes are only serialized inside each process
+    fcntl = None
+
+# Hour 0 of the price array
+PRICE_EPOCH = datetime(2000, 1, 1)
+
+
+def hours_since_epoch(timestamp: datetime) -> int:
+    """Get the index of the hour a timestamp falls in"""
+    return int((timestamp - PRICE_EPOCH).total_seconds() // 3600)
+
+
+def invalidate_months(months: Iterable[Tuple[int, int]]):
+    """
+    Invalidate the cached invoices of the months in every worker. Written through a
+    session of its own, since prices can be refreshed from a read-only session.
+    """
+    db = SessionLocal()
+    try:
+        mark_stale(db, [month_tag(year, month) for year, month in months])
+        db.commit()
+    finally:
+        db.close()
+
+
+class HourlyPriceStore:
+    """
+    Dense float64 array of XM prices indexed by hours since PRICE_EPOCH.
+
+    The array lives in a memory-mapped file shared by every worker, with NaN for hours
+    without a price. A sidecar JSON file records the last xm_data_hourly_per_agent id
+    copied into it, so refreshes only fetch the rows inserted since. When an hour has
+    several prices, the first one stored wins. Prices edited in place are not picked up
+    incrementally; call rebuild() after such changes.
+    """
+
+    def __init__(self, path: str = XM_PRICE_STORE_PATH, refresh_interval: float = XM_PRICE_REFRESH_INTERVAL):
+        self.path = path
+        self.meta_path = path + ".json"
+        self.lock_path = path + ".lock"
+        self.refresh_interval = refresh_interval
+        self._prices: Optional[np.memmap] = None
+        self._mapped_id = None
+        self._checked_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _read_meta(self) -> Dict:
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_meta(self, meta: Dict):
+        temp_path = self.meta_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(temp_path, self.meta_path)
+
+    def _file_size(self) -> int:
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def _file_id(self):
+        """Identify the current file, which changes when it grows or is rebuilt"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size
+
+    def _grow(self, size: int):
+        """Extend the file with NaN up to size hours"""
+        current = self._file_size() // 8
+        if size > current:
+            with open(self.path, "ab") as f:
+                f.write(np.full(size - current, np.nan).tobytes())
+
+    def _source(self, db: Session) -> str:
+        """Identify the database the prices come from, so another one triggers a rebuild"""
+        url = db.get_bind().url
+        url = url.set(drivername=url.get_backend_name()).render_as_string(hide_password=True)
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    def refresh(self, db: Session, rebuild: bool = False) -> int:
+        """Copy the rows inserted since the last refresh into the file, returning how many were read"""
+        with self._lock, open(self.lock_path, "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            meta = self._read_meta()
+            source = self._source(db)
+            rebuilding = rebuild or meta.get("source") != source or meta.get("epoch") != PRICE_EPOCH.isoformat()
+            if rebuilding:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                meta = {"source": source, "epoch": PRICE_EPOCH.isoformat(), "last_id": 0}
+
+            rows = db.query(
+                XmDataHourlyPerAgent.id,
+                XmDataHourlyPerAgent.record_timestamp,
+                XmDataHourlyPerAgent.value
+            ).filter(
+                XmDataHourlyPerAgent.id > meta["last_id"],
+                XmDataHourlyPerAgent.record_timestamp >= PRICE_EPOCH
+            ).order_by(
+                XmDataHourlyPerAgent.id
+            ).all()
+
+            if rows:
+                indexes = np.array([hours_since_epoch(timestamp) for _, timestamp, _ in rows])
+                values = np.array([value for _, _, value in rows], dtype=np.float64)
+
+                # Keep the first price read for each hour, and only fill hours still empty
+                indexes, first = np.unique(indexes, return_index=True)
+                values = values[first]
+
+                self._grow(int(indexes[-1]) + 1)
+                prices = np.memmap(self.path, dtype=np.float64, mode="r+")
+                empty = np.isnan(prices[indexes])
+                prices[indexes[empty]] = values[empty]
+                prices.flush()
+                del prices
+
+                # Late prices change the EE2 of months that may already be invoiced
+                if not rebuilding:
+                    months = {
+                        (hour.year, hour.month)
+                        for hour in (PRICE_EPOCH + timedelta(hours=int(index)) for index in indexes[empty])
+                    }
+                    invalidate_months(months)
+
+                meta["last_id"] = max(id_ for id_, _, _ in rows)
+
+            self._write_meta(meta)
+            self._checked_at = time.monotonic()
+            self._prices = None
+
+            return len(rows)
+
+    def rebuild(self, db: Session) -> int:
+        """Recreate the file from every row of xm_data_hourly_per_agent"""
+        return self.refresh(db, rebuild=True)
+
+    def _view(self) -> np.ndarray:
+        """Map the file read-only, remapping it if another worker grew or rebuilt it"""
+        file_id = self._file_id()
+        if self._prices is None or file_id != self._mapped_id:
+            if file_id and file_id[1]:
+                self._prices = np.memmap(self.path, dtype=np.float64, mode="r")
+            else:
+                self._prices = np.empty(0)
+            self._mapped_id = file_id
+        return self._prices
+
+    def get_prices(self, db: Session, start: datetime, hours: int) -> np.ndarray:
+        """Get the prices of the given number of hours from start, NaN where there is none"""
+        if self._checked_at is None or time.monotonic() - self._checked_at > self.refresh_interval:
+            self.refresh(db)
+
+        prices = self._view()
+        first = hours_since_epoch(start)
+        result = np.full(hours, np.nan)
+
+        # Only the part of the range inside the array has prices
+        low, high = max(first, 0), min(first + hours, len(prices))
+        if low < high:
+            result[low - first:high - first] = prices[low:high]
+
+        return result
+
+
+price_store = HourlyPriceStore()
+
+
+@profiled
+def get_hourly_rates(db: Session, year: int, month: int) -> np.ndarray:
+    """
+    Get the XM rate of each hour of the first day of the month from the hourly price store.
+
+    Hours without a rate get 0. When an hour has several rates, the first one stored wins.
+    """
+    rates = price_store.get_prices(db, datetime(year, month, 1), HOURS_PER_DAY)
+    return np.nan_to_num(rates)
+
+
+@profiled
+def get_monthly_hourly_rates(db: Session, months: List[Tuple[int, int]]) -> Dict[Tuple[int, int], np.ndarray]:
+    """
+    Get the hourly rates of several (year, month) pairs, as get_hourly_rates does for one,
+    from a single read of the price store spanning all of them.
+    """
+    if not months:
+        return {}
+    starts = {month: hours_since_epoch(datetime(*month, 1)) for month in months}
+    first = min(starts.values())
+    rates = np.nan_to_num(price_store.get_prices(
+        db, PRICE_EPOCH + timedelta(hours=first), max(starts.values()) - first + HOURS_PER_DAY
+    ))
+    return {month: rates[start - first:start - first + HOURS_PER_DAY] for month, start in starts.items()}
@@ -0,0 +1,260 @@
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from collections import Counter
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Tuple
+import logging
+import threading
+import time
+
+from app.config import PROFILING_ENABLED, PROFILING_N_PLUS_ONE_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the request duration histogram
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Profile:
+    """Queries and time spent on them by one request, or one profiled call outside a request"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.statements = Counter()
+        # Function name -> [calls, seconds, db seconds, queries], inclusive of nested calls
+        self.functions: Dict[str, List] = {}
+        self._lock = threading.Lock()
+
+    def add_query(self, statement: str, elapsed: float):
+        with self._lock:
+            self.queries += 1
+            self.db_time += elapsed
+            self.statements[statement] += 1
+
+    def add_function(self, name: str, elapsed: float, db_time: float, queries: int):
+        with self._lock:
+            totals = self.functions.setdefault(name, [0, 0.0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += elapsed
+            totals[2] += db_time
+            totals[3] += queries
+
+    def repeated_statements(self, threshold: int = PROFILING_N_PLUS_ONE_THRESHOLD) -> List[Tuple[str, int]]:
+        """Statements run at least threshold times, the usual sign of an N+1 query pattern"""
+        return [(statement, count) for statement, count in self.statements.items() if count >= threshold]
+
+
+current_profile: ContextVar[Optional[Profile]] = ContextVar("current_profile", default=None)
+
+
+class Metrics:
+    """Totals of every profiled request and function in this process, rendered for Prometheus"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: Dict[Tuple, List] = {}
+        self.durations: Dict[str, List[int]] = {}
+        self.functions: Dict[str, List] = {}
+        self.n_plus_one: Counter = Counter()
+
+    def record_functions(self, functions: Dict[str, List]):
+        with self._lock:
+            for name, values in functions.items():
+                totals = self.functions.setdefault(name, [0, 0.0, 0.0, 0])
+                for index, value in enumerate(values):
+                    totals[index] += value
+
+    def record_request(self, endpoint: str, status: int, elapsed: float, profile: Profile):
+        with self._lock:
+            totals = self.requests.setdefault((endpoint, status), [0, 0.0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += elapsed
+            totals[2] += profile.db_time
+            totals[3] += profile.queries
+
+            # Cumulative counts, as Prometheus histograms expect
+            buckets = self.durations.setdefault(endpoint, [0] * len(DURATION_BUCKETS))
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if elapsed <= bound:
+                    buckets[index] += 1
+        self.record_functions(profile.functions)
+
+    def record_n_plus_one(self, endpoint: str):
+        with self._lock:
+            self.n_plus_one[endpoint] += 1
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        with self._lock:
+            requests = sorted((key, list(totals)) for key, totals in self.requests.items())
+            durations = sorted((key, list(buckets)) for key, buckets in self.durations.items())
+            functions = sorted((key, list(totals)) for key, totals in self.functions.items())
+            n_plus_one = sorted(self.n_plus_one.items())
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                label_text = ",".join(f'{key}="{escape(label)}"' for key, label in labels)
+                lines.append(f"{sample_name}{{{label_text}}} {value}")
+
+        def request_samples(name, index):
+            return [(name, (("endpoint", endpoint), ("status", status)), totals[index])
+                    for (endpoint, status), totals in requests]
+
+        def function_samples(name, index):
+            return [(name, (("function", function),), totals[index]) for function, totals in functions]
+
+        histogram = []
+        for endpoint, buckets in durations:
+            count = sum(totals[0] for (name, _), totals in requests if name == endpoint)
+            seconds = sum(totals[1] for (name, _), totals in requests if name == endpoint)
+            labels = (("endpoint", endpoint),)
+            for bound, bucket in zip(DURATION_BUCKETS, buckets):
+                histogram.append(("http_request_duration_seconds_bucket", labels + (("le", bound),), bucket))
+            histogram.append(("http_request_duration_seconds_bucket", labels + (("le", "+Inf"),), count))
+            histogram.append(("http_request_duration_seconds_sum", labels, seconds))
+            histogram.append(("http_request_duration_seconds_count", labels, count))
+
+        metric("http_requests_total", "counter", "Requests handled.", request_samples("http_requests_total", 0))
+        metric("http_request_duration_seconds", "histogram", "Time spent handling requests.", histogram)
+        metric("http_request_db_seconds_total", "counter", "Time requests spent on database queries.",
+               request_samples("http_request_db_seconds_total", 2))
+        metric("http_request_queries_total", "counter", "Database queries sent by requests.",
+               request_samples("http_request_queries_total", 3))
+        metric("billing_function_calls_total", "counter", "Calls of profiled functions.",
+               function_samples("billing_function_calls_total", 0))
+        metric("billing_function_seconds_total", "counter", "Time spent in profiled functions, nested calls included.",
+               function_samples("billing_function_seconds_total", 1))
+        metric("billing_function_db_seconds_total", "counter", "Time profiled functions spent on database queries.",
+               function_samples("billing_function_db_seconds_total", 2))
+        metric("billing_function_queries_total", "counter", "Database queries sent by profiled functions.",
+               function_samples("billing_function_queries_total", 3))
+        metric("n_plus_one_warnings_total", "counter", "Requests that repeated a statement like an N+1 query pattern.",
+               [("n_plus_one_warnings_total", (("endpoint", endpoint),), count) for endpoint, count in n_plus_one])
+        return "\n".join(lines) + "\n"
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if current_profile.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile.get()
+    starts = conn.info.get("query_start")
+    if profile is not None and starts:
+        profile.add_query(statement, time.perf_counter() - starts.pop())
+
+
+def profiled(func: Callable) -> Callable:
+    """
+    Record the calls, time, database time and queries of a function.
+
+    Inside a request the numbers go to the request's profile, and from there to the
+    Server-Timing header and /metrics. Outside a request they go straight to /metrics.
+    """
+    if not PROFILING_ENABLED:
+        return func
+
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = current_profile.get()
+        token = None
+        if profile is None:
+            profile = Profile()
+            token = current_profile.set(profile)
+
+        queries, db_time = profile.queries, profile.db_time
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.add_function(
+                name, time.perf_counter() - start, profile.db_time - db_time, profile.queries - queries
+            )
+            if token is not None:
+                current_profile.reset(token)
+                metrics.record_functions(profile.functions)
+
+    return wrapper
+
+
+def get_server_timing(profile: Profile, elapsed: float) -> str:
+    """Server-Timing header value: database and Python time, then each profiled function"""
+    timings = [
+        f'db;dur={profile.db_time * 1000:.2f};desc="{profile.queries} queries"',
+        f"app;dur={(elapsed - profile.db_time) * 1000:.2f}",
+        f"total;dur={elapsed * 1000:.2f}",
+    ]
+    for name, (calls, seconds, db_time, queries) in profile.functions.items():
+        timings.append(f'{name};dur={seconds * 1000:.2f};desc="{calls} calls, {queries} queries"')
+    return ", ".join(timings)
+
+
+def get_endpoint(scope: Dict) -> str:
+    """Method and route template of a request, so metrics don't get a label per client ID"""
+    route = scope.get("route")
+    path = getattr(route, "path_format", None) or "unmatched"
+    return f"{scope['method']} {path}"
+
+
+class ProfilingMiddleware:
+    """
+    Profile every HTTP request: queries, database time and time in profiled functions.
+
+    The Server-Timing header holds what happened until the response started; streamed
+    bodies keep counting towards /metrics until they end.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not PROFILING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profile()
+        token = current_profile.set(profile)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timing = get_server_timing(profile, time.perf_counter() - start)
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_profile.reset(token)
+            endpoint = get_endpoint(scope)
+            metrics.record_request(endpoint, status, time.perf_counter() - start, profile)
+
+            repeated = profile.repeated_statements()
+            if repeated:
+                metrics.record_n_plus_one(endpoint)
+                for statement, count in repeated:
+                    logger.warning(
+                        "Possible N+1 queries in %s: statement run %d times: %s",
+                        endpoint, count, " ".join(statement.split())
+                    )
@@ -0,0 +1,107 @@
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from datetime import datetime
+from typing import List
+import numpy as np
+
+from app.models.models import Record
+from app.utils.billing import HOURS_PER_DAY, bucket_by_hour, sequential_sum
+from app.utils.dates import next_bucket, truncate
+
+# Rows fetched from the cursor at a time when loading a reading set
+READING_SET_CHUNK_SIZE = 10000
+
+SECONDS_PER_HOUR = 3600
+
+EPOCH = np.datetime64(0, "s")
+
+
+def to_epoch(timestamp: datetime) -> int:
+    """Seconds from 1970-01-01 to a naive timestamp, the way reading sets store them"""
+    return int((np.datetime64(timestamp, "s") - EPOCH).astype(np.int64))
+
+
+class ReadingSet:
+    """
+    Readings of one value column as two arrays, ordered by timestamp.
+
+    Timestamps are int64 seconds since the epoch and values float64, with missing values
+    as NaN: 16 bytes a reading instead of a Row tuple, a datetime and a float object.
+    Slices share the arrays of the set they come from.
+    """
+
+    __slots__ = ("timestamps", "values")
+
+    def __init__(self, timestamps: np.ndarray, values: np.ndarray):
+        self.timestamps = timestamps
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    @property
+    def nbytes(self) -> int:
+        return self.timestamps.nbytes + self.values.nbytes
+
+    def between(self, start: datetime, end: datetime) -> "ReadingSet":
+        """Readings from start up to end, not included, without copying them"""
+        first, last = np.searchsorted(self.timestamps, [to_epoch(start), to_epoch(end)])
+        return ReadingSet(self.timestamps[first:last], self.values[first:last])
+
+    def bucket(self, timestamp: datetime, resolution: str) -> "ReadingSet":
+        """Readings of the hour, day or month a timestamp falls in, without copying them"""
+        start = truncate(timestamp, resolution)
+        return self.between(start, next_bucket(start, resolution))
+
+    def hours_of_day(self) -> np.ndarray:
+        return self.timestamps // SECONDS_PER_HOUR % HOURS_PER_DAY
+
+    def total(self) -> float:
+        """Sum of the values in order, ignoring missing ones"""
+        return sequential_sum(np.nan_to_num(self.values))
+
+    def hourly_totals(self) -> np.ndarray:
+        """Sum of the values by hour of the day, ignoring missing ones"""
+        return bucket_by_hour(self.hours_of_day(), self.values)
+
+
+def load_reading_set(
+        db: Session,
+        value_column,
+        client_id: int,
+        start: datetime,
+        end: datetime,
+        chunk_size: int = READING_SET_CHUNK_SIZE
+) -> ReadingSet:
+    """
+    Load the readings of a value column (Consumption.value or Injection.value) of a client
+    from start to end, both included.
+
+    Rows are read chunk_size at a time and converted to arrays as they arrive, so only one
+    chunk of row objects is alive at any moment.
+    """
+    query = select(
+        Record.record_timestamp,
+        value_column
+    ).join(
+        value_column.class_
+    ).where(
+        Record.id_service == client_id,
+        Record.record_timestamp >= start,
+        Record.record_timestamp <= end
+    ).order_by(
+        Record.record_timestamp,
+        Record.id_record
+    )
+    result = db.execute(query.execution_options(yield_per=chunk_size))
+
+    timestamps: List[np.ndarray] = []
+    values: List[np.ndarray] = []
+    for rows in result.partitions():
+        columns = list(zip(*rows))
+        timestamps.append((np.array(columns[0], dtype="datetime64[s]") - EPOCH).astype(np.int64))
+        values.append(np.array(columns[1], dtype=np.float64))
+
+    if not timestamps:
+        return ReadingSet(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+    return ReadingSet(np.concatenate(timestamps), np.concatenate(values))
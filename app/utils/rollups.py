@@ -0,0 +1,266 @@
+from sqlalchemy.orm import Session
+from sqlalchemy import func, insert, delete, select
+from sqlalchemy.dialects import postgresql, sqlite
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+from app.models.models import (
+    Consumption,
+    Injection,
+    Record,
+    ServiceHourlyProfile,
+    ServiceMonthlyRollup,
+    SystemHourlyRollup
+)
+from app.utils.billing import HOURS_PER_DAY
+from app.utils.dates import check_month, next_bucket
+from app.utils.invoice_cache import ALL_INVOICES, mark_stale, month_tag, readings_tag
+from app.utils.profiling import profiled
+
+# Rollup value columns; a NULL sum means no reading of that kind was seen
+ROLLUP_VALUES = ("records", "consumption", "injection")
+
+
+# SQLite formats truncating a timestamp to each resolution
+BUCKET_FORMATS = {
+    "hour": "%Y-%m-%d %H:00:00.000000",
+    "day": "%Y-%m-%d 00:00:00.000000",
+    "month": "%Y-%m-01 00:00:00.000000",
+}
+
+
+def time_bucket(db: Session, timestamp, resolution: str = "hour"):
+    """SQL expression truncating a timestamp to its hour, day or month"""
+    if db.get_bind().dialect.name == "sqlite":
+        # Same text format SQLAlchemy stores DateTime values in, so comparisons keep working
+        return func.strftime(BUCKET_FORMATS[resolution], timestamp)
+    return func.date_trunc(resolution, timestamp)
+
+
+def rebuild_rollups(db: Session, year: Optional[int] = None, month: Optional[int] = None):
+    """
+    Recompute the rollups from the raw records.
+
+    Only the given month is rebuilt when year and month are set, otherwise everything.
+    Use it after bulk loads or after editing readings in place; cached invoices of the
+    rebuilt months are dropped as well.
+    """
+    record_filter = []
+    monthly_filter = []
+    profile_filter = []
+    hourly_filter = []
+    if year is not None and month is not None:
+        check_month(month)
+        first_day = datetime(year, month, 1)
+        next_month = next_bucket(first_day, "month")
+        record_filter = [Record.record_timestamp >= first_day, Record.record_timestamp < next_month]
+        monthly_filter = [ServiceMonthlyRollup.year == year, ServiceMonthlyRollup.month == month]
+        profile_filter = [ServiceHourlyProfile.year == year, ServiceHourlyProfile.month == month]
+        hourly_filter = [SystemHourlyRollup.hour_timestamp >= first_day, SystemHourlyRollup.hour_timestamp < next_month]
+        mark_stale(db, [month_tag(year, month)])
+    else:
+        mark_stale(db, [ALL_INVOICES])
+
+    record_year = func.extract('year', Record.record_timestamp)
+    record_month = func.extract('month', Record.record_timestamp)
+    record_hour_of_day = func.extract('hour', Record.record_timestamp)
+    record_hour = time_bucket(db, Record.record_timestamp)
+
+    sums = (
+        func.count(Record.id_record),
+        func.sum(Consumption.value),
+        func.sum(Injection.value)
+    )
+
+    monthly = select(
+        Record.id_service, record_year, record_month, *sums
+    ).outerjoin(
+        Consumption, Record.id_record == Consumption.id_record
+    ).outerjoin(
+        Injection, Record.id_record == Injection.id_record
+    ).where(
+        Record.id_service.isnot(None),
+        Record.record_timestamp.isnot(None),
+        *record_filter
+    ).group_by(
+        Record.id_service, record_year, record_month
+    )
+
+    profiles = select(
+        Record.id_service, record_year, record_month, record_hour_of_day, *sums
+    ).outerjoin(
+        Consumption, Record.id_record == Consumption.id_record
+    ).outerjoin(
+        Injection, Record.id_record == Injection.id_record
+    ).where(
+        Record.id_service.isnot(None),
+        Record.record_timestamp.isnot(None),
+        *record_filter
+    ).group_by(
+        Record.id_service, record_year, record_month, record_hour_of_day
+    )
+
+    hourly = select(
+        record_hour, *sums
+    ).outerjoin(
+        Consumption, Record.id_record == Consumption.id_record
+    ).outerjoin(
+        Injection, Record.id_record == Injection.id_record
+    ).where(
+        Record.record_timestamp.isnot(None),
+        *record_filter
+    ).group_by(
+        record_hour
+    )
+
+    db.execute(delete(ServiceMonthlyRollup).where(*monthly_filter))
+    db.execute(insert(ServiceMonthlyRollup).from_select(
+        ["id_service", "year", "month", *ROLLUP_VALUES], monthly
+    ))
+    db.execute(delete(ServiceHourlyProfile).where(*profile_filter))
+    db.execute(insert(ServiceHourlyProfile).from_select(
+        ["id_service", "year", "month", "hour", *ROLLUP_VALUES], profiles
+    ))
+    db.execute(delete(SystemHourlyRollup).where(*hourly_filter))
+    db.execute(insert(SystemHourlyRollup).from_select(
+        ["hour_timestamp", *ROLLUP_VALUES], hourly
+    ))
+    db.commit()
+
+
+def aggregate_readings(readings: Iterable[Tuple]) -> Tuple[Dict, Dict, Dict]:
+    """
+    Sum readings into monthly per-service, hour of the day per-service-month and hourly
+    system-wide buckets.
+
+    Readings are (id_service, record_timestamp, consumption, injection) tuples, with
+    None for a missing consumption or injection value.
+    """
+    monthly = {}
+    profiles = {}
+    hourly = {}
+
+    for id_service, timestamp, consumption, injection in readings:
+        for buckets, key in (
+                (monthly, (id_service, timestamp.year, timestamp.month)),
+                (profiles, (id_service, timestamp.year, timestamp.month, timestamp.hour)),
+                (hourly, (timestamp.replace(minute=0, second=0, microsecond=0),))
+        ):
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = [0, None, None]
+            bucket[0] += 1
+            if consumption is not None:
+                bucket[1] = consumption if bucket[1] is None else bucket[1] + consumption
+            if injection is not None:
+                bucket[2] = injection if bucket[2] is None else bucket[2] + injection
+
+    return monthly, profiles, hourly
+
+
+def add_to_rollup(db: Session, model, key_columns: List[str], buckets: Dict):
+    """Add bucket sums to the existing rollup rows, inserting the missing ones"""
+    if not buckets:
+        return
+
+    # Sorted, so concurrent writers lock the rollup rows in the same order and can't deadlock
+    rows = [
+        dict(zip(key_columns, key), **dict(zip(ROLLUP_VALUES, buckets[key])))
+        for key in sorted(buckets)
+    ]
+
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(model)
+    elif dialect == "sqlite":
+        statement = sqlite.insert(model)
+    else:
+        raise ValueError(f"Incremental rollups are not supported on {dialect}, only on PostgreSQL and SQLite")
+
+    table = model.__table__
+    statement = statement.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={
+            # A NULL on either side keeps the other one
+            column: func.coalesce(table.c[column] + statement.excluded[column], table.c[column], statement.excluded[column])
+            for column in ROLLUP_VALUES
+        }
+    )
+    db.execute(statement, rows)
+
+
+@profiled
+def update_rollups(db: Session, readings: Iterable[Tuple]):
+    """
+    Add newly stored readings to the rollups, in the caller's transaction.
+
+    Cached invoices of the months they belong to are dropped once it commits.
+
+    Readings are (id_service, record_timestamp, consumption, injection) tuples.
+    """
+    monthly, profiles, hourly = aggregate_readings(readings)
+    mark_stale(db, [readings_tag(*key) for key in monthly])
+    add_to_rollup(db, ServiceMonthlyRollup, ["id_service", "year", "month"], monthly)
+    add_to_rollup(db, ServiceHourlyProfile, ["id_service", "year", "month", "hour"], profiles)
+    add_to_rollup(db, SystemHourlyRollup, ["hour_timestamp"], hourly)
+
+
+@profiled
+def get_service_month_totals(db: Session, client_id: int, year: int, month: int) -> Tuple[float, float]:
+    """Get a service's total consumption and injection for a month from the rollups"""
+    row = db.query(
+        ServiceMonthlyRollup.consumption,
+        ServiceMonthlyRollup.injection
+    ).filter(
+        ServiceMonthlyRollup.id_service == client_id,
+        ServiceMonthlyRollup.year == year,
+        ServiceMonthlyRollup.month == month
+    ).first()
+
+    if not row:
+        return 0.0, 0.0
+    return row.consumption or 0.0, row.injection or 0.0
+
+
+@profiled
+def get_hourly_profiles(
+        db: Session,
+        client_ids: Iterable[int],
+        year: int,
+        month: int,
+        column: str = "injection"
+) -> Dict[int, np.ndarray]:
+    """
+    Get a column of the hourly profiles of services for a month, as 24 values by hour of
+    the day; hours without readings are 0 and services without any are left out.
+    """
+    value = getattr(ServiceHourlyProfile, column)
+    rows = db.query(
+        ServiceHourlyProfile.id_service,
+        ServiceHourlyProfile.hour,
+        value
+    ).filter(
+        ServiceHourlyProfile.id_service.in_(list(client_ids)),
+        ServiceHourlyProfile.year == year,
+        ServiceHourlyProfile.month == month
+    ).all()
+
+    profiles = {}
+    for id_service, hour, total in rows:
+        profile = profiles.get(id_service)
+        if profile is None:
+            profile = profiles[id_service] = np.zeros(HOURS_PER_DAY)
+        profile[hour] = total or 0.0
+    return profiles
+
+
+if __name__ == "__main__":
+    from app.database import SessionLocal
+
+    session = SessionLocal()
+    try:
+        rebuild_rollups(session)
+        print("Rollups rebuilt")
+    finally:
+        session.close()
@@ -0,0 +1,79 @@
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+import orjson
+
+# Ways list-heavy responses can be laid out: a list of objects, or one list per field
+LAYOUTS = ("rows", "columnar")
+
+STATISTIC_FIELDS = ("month", "year", "consumption", "injection", "net")
+SYSTEM_LOAD_FIELDS = ("hour", "load")
+SYSTEM_LOAD_SERIES_FIELDS = ("timestamp", "load")
+HOURLY_PROFILE_FIELDS = ("hour", "consumption", "injection")
+
+
+def to_columns(rows: List[Dict], fields: Sequence[str]) -> Dict[str, List]:
+    """Turn a list of objects into one list per field"""
+    return {field: [row[field] for row in rows] for field in fields}
+
+
+def columnar_client_statistics(statistics: Dict) -> Dict:
+    """Client statistics with monthly_statistics as one list per field"""
+    return dict(statistics, monthly_statistics=to_columns(statistics["monthly_statistics"], STATISTIC_FIELDS))
+
+
+def columnar_hourly_profile(profile: Dict) -> Dict:
+    """Client hourly profile with hourly_profile as one list per field"""
+    return dict(profile, hourly_profile=to_columns(profile["hourly_profile"], HOURLY_PROFILE_FIELDS))
+
+
+def columnar_system_load(system_load: Dict) -> Dict:
+    """System load with hourly_loads as one list per field"""
+    return dict(system_load, hourly_loads=to_columns(system_load["hourly_loads"], SYSTEM_LOAD_FIELDS))
+
+
+def columnar_system_load_series(series: Dict) -> Dict:
+    """System load series with loads as one list per field"""
+    return dict(series, loads=to_columns(series["loads"], SYSTEM_LOAD_SERIES_FIELDS))
+
+
+def iter_system_load_series_json(
+        start: datetime,
+        end: datetime,
+        resolution: str,
+        loads: Iterable[Tuple[datetime, float]],
+        chunk_size: int = 1000
+) -> Iterator[bytes]:
+    """Render a system load series as JSON in chunks, with the same shape as the non-streamed response"""
+    head = orjson.dumps({"start": start, "end": end, "resolution": resolution})
+    yield head[:-1] + b',"loads":['
+
+    chunk = []
+    separator = b""
+    for timestamp, load in loads:
+        chunk.append(orjson.dumps({"timestamp": timestamp, "load": load}))
+        if len(chunk) == chunk_size:
+            yield separator + b",".join(chunk)
+            separator = b","
+            chunk = []
+    if chunk:
+        yield separator + b",".join(chunk)
+    yield b"]}"
+
+
+def iter_portfolio_statistics_json(statistics: Iterable[Dict], limit: int, layout: str = "rows") -> Iterator[bytes]:
+    """
+    Render a page of client statistics as JSON, one client at a time.
+
+    next_after, written last, is the ID to pass as after for the next page, or null when
+    the page wasn't full and there are no more clients.
+    """
+    yield b'{"clients":['
+    count = 0
+    last_id: Optional[int] = None
+    for client in statistics:
+        if layout == "columnar":
+            client = columnar_client_statistics(client)
+        yield (b"," if count else b"") + orjson.dumps(client)
+        count += 1
+        last_id = client["client_id"]
+    yield b'],"next_after":' + orjson.dumps(last_id if count == limit else None) + b"}"
@@ -0,0 +1,305 @@
+"""
+What-if re-pricing of a month under candidate tariffs, without writing to the database.
+
+Of the tariff components only CU and C enter an invoice (EA, EE1 and EC), and EE2 is
+priced at the hourly XM rates, so once the month's quantities of every service are
+loaded a scenario is a few array operations over all services at once.
+"""
+from sqlalchemy.orm import Session
+from collections import namedtuple
+from typing import Dict, List, Optional, Set, Tuple
+import threading
+import time
+import numpy as np
+
+from app.config import SIMULATION_CACHE_MONTHS, SIMULATION_CACHE_TTL
+from app.utils.billing import HOURS_PER_DAY, InvoiceInputs, compute_EE2
+from app.utils.dates import check_month
+from app.utils.invoice_batch import get_hourly_injections, get_monthly_totals, get_services_with_tariffs
+from app.utils.invoice_cache import invoice_cache
+from app.utils.prices import get_hourly_rates
+from app.utils.profiling import profiled
+from app.utils.tariffs import get_tariff_key, tariff_resolver
+
+# Components a candidate tariff can set; CU defaults to their sum
+TARIFF_COMPONENTS = ("G", "T", "D", "R", "C", "P")
+
+# The month's quantities of every service with a tariff, one array element per service.
+# tariff_index points into tariff_keys, whose current CU and C rates are in cu and c.
+# The services without a tariff are kept apart, in the unpriced arrays, to count them.
+PricingBase = namedtuple("PricingBase", [
+    "client_ids",
+    "id_market",
+    "voltage_level",
+    "consumption",
+    "injection",
+    "ee2",
+    "tariff_index",
+    "tariff_keys",
+    "cu",
+    "c",
+    "unpriced_client_ids",
+    "unpriced_id_market",
+    "unpriced_voltage_level",
+])
+
+
+@profiled
+def load_pricing_base(db: Session, year: int, month: int) -> PricingBase:
+    """
+    Load the quantities a month's invoices depend on for every service with a tariff.
+
+    EE2 doesn't depend on the tariff, so it is computed here once, from the hourly
+    profiles, for the services with excess injection.
+    """
+    check_month(month)
+
+    services = get_services_with_tariffs(db, [])
+    totals = get_monthly_totals(db, [], year, month)
+
+    priced = [(service, tariff) for service, tariff in services if tariff]
+    unpriced = [service for service, tariff in services if not tariff]
+    excess = {id_service for id_service, (consumption, injection) in totals.items() if injection > consumption}
+    excess_ids = [service.id_service for service, _ in priced if service.id_service in excess]
+    hourly_injections = get_hourly_injections(db, excess_ids, year, month) if excess_ids else {}
+    hourly_rates = get_hourly_rates(db, year, month) if excess_ids else None
+
+    keys: Dict[Tuple, int] = {}
+    tariff_index = np.empty(len(priced), dtype=np.int64)
+    consumption = np.empty(len(priced))
+    injection = np.empty(len(priced))
+    ee2 = np.zeros(len(priced))
+    cu = []
+    c = []
+    for position, (service, tariff) in enumerate(priced):
+        key = get_tariff_key(tariff.id_market, tariff.voltage_level, tariff.cdi)
+        if key not in keys:
+            keys[key] = len(keys)
+            cu.append(tariff.CU)
+            c.append(tariff.C)
+        tariff_index[position] = keys[key]
+
+        total_consumption, total_injection = totals.get(service.id_service, (0.0, 0.0))
+        consumption[position] = total_consumption
+        injection[position] = total_injection
+        if total_injection > total_consumption:
+            ee2[position] = compute_EE2(InvoiceInputs(
+                client_id=service.id_service,
+                year=year,
+                month=month,
+                tariff=tariff,
+                total_consumption=total_consumption,
+                total_injection=total_injection,
+                hourly_injections=hourly_injections.get(service.id_service, np.zeros(HOURS_PER_DAY)),
+                hourly_rates=hourly_rates
+            )).total
+
+    return PricingBase(
+        client_ids=np.array([service.id_service for service, _ in priced], dtype=np.int64),
+        id_market=np.array([service.id_market for service, _ in priced], dtype=np.int64),
+        voltage_level=np.array([service.voltage_level for service, _ in priced], dtype=np.int64),
+        consumption=consumption,
+        injection=injection,
+        ee2=ee2,
+        tariff_index=tariff_index,
+        tariff_keys=list(keys),
+        cu=np.array(cu, dtype=np.float64),
+        c=np.array(c, dtype=np.float64),
+        unpriced_client_ids=np.array([service.id_service for service in unpriced], dtype=np.int64),
+        # As floats so a missing market or voltage level is NaN, which no filter matches
+        unpriced_id_market=np.array([service.id_market for service in unpriced], dtype=np.float64),
+        unpriced_voltage_level=np.array([service.voltage_level for service in unpriced], dtype=np.float64)
+    )
+
+
+class PricingBaseCache:
+    """
+    Pricing bases of the last SIMULATION_CACHE_MONTHS months simulated in this process.
+
+    A base is dropped when the invoice cache invalidates its month (readings ingested,
+    rollups rebuilt, late prices) or any service or tariff, including the invalidations
+    other workers commit, and reloaded after SIMULATION_CACHE_TTL seconds in any case.
+    """
+
+    def __init__(self, ttl: float = SIMULATION_CACHE_TTL, max_months: int = SIMULATION_CACHE_MONTHS):
+        self.ttl = ttl
+        self.max_months = max_months
+        self._bases: Dict[Tuple[int, int], Tuple[PricingBase, float, int]] = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._bases.clear()
+
+    def invalidate(self, tags: Set[str]):
+        """Drop the bases of the months in readings and month tags, or every base for any other tag"""
+        months = set()
+        for tag in tags:
+            kind, *parts = tag.split(":")
+            if kind not in ("readings", "month"):
+                self.clear()
+                return
+            months.add((int(parts[-2]), int(parts[-1])))
+        with self._lock:
+            for month in months:
+                self._bases.pop(month, None)
+
+    def get(self, db: Session, year: int, month: int) -> PricingBase:
+        invoice_cache.sync(db)
+        tariff_resolver.get_tariffs(db)
+        entry = self._bases.get((year, month))
+        if entry is not None:
+            base, loaded_at, tariff_version = entry
+            if time.monotonic() - loaded_at <= self.ttl and tariff_version == tariff_resolver.version:
+                return base
+
+        base = load_pricing_base(db, year, month)
+        with self._lock:
+            self._bases.pop((year, month), None)
+            self._bases[(year, month)] = (base, time.monotonic(), tariff_resolver.version)
+            # Dicts keep insertion order, so the first entries are the oldest
+            while len(self._bases) > self.max_months:
+                del self._bases[next(iter(self._bases))]
+        return base
+
+
+pricing_bases = PricingBaseCache()
+invoice_cache.listeners.append(pricing_bases.invalidate)
+
+
+def get_scenario_rates(base: PricingBase, tariffs: List[Dict]) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    Get the CU and C rates of every tariff key under a scenario, with the number of
+    candidate tariffs that match no priced service. Keys the scenario doesn't set keep
+    their current rates; when several candidates share a key, the one with the lowest cdi
+    is used, as with the stored tariffs.
+    """
+    cu = base.cu.copy()
+    c = base.c.copy()
+    positions = {key: position for position, key in enumerate(base.tariff_keys)}
+
+    unmatched = 0
+    seen = set()
+    for tariff in sorted(tariffs, key=lambda tariff: (tariff.get("cdi") is None, tariff.get("cdi") or 0)):
+        key = get_tariff_key(tariff["id_market"], tariff["voltage_level"], tariff.get("cdi"))
+        position = positions.get(key)
+        if position is None:
+            unmatched += 1
+            continue
+        if key in seen:
+            continue
+        seen.add(key)
+
+        cu_rate = tariff.get("CU")
+        if cu_rate is None:
+            cu_rate = sum(tariff[component] for component in TARIFF_COMPONENTS)
+        cu[position] = cu_rate
+        c[position] = tariff["C"]
+
+    return cu, c, unmatched
+
+
+def price(base: PricingBase, cu: np.ndarray, c: np.ndarray, selected: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Price the selected services at the given rates of each tariff key.
+
+    cu and c can have one row per scenario, in which case every concept gets one row per
+    scenario too. Each element is computed like compute_invoice does, so with the current
+    rates the totals are those of the invoice endpoints.
+    """
+    tariff_index = base.tariff_index[selected]
+    cu = cu[..., tariff_index]
+    c = c[..., tariff_index]
+    consumption = base.consumption[selected]
+    injection = base.injection[selected]
+
+    concepts = {
+        "EA": consumption * cu,
+        "EC": injection * c,
+        "EE1": np.minimum(injection, consumption) * -cu,
+        "EE2": np.broadcast_to(base.ee2[selected], cu.shape),
+    }
+    concepts["total"] = concepts["EA"] + concepts["EC"] + concepts["EE1"] + concepts["EE2"]
+    return concepts
+
+
+def select_services(
+        ids: np.ndarray,
+        markets: np.ndarray,
+        voltage_levels: np.ndarray,
+        client_ids: Optional[List[int]],
+        id_market: Optional[int],
+        voltage_level: Optional[int]
+) -> np.ndarray:
+    """Mask of the services matching the filters, as get_service_filter selects them"""
+    selected = np.ones(len(ids), dtype=bool)
+    if client_ids is not None:
+        selected &= np.isin(ids, client_ids)
+    if id_market is not None:
+        selected &= markets == id_market
+    if voltage_level is not None:
+        selected &= voltage_levels == voltage_level
+    return selected
+
+
+@profiled
+def simulate_tariffs(
+        db: Session,
+        year: int,
+        month: int,
+        scenarios: List[Dict],
+        client_ids: Optional[List[int]] = None,
+        id_market: Optional[int] = None,
+        voltage_level: Optional[int] = None,
+        include_services: bool = True
+) -> Dict:
+    """
+    Re-price a month under each scenario's candidate tariffs and compare with the current ones.
+
+    Scenarios are dicts with a name and a list of tariffs (id_market, voltage_level, cdi
+    and the G, T, D, R, C, P components, CU optionally). Services can be narrowed down by
+    ID, market or voltage level. Aggregates are returned per concept; with
+    include_services, also every service's current and simulated total, as one list per
+    field in client_ids order.
+    """
+    base = pricing_bases.get(db, year, month)
+
+    filters = (client_ids, id_market, voltage_level)
+    selected = select_services(base.client_ids, base.id_market, base.voltage_level, *filters)
+    unpriced = select_services(base.unpriced_client_ids, base.unpriced_id_market, base.unpriced_voltage_level, *filters)
+
+    current = price(base, base.cu, base.c, selected)
+
+    rates = [get_scenario_rates(base, scenario["tariffs"]) for scenario in scenarios]
+    simulated = price(
+        base,
+        np.array([cu for cu, _, _ in rates]).reshape(len(rates), len(base.cu)),
+        np.array([c for _, c, _ in rates]).reshape(len(rates), len(base.c)),
+        selected
+    )
+
+    current_totals = {concept: float(values.sum()) for concept, values in current.items()}
+    results = []
+    for row, (scenario, (_, _, unmatched)) in enumerate(zip(scenarios, rates)):
+        totals = {concept: float(values[row].sum()) for concept, values in simulated.items()}
+        delta = totals["total"] - current_totals["total"]
+        results.append({
+            "name": scenario["name"],
+            "unmatched_tariffs": unmatched,
+            "totals": totals,
+            "deltas": {concept: totals[concept] - current_totals[concept] for concept in totals},
+            "delta_percent": delta / current_totals["total"] * 100 if current_totals["total"] else None,
+            "service_totals": simulated["total"][row].tolist() if include_services else None,
+            "service_deltas": (simulated["total"][row] - current["total"]).tolist() if include_services else None,
+        })
+
+    return {
+        "year": year,
+        "month": month,
+        "services": int(selected.sum()),
+        "services_without_tariff": int(unpriced.sum()),
+        "current": current_totals,
+        "client_ids": base.client_ids[selected].tolist() if include_services else None,
+        "current_service_totals": current["total"].tolist() if include_services else None,
+        "scenarios": results,
+    }
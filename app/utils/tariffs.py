@@ -0,0 +1,97 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from typing import Dict, Optional, Tuple
+import threading
+import time
+
+from app.config import TARIFF_CACHE_TTL
+from app.models.models import Service, Tariff
+from app.utils.billing import TariffRates
+
+# Voltage levels whose tariff does not depend on the cdi
+CDI_INDEPENDENT_VOLTAGE_LEVELS = (2, 3)
+
+
+def get_tariff_key(id_market: int, voltage_level: int, cdi: Optional[int]) -> Tuple:
+    """Get the lookup key of a tariff; cdi doesn't matter if voltage_level is 2 or 3"""
+    if voltage_level in CDI_INDEPENDENT_VOLTAGE_LEVELS:
+        return id_market, voltage_level, None
+    return id_market, voltage_level, cdi
+
+
+class TariffResolver:
+    """
+    In-process copy of the tariffs table indexed by (id_market, voltage_level, cdi).
+
+    The table is loaded on first use and reloaded after TARIFF_CACHE_TTL seconds,
+    after an explicit invalidate() or whenever tariff writes are committed through the ORM.
+    Other workers reload it when they apply the invalidation log before an invoice cache
+    lookup (see app.utils.invoice_cache).
+    """
+
+    def __init__(self, ttl: float = TARIFF_CACHE_TTL):
+        self.ttl = ttl
+        self.version = 0
+        self._tariffs: Optional[Dict[Tuple, TariffRates]] = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Drop the loaded table so the next lookup reloads it"""
+        with self._lock:
+            self._tariffs = None
+
+    def load(self, db: Session) -> Dict[Tuple, TariffRates]:
+        """Load every tariff, keeping the lowest cdi when several share a key"""
+        rows = db.query(Tariff).order_by(Tariff.id_market, Tariff.voltage_level, Tariff.cdi).all()
+
+        tariffs = {}
+        for row in rows:
+            key = get_tariff_key(row.id_market, row.voltage_level, row.cdi)
+            if key not in tariffs:
+                tariffs[key] = TariffRates(
+                    row.id_market, row.cdi, row.voltage_level,
+                    row.G, row.T, row.D, row.R, row.C, row.P, row.CU
+                )
+
+        with self._lock:
+            self._tariffs = tariffs
+            self._loaded_at = time.monotonic()
+            self.version += 1
+
+        return tariffs
+
+    def get_tariffs(self, db: Session) -> Dict[Tuple, TariffRates]:
+        """Get the tariff table, reloading it if it was invalidated or expired"""
+        tariffs = self._tariffs
+        if tariffs is None or time.monotonic() - self._loaded_at > self.ttl:
+            tariffs = self.load(db)
+        return tariffs
+
+    def resolve(self, db: Session, service: Service) -> Optional[TariffRates]:
+        """Get the tariff that applies to a service, or None if there is none"""
+        key = get_tariff_key(service.id_market, service.voltage_level, service.cir)
+        return self.get_tariffs(db).get(key)
+
+
+tariff_resolver = TariffResolver()
+
+
+@event.listens_for(Session, "after_flush")
+def track_tariff_writes(session, flush_context):
+    """Remember when tariffs are inserted, updated or deleted through the ORM"""
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    if any(isinstance(instance, Tariff) for instance in changed):
+        session.info["tariffs_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_tariffs_on_commit(session):
+    """Reload tariffs once the written ones are committed"""
+    if session.info.pop("tariffs_changed", False):
+        tariff_resolver.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_tariff_writes(session):
+    session.info.pop("tariffs_changed", None)
@@ -0,0 +1,415 @@
+"""
+Benchmark and load-test the billing API on a synthetic dataset.
+
+Point DATABASE_URL at a scratch database (SQLite or PostgreSQL), seed it, then run:
+
+    python benchmarks/billing.py seed --services 200 --months 6 --reset
+    python benchmarks/billing.py run --output baseline.json
+    # ... change something ...
+    python benchmarks/billing.py run --output current.json --baseline baseline.json
+    python benchmarks/billing.py compare baseline.json current.json
+
+"run" times each calculate_* function called directly, and compute_invoice on inputs
+loaded beforehand so database latency is left out (micro benchmarks), then sends a
+mix of requests to the ASGI app in-process with a number of concurrent clients (load
+test), and reports p50/p95/p99 latency and throughput. With --baseline, or with
+"compare", benchmarks whose p95 got slower than the tolerance are listed and the exit
+status is 1, so it can gate a CI job.
+
+The invoice cache is disabled while running unless --invoice-cache is given, since every
+seeded month is closed and would otherwise be served from it after the first call.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from sqlalchemy import func
+
+from app.database import engine, SessionLocal
+from app.models.models import Base, Record, Service, ServiceMonthlyRollup, Tariff, XmDataHourlyPerAgent
+from app.utils.calculations import (
+    calculate_EA,
+    calculate_EC,
+    calculate_EE1,
+    calculate_EE2,
+    calculate_all_concepts,
+    get_client_statistics,
+    get_system_load,
+    load_invoice_inputs
+)
+from app.utils.billing import compute_invoice
+from app.utils.columnar import READINGS_CHUNK_SIZE, READINGS_SCHEMA, write_reading_batch
+from app.utils.invoice_cache import invoice_cache
+from app.utils.prices import price_store
+from app.utils.rollups import rebuild_rollups
+from app.utils.tariffs import tariff_resolver
+
+MARKETS = (1, 2, 3, 4)
+VOLTAGE_LEVELS = (1, 2, 3)
+CDIS = (0, 50, 100)
+
+# Share of services with solar panels, the only ones injecting energy
+SOLAR_SHARE = 0.3
+
+MICRO_BENCHMARKS = {
+    "calculate_EA": calculate_EA,
+    "calculate_EC": calculate_EC,
+    "calculate_EE1": calculate_EE1,
+    "calculate_EE2": calculate_EE2,
+    "calculate_all_concepts": calculate_all_concepts,
+}
+
+
+def month_starts(start: datetime, months: int):
+    return [datetime(start.year + (start.month - 1 + i) // 12, (start.month - 1 + i) % 12 + 1, 1)
+            for i in range(months + 1)]
+
+
+def make_tariffs(rng):
+    tariffs = []
+    for id_market in MARKETS:
+        for voltage_level in VOLTAGE_LEVELS:
+            for cdi in CDIS:
+                components = rng.uniform([250, 30, 100, 10, 15, 40], [400, 60, 300, 25, 35, 90]).tolist()
+                components = dict(zip("GTDRCP", components))
+                tariffs.append(dict(id_market=id_market, voltage_level=voltage_level, cdi=cdi,
+                                    CU=sum(components.values()), **components))
+    return tariffs
+
+
+def make_services(rng, count):
+    return [
+        dict(id_service=id_service, id_market=int(rng.choice(MARKETS)),
+             voltage_level=int(rng.choice(VOLTAGE_LEVELS)), cir=int(rng.choice(CDIS)))
+        for id_service in range(1, count + 1)
+    ]
+
+
+def make_prices(rng, hours):
+    return [dict(record_timestamp=hour.to_pydatetime(), value=float(value))
+            for hour, value in zip(hours, rng.uniform(200, 1000, len(hours)))]
+
+
+def make_readings(rng, services, hours, solar, first_id):
+    """Hourly readings of every service, ordered by time as meters report them"""
+    hour_of_day = hours.hour.to_numpy()
+    # Consumption peaks in the evening, solar injection around noon
+    consumption_profile = 1 + 0.6 * np.sin((hour_of_day - 13) * np.pi / 12)
+    solar_profile = np.clip(np.sin((hour_of_day - 6) * np.pi / 12), 0, None)
+
+    base = rng.uniform(0.2, 3.0, len(services))
+    consumption = base[None, :] * consumption_profile[:, None] * rng.uniform(0.7, 1.3, (len(hours), len(services)))
+    injection = (solar * base * rng.uniform(1.5, 8.0, len(services)))[None, :] * solar_profile[:, None]
+    injection = injection * rng.uniform(0.5, 1.0, injection.shape)
+
+    rows = len(hours) * len(services)
+    return pa.RecordBatch.from_arrays([
+        pa.array(np.arange(first_id, first_id + rows), type=pa.int64()),
+        pa.array(np.tile(services, len(hours)), type=pa.int64()),
+        pa.array(np.repeat(hours.to_numpy(), len(services)), type=pa.timestamp("us")),
+        pa.array(consumption.ravel().round(3), type=pa.float64()),
+        pa.array(injection.ravel().round(3), type=pa.float64()),
+    ], schema=READINGS_SCHEMA)
+
+
+def seed(args):
+    """Fill the database with services, tariffs, prices and hourly readings"""
+    if args.reset:
+        Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    db = SessionLocal()
+    try:
+        if db.query(Service).first() is not None:
+            sys.exit("The database already has data; use --reset to drop it and seed from scratch")
+
+        rng = np.random.default_rng(args.seed)
+        start = time.perf_counter()
+
+        starts = month_starts(datetime.strptime(args.start, "%Y-%m"), args.months)
+        services = make_services(rng, args.services)
+        service_ids = np.array([service["id_service"] for service in services])
+        solar = rng.random(len(services)) < SOLAR_SHARE
+
+        db.execute(Tariff.__table__.insert(), make_tariffs(rng))
+        db.execute(Service.__table__.insert(), services)
+        db.execute(XmDataHourlyPerAgent.__table__.insert(), make_prices(
+            rng, pd.date_range(starts[0], starts[-1], freq="h", inclusive="left")
+        ))
+        db.commit()
+
+        readings = 0
+        for first_day, next_month in zip(starts, starts[1:]):
+            hours = pd.date_range(first_day, next_month, freq="h", inclusive="left")
+            batch = make_readings(rng, service_ids, hours, solar, readings + 1)
+            for offset in range(0, batch.num_rows, READINGS_CHUNK_SIZE):
+                write_reading_batch(db, batch.slice(offset, READINGS_CHUNK_SIZE))
+                db.commit()
+            readings += batch.num_rows
+            print(f"Seeded {first_day:%Y-%m}: {batch.num_rows} readings")
+
+        rebuild_rollups(db)
+    finally:
+        db.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Seeded {len(services)} services and {readings} readings in {elapsed:.2f}s")
+
+
+def summarize(timings, elapsed):
+    """Latency percentiles in milliseconds and throughput in calls per second"""
+    timings = np.array(timings) * 1000
+    return {
+        "count": len(timings),
+        "mean_ms": float(timings.mean()),
+        "p50_ms": float(np.percentile(timings, 50)),
+        "p95_ms": float(np.percentile(timings, 95)),
+        "p99_ms": float(np.percentile(timings, 99)),
+        "max_ms": float(timings.max()),
+        "throughput": len(timings) / elapsed if elapsed else 0.0,
+    }
+
+
+def get_dataset(db):
+    """Services and months that have readings, to draw the benchmark inputs from"""
+    months = db.query(ServiceMonthlyRollup.year, ServiceMonthlyRollup.month).distinct().order_by(
+        ServiceMonthlyRollup.year, ServiceMonthlyRollup.month
+    ).all()
+    if not months:
+        sys.exit("The database has no readings; seed it first")
+    return {
+        "services": [row[0] for row in db.query(Service.id_service).order_by(Service.id_service)],
+        "months": [tuple(month) for month in months],
+        "readings": db.query(func.count(Record.id_record)).scalar(),
+    }
+
+
+def time_call(func, *args):
+    db = SessionLocal()
+    try:
+        start = time.perf_counter()
+        func(db, *args)
+        return time.perf_counter() - start
+    finally:
+        db.close()
+
+
+def run_micro(dataset, rng, repeat, warmup):
+    results = {}
+    inputs = [(rng.choice(dataset["services"]), *rng.choice(dataset["months"])) for _ in range(repeat)]
+    days = [datetime(year, month, rng.randint(1, 28)) for year, month in (rng.choice(dataset["months"])
+                                                                          for _ in range(repeat))]
+    benchmarks = [(name, func, inputs) for name, func in MICRO_BENCHMARKS.items()]
+    benchmarks.append(("get_client_statistics", get_client_statistics, [(args[0],) for args in inputs]))
+    benchmarks.append(("get_system_load", get_system_load, [(day,) for day in days]))
+
+    for name, func, calls in benchmarks:
+        for args in calls[:warmup]:
+            time_call(func, *args)
+
+        start = time.perf_counter()
+        timings = [time_call(func, *args) for args in calls]
+        results[name] = summarize(timings, time.perf_counter() - start)
+
+    # The billing math alone, on inputs already in memory
+    db = SessionLocal()
+    try:
+        loaded = [load_invoice_inputs(db, *args)[1] for args in inputs]
+    finally:
+        db.close()
+    for invoice_inputs in loaded[:warmup]:
+        compute_invoice(invoice_inputs)
+
+    timings = []
+    start = time.perf_counter()
+    for invoice_inputs in loaded:
+        call_start = time.perf_counter()
+        compute_invoice(invoice_inputs)
+        timings.append(time.perf_counter() - call_start)
+    results["compute_invoice"] = summarize(timings, time.perf_counter() - start)
+    return results
+
+
+def make_requests(dataset, rng, count):
+    """A mix of API requests as (endpoint name, method, path, JSON body)"""
+    requests = []
+    for _ in range(count):
+        client_id = rng.choice(dataset["services"])
+        year, month = rng.choice(dataset["months"])
+        kind = rng.choice(["invoice", "invoice", "concept", "client_statistics", "system_load"])
+        if kind == "invoice":
+            requests.append(("calculate-invoice", "POST", "/api/v1/calculate-invoice",
+                             {"client_id": client_id, "year": year, "month": month}))
+        elif kind == "concept":
+            concept = rng.choice(["ea", "ec", "ee1", "ee2"])
+            requests.append((f"calculate-{concept}", "GET",
+                             f"/api/v1/calculate-{concept}/{client_id}?year={year}&month={month}", None))
+        elif kind == "client_statistics":
+            requests.append(("client-statistics", "GET", f"/api/v1/client-statistics/{client_id}", None))
+        else:
+            requests.append(("system-load", "GET",
+                             f"/api/v1/system-load?date_str={year}-{month:02d}-{rng.randint(1, 28):02d}", None))
+    return requests
+
+
+async def run_load(requests, concurrency):
+    from app.main import app
+
+    timings = {}
+    errors = {}
+    queue = list(reversed(requests))
+
+    async def client_loop(client):
+        while queue:
+            name, method, path, body = queue.pop()
+            start = time.perf_counter()
+            response = await client.request(method, path, json=body)
+            timings.setdefault(name, []).append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors[name] = errors.get(name, 0) + 1
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    results = {name: dict(summarize(values, elapsed), errors=errors.get(name, 0))
+               for name, values in sorted(timings.items())}
+    results["all"] = dict(summarize([value for values in timings.values() for value in values], elapsed),
+                          errors=sum(errors.values()))
+    return results
+
+
+def print_results(title, results):
+    print(f"\n=== {title}")
+    print(f"{'benchmark':<24} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'per s':>9}")
+    for name, result in results.items():
+        print(f"{name:<24} {result['count']:>6} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+              f"{result['p99_ms']:>9.2f} {result['throughput']:>9.1f}"
+              + (f"  ({result['errors']} errors)" if result.get("errors") else ""))
+
+
+def run(args):
+    if not args.invoice_cache:
+        invoice_cache.backend = None
+
+    db = SessionLocal()
+    try:
+        dataset = get_dataset(db)
+        # Load the tariffs and prices up front, as a running worker would have them
+        tariff_resolver.get_tariffs(db)
+        price_store.refresh(db)
+    finally:
+        db.close()
+
+    rng = random.Random(args.seed)
+    results = {
+        "dialect": engine.dialect.name,
+        "dataset": {"services": len(dataset["services"]), "months": len(dataset["months"]),
+                    "readings": dataset["readings"]},
+        "settings": {"repeat": args.repeat, "requests": args.requests, "concurrency": args.concurrency,
+                     "invoice_cache": args.invoice_cache},
+    }
+
+    if not args.skip_micro:
+        results["micro"] = run_micro(dataset, rng, args.repeat, args.warmup)
+        print_results("micro benchmarks", results["micro"])
+    if not args.skip_load:
+        requests = make_requests(dataset, rng, args.requests)
+        asyncio.run(run_load(requests[:args.warmup], args.concurrency))
+        results["load"] = asyncio.run(run_load(requests, args.concurrency))
+        print_results(f"load test, {args.concurrency} concurrent clients", results["load"])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_results(baseline, results, args.tolerance):
+            sys.exit(1)
+
+
+def compare_results(before, after, tolerance):
+    """Print the p95 changes between two runs, returning the benchmarks slower than the tolerance"""
+    regressions = []
+    print(f"\n{'benchmark':<32} {'p95 before':>11} {'p95 after':>10} {'change':>8}")
+    for section in ("micro", "load"):
+        for name, result in after.get(section, {}).items():
+            old = before.get(section, {}).get(name)
+            if old is None:
+                continue
+            change = result["p95_ms"] / old["p95_ms"] - 1 if old["p95_ms"] else 0.0
+            flag = ""
+            if change > tolerance:
+                regressions.append(f"{section}.{name}")
+                flag = "  REGRESSION"
+            print(f"{section + '.' + name:<32} {old['p95_ms']:>11.2f} {result['p95_ms']:>10.2f} {change:>+8.0%}{flag}")
+
+    if before.get("dataset") != after.get("dataset") or before.get("dialect") != after.get("dialect"):
+        print("\nWarning: the runs used different datasets or databases")
+    return regressions
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if compare_results(before, after, args.tolerance):
+        sys.exit(1)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark and load-test the billing API on a synthetic dataset")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="Fill the database with a synthetic dataset")
+    seed_parser.add_argument("--services", type=int, default=100, help="Number of services")
+    seed_parser.add_argument("--months", type=int, default=3, help="Months of hourly readings")
+    seed_parser.add_argument("--start", default="2023-01", help="First month (YYYY-MM)")
+    seed_parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    seed_parser.add_argument("--reset", action="store_true", help="Drop every table first")
+
+    run_parser = commands.add_parser("run", help="Run the micro benchmarks and the load test")
+    run_parser.add_argument("--repeat", type=int, default=200, help="Calls per micro benchmark")
+    run_parser.add_argument("--requests", type=int, default=1000, help="Requests sent by the load test")
+    run_parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients of the load test")
+    run_parser.add_argument("--warmup", type=int, default=20, help="Untimed calls before each benchmark")
+    run_parser.add_argument("--seed", type=int, default=0, help="Random seed for the inputs")
+    run_parser.add_argument("--invoice-cache", action="store_true", help="Keep the invoice cache enabled")
+    run_parser.add_argument("--skip-micro", action="store_true", help="Only run the load test")
+    run_parser.add_argument("--skip-load", action="store_true", help="Only run the micro benchmarks")
+    run_parser.add_argument("--output", help="Save the results as JSON")
+    run_parser.add_argument("--baseline", help="Compare with the results saved by an earlier run")
+
+    compare_parser = commands.add_parser("compare", help="Compare two saved runs")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    for command_parser in (run_parser, compare_parser):
+        command_parser.add_argument("--tolerance", type=float, default=0.2,
+                                    help="p95 slowdown reported as a regression (0.2 is 20%%)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    {"seed": seed, "run": run, "compare": compare}[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Measure how many readings per second POST /api/v1/readings stores.
+
+    python benchmarks/ingestion.py --readings 200000
+    python benchmarks/ingestion.py --format csv --batch-size 20000 --output ingestion.json
+
+Readings for the services already in DATABASE_URL, hourly from the hour after the
+latest reading, are parsed and written the way the endpoint does: through the line
+parser and the reading buffer, without id_record so IDs are allocated. The readings
+stay in the database, so point DATABASE_URL at a scratch database seeded with
+benchmarks/billing.py.
+
+Besides the end-to-end rate, parsing is timed on its own, and the time of each write
+step is taken from the profiled functions, summed over batches. Batches written in
+parallel overlap, so on PostgreSQL the steps can add up to more than the wall time.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from sqlalchemy import func
+
+from app.config import INGEST_BATCH_SIZE, INGEST_MAX_PENDING_BATCHES, PROFILING_ENABLED
+from app.database import SessionLocal
+from app.models.models import Record, Service
+from app.utils.ingestion import ReadingBuffer, get_reading_parser, ingest_readings
+from app.utils.profiling import metrics
+
+CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# Profiled functions a batch goes through, in order; commit is the rest of write_readings
+WRITE_STEPS = ("check_services", "allocate_record_ids", "copy_readings", "insert_readings", "update_rollups")
+
+# Body chunk size, about what a server hands the endpoint at a time
+CHUNK_SIZE = 64 * 1024
+
+
+def make_body(db, count, body_format, seed):
+    """A request body with count readings, spread over the services hour after hour"""
+    services = [row[0] for row in db.query(Service.id_service).order_by(Service.id_service)]
+    if not services:
+        sys.exit("The database has no services; seed it first")
+    last = db.query(func.max(Record.record_timestamp)).scalar()
+    if last is None:
+        sys.exit("The database has no readings; seed it first")
+    first_hour = last.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+
+    rng = np.random.default_rng(seed)
+    consumption = rng.uniform(0.2, 3.0, count).round(3)
+    injection = rng.uniform(0.0, 2.0, count).round(3)
+
+    lines = ["id_service,record_timestamp,consumption,injection\n"] if body_format == "csv" else []
+    for index in range(count):
+        service = services[index % len(services)]
+        timestamp = (first_hour + timedelta(hours=index // len(services))).isoformat(" ")
+        if body_format == "csv":
+            lines.append(f"{service},{timestamp},{consumption[index]},{injection[index]}\n")
+        else:
+            lines.append(json.dumps({
+                "id_service": service,
+                "record_timestamp": timestamp,
+                "consumption": consumption[index],
+                "injection": injection[index],
+            }) + "\n")
+    return "".join(lines).encode()
+
+
+def iter_chunks(body):
+    for offset in range(0, len(body), CHUNK_SIZE):
+        yield body[offset:offset + CHUNK_SIZE]
+
+
+async def stream(body):
+    for chunk in iter_chunks(body):
+        yield chunk
+
+
+def time_parsing(body, content_type):
+    parser = get_reading_parser(content_type)
+    start = time.perf_counter()
+    count = 0
+    for chunk in iter_chunks(body):
+        count += len(parser.feed(chunk))
+    count += len(parser.close())
+    return count, time.perf_counter() - start
+
+
+def get_function_seconds():
+    return {name: totals[1] for name, totals in metrics.functions.items()}
+
+
+def run(args):
+    db = SessionLocal()
+    try:
+        body = make_body(db, args.readings, args.format, args.seed)
+        dialect = db.get_bind().dialect.name
+    finally:
+        db.close()
+
+    content_type = CONTENT_TYPES[args.format]
+    parsed, parse_time = time_parsing(body, content_type)
+
+    before = get_function_seconds()
+    buffer = ReadingBuffer(batch_size=args.batch_size, max_pending=args.max_pending)
+    start = time.perf_counter()
+    asyncio.run(ingest_readings(stream(body), get_reading_parser(content_type), buffer))
+    elapsed = time.perf_counter() - start
+    after = get_function_seconds()
+    steps = {name: after.get(name, 0.0) - before.get(name, 0.0) for name in WRITE_STEPS + ("write_readings",)}
+
+    results = {
+        "database": dialect,
+        "format": args.format,
+        "readings": buffer.stored,
+        "batches": buffer.batches,
+        "batch_size": args.batch_size,
+        "max_pending": args.max_pending,
+        "seconds": elapsed,
+        "readings_per_second": buffer.stored / elapsed,
+        "parse_readings_per_second": parsed / parse_time,
+        "write_steps_seconds": {},
+    }
+
+    print(f"{dialect}, {args.format}: {buffer.stored} readings in {buffer.batches} batches, {elapsed:.2f}s")
+    print(f"{'end to end':<22} {results['readings_per_second']:>12,.0f} readings/s")
+    print(f"{'parsing only':<22} {results['parse_readings_per_second']:>12,.0f} readings/s")
+
+    if not PROFILING_ENABLED:
+        print("\nPROFILING_ENABLED is off, so the write steps are not timed")
+    else:
+        accounted = 0.0
+        print(f"\n{'write step':<22} {'seconds':>10} {'share':>8}")
+        for name in WRITE_STEPS + ("commit",):
+            seconds = steps["write_readings"] - accounted if name == "commit" else steps[name]
+            if name != "commit" and not seconds:
+                continue
+            accounted += seconds
+            results["write_steps_seconds"][name] = seconds
+            share = seconds / steps["write_readings"] if steps["write_readings"] else 0.0
+            print(f"{name:<22} {seconds:>10.3f} {share:>8.0%}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the readings per second the ingestion endpoint stores")
+    parser.add_argument("--readings", type=int, default=100000, help="Readings sent")
+    parser.add_argument("--format", choices=sorted(CONTENT_TYPES), default="ndjson", help="Body format")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE, help="Readings written per transaction")
+    parser.add_argument("--max-pending", type=int, default=INGEST_MAX_PENDING_BATCHES,
+                        help="Batches written at the same time")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Save the results as JSON")
+    run(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Show the query plans and timings of the billing queries.
+
+Run it before and after a migration to see what an index or partitioning changes:
+
+    python benchmarks/query_plans.py --output plans_before.json
+    alembic upgrade head
+    python benchmarks/query_plans.py --output plans_after.json
+    python benchmarks/query_plans.py --compare plans_before.json plans_after.json
+
+The queries are captured while the real calculation functions run, so the plans are
+those of the SQL the API sends. PostgreSQL plans come from EXPLAIN ANALYZE, SQLite
+plans from EXPLAIN QUERY PLAN.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event
+
+from app.database import engine, SessionLocal
+from app.models.models import XmDataHourlyPerAgent
+from app.utils.calculations import calculate_all_concepts, get_client_statistics, get_system_load
+from app.utils.dates import get_month_date_range
+from app.utils.invoice_batch import calculate_invoices
+
+
+def get_workloads(client_id, year, month, date):
+    first_day, last_day = get_month_date_range(year, month)
+
+    def xm_month_prices(db):
+        return db.query(XmDataHourlyPerAgent.record_timestamp, XmDataHourlyPerAgent.value).filter(
+            XmDataHourlyPerAgent.record_timestamp >= first_day,
+            XmDataHourlyPerAgent.record_timestamp <= last_day
+        ).all()
+
+    return {
+        "invoice": lambda db: calculate_all_concepts(db, client_id, year, month),
+        "batch_invoices": lambda db: list(calculate_invoices(db, year, month)),
+        "client_statistics": lambda db: get_client_statistics(db, client_id),
+        "system_load": lambda db: get_system_load(db, date),
+        "xm_month_prices": xm_month_prices,
+    }
+
+
+def capture_queries(func):
+    """Run func with a new session, returning the statements it sent"""
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        queries.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    db = SessionLocal()
+    try:
+        func(db)
+    finally:
+        db.close()
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+    return queries
+
+
+def explain(statement, parameters):
+    prefix = "EXPLAIN (ANALYZE, BUFFERS) " if engine.dialect.name == "postgresql" else "EXPLAIN QUERY PLAN "
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql(prefix + statement, parameters).all()
+    return "\n".join(" ".join(str(value) for value in row) for row in rows)
+
+
+def plan_shape(plan):
+    """Strip costs, timings and buffer counts, leaving the operations of a plan"""
+    lines = []
+    for line in plan.splitlines():
+        if re.match(r"\s*(Buffers|Planning|Execution)\b", line):
+            continue
+        lines.append(re.sub(r"\s*\((cost|actual)[^)]*\)", "", line).rstrip())
+    return "\n".join(lines)
+
+
+def time_workload(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        db = SessionLocal()
+        try:
+            start = time.perf_counter()
+            func(db)
+            timings.append((time.perf_counter() - start) * 1000)
+        finally:
+            db.close()
+    return sorted(timings)[len(timings) // 2]
+
+
+def run(args):
+    date = datetime.strptime(args.date, "%Y-%m-%d")
+    results = {"dialect": engine.dialect.name, "workloads": {}}
+
+    for name, func in get_workloads(args.client, args.year, args.month, date).items():
+        # Warm caches (tariffs, prices) first, so only the per-request queries are captured
+        time_workload(func, 1)
+
+        queries = []
+        for statement, parameters in capture_queries(func):
+            if any(query["sql"] == statement for query in queries):
+                continue
+            queries.append({"sql": statement, "plan": explain(statement, parameters)})
+
+        results["workloads"][name] = {
+            "median_ms": time_workload(func, args.repeat),
+            "queries": queries,
+        }
+
+        print(f"=== {name}: {results['workloads'][name]['median_ms']:.2f} ms median, {len(queries)} distinct queries")
+        for query in queries:
+            print(query["sql"].strip())
+            print("  " + query["plan"].replace("\n", "\n  "))
+            print()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    print(f"{'workload':<20} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+    for name, result in after["workloads"].items():
+        if name not in before["workloads"]:
+            continue
+        old, new = before["workloads"][name]["median_ms"], result["median_ms"]
+        print(f"{name:<20} {old:>10.2f} {new:>10.2f} {old / new if new else 0:>7.1f}x")
+
+    for name, result in after["workloads"].items():
+        old_plans = {query["sql"]: query["plan"] for query in before["workloads"].get(name, {}).get("queries", [])}
+        for query in result["queries"]:
+            old_plan = old_plans.get(query["sql"])
+            if old_plan is not None and plan_shape(old_plan) != plan_shape(query["plan"]):
+                print(f"\n=== {name}\n{query['sql'].strip()}")
+                print("--- before\n  " + old_plans[query["sql"]].replace("\n", "\n  "))
+                print("--- after\n  " + query["plan"].replace("\n", "\n  "))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show the query plans and timings of the billing queries")
+    parser.add_argument("--client", type=int, default=3222, help="Client to invoice")
+    parser.add_argument("--year", type=int, default=2023)
+    parser.add_argument("--month", type=int, default=9)
+    parser.add_argument("--date", default="2023-09-01", help="Day for the system load (YYYY-MM-DD)")
+    parser.add_argument("--repeat", type=int, default=20, help="Runs per workload for the timing")
+    parser.add_argument("--output", help="Save the plans and timings as JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two saved JSON files")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Compare the throughput of the response serialization paths.
+
+    python benchmarks/serialization.py
+    python benchmarks/serialization.py --months 600 --invoices 5000 --output serialization.json
+
+"validated" is what FastAPI does with a response_model: validate the returned dict
+against the model, encode it and render it with the standard json module. "orjson"
+renders the dict as built by the calculation layer, and "columnar" does the same with
+list-heavy fields turned into one list per field. No database is needed: payloads are
+synthetic, shaped like the real responses.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app.schemas.database import ClientStatisticsResponse, InvoiceCalculationResponse, SystemLoadResponse
+from app.utils.invoice_batch import iter_invoices_ndjson
+from app.utils.serialization import columnar_client_statistics, columnar_system_load
+
+
+def make_invoice(client_id):
+    concepts = {
+        concept: {"quantity": random.uniform(0, 1000), "tariff": random.uniform(-800, 800), "total": random.uniform(-1e5, 1e5)}
+        for concept in ("EA", "EC", "EE1", "EE2")
+    }
+    return dict(client_id=client_id, month=9, year=2023, total=sum(c["total"] for c in concepts.values()), **concepts)
+
+
+def make_statistics(months):
+    monthly = []
+    for index in range(months):
+        consumption, injection = random.uniform(0, 30000), random.uniform(0, 5000)
+        monthly.append({
+            "month": index % 12 + 1,
+            "year": 2000 + index // 12,
+            "consumption": consumption,
+            "injection": injection,
+            "net": consumption - injection
+        })
+    return {
+        "client_id": 3222,
+        "monthly_statistics": monthly,
+        "average_consumption": random.uniform(0, 30000),
+        "average_injection": random.uniform(0, 5000),
+        "average_net": random.uniform(0, 25000)
+    }
+
+
+def make_system_load(hours):
+    return {
+        "date": datetime(2023, 9, 1),
+        "hourly_loads": [{"hour": hour % 24, "load": random.uniform(0, 500)} for hour in range(hours)]
+    }
+
+
+def validated(model):
+    field = create_response_field(name="response", type_=model)
+
+    def render(payload):
+        content = asyncio.run(serialize_response(field=field, response_content=payload))
+        return JSONResponse(content).body
+
+    return render
+
+
+def orjson_render(payload):
+    return ORJSONResponse(payload).body
+
+
+def ndjson_json(invoices):
+    return "".join(json.dumps(invoice) + "\n" for invoice in invoices)
+
+
+def ndjson_orjson(invoices):
+    return "".join(iter_invoices_ndjson(invoices))
+
+
+def measure(func, payload, min_time):
+    """Run func(payload) repeatedly for at least min_time seconds, returning (calls per second, output bytes)"""
+    size = len(func(payload))
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        func(payload)
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return calls / elapsed, size
+
+
+def run(args):
+    random.seed(0)
+    statistics = make_statistics(args.months)
+    system_load = make_system_load(args.hours)
+    invoices = [make_invoice(client_id) for client_id in range(args.invoices)]
+
+    cases = {
+        "invoice": (make_invoice(3222), {
+            "validated": validated(InvoiceCalculationResponse),
+            "orjson": orjson_render,
+        }),
+        "client_statistics": (statistics, {
+            "validated": validated(ClientStatisticsResponse),
+            "orjson": orjson_render,
+            "columnar": lambda payload: orjson_render(columnar_client_statistics(payload)),
+        }),
+        "system_load": (system_load, {
+            "validated": validated(SystemLoadResponse),
+            "orjson": orjson_render,
+            "columnar": lambda payload: orjson_render(columnar_system_load(payload)),
+        }),
+        "batch_ndjson": (invoices, {
+            "json": ndjson_json,
+            "orjson": ndjson_orjson,
+        }),
+    }
+
+    results = {}
+    print(f"{'payload':<18} {'path':<10} {'calls/s':>12} {'bytes':>10} {'speedup':>8}")
+    for name, (payload, paths) in cases.items():
+        results[name] = {}
+        baseline = None
+        for path, func in paths.items():
+            rate, size = measure(func, payload, args.min_time)
+            baseline = baseline or rate
+            results[name][path] = {"calls_per_second": rate, "bytes": size}
+            print(f"{name:<18} {path:<10} {rate:>12,.0f} {size:>10,} {rate / baseline:>7.1f}x")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the throughput of the response serialization paths")
+    parser.add_argument("--months", type=int, default=240, help="Months in the client statistics payload")
+    parser.add_argument("--hours", type=int, default=24, help="Hours in the system load payload")
+    parser.add_argument("--invoices", type=int, default=1000, help="Invoices in the batch payload")
+    parser.add_argument("--min-time", type=float, default=1.0, help="Seconds each path is run for")
+    parser.add_argument("--output", help="Save the results as JSON")
+    run(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    main()
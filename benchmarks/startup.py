@@ -0,0 +1,125 @@
+"""
+Measure how long a fresh worker takes to serve its first request.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --path /api/v1/client-statistics/1 --output startup.json
+    python benchmarks/startup.py --baseline startup.json
+
+Each run starts a new Python process, like a uvicorn worker would, and times three steps:
+importing app.main, running the lifespan startup, and handling the first request to
+--path in-process. The process start, including importing the benchmark's own HTTP
+client, is reported separately as "interpreter".
+With --baseline, steps whose median got slower than the tolerance are listed and the
+exit status is 1.
+
+The database in DATABASE_URL is only contacted if the requested path needs it.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STEPS = ("interpreter", "import", "startup", "first_response", "total")
+
+# Runs in the child process; prints the time of each step in seconds as JSON
+CHILD = """
+import asyncio, json, sys, time
+import httpx
+start = time.perf_counter()
+import app.main
+imported = time.perf_counter()
+
+async def first_request(path):
+    async with app.main.app.router.lifespan_context(app.main.app):
+        started = time.perf_counter()
+        transport = httpx.ASGITransport(app=app.main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://startup") as client:
+            response = await client.get(path)
+        return started, time.perf_counter(), response.status_code
+
+started, responded, status = asyncio.run(first_request(sys.argv[1]))
+print(json.dumps({
+    "import": imported - start,
+    "startup": started - imported,
+    "first_response": responded - started,
+    "status": status,
+}))
+"""
+
+
+def run_once(path):
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    launched = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD, path], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    total = time.perf_counter() - launched
+
+    timings = json.loads(output.strip().splitlines()[-1])
+    timings["total"] = total
+    timings["interpreter"] = total - timings["import"] - timings["startup"] - timings["first_response"]
+    return timings
+
+
+def run(args):
+    runs = [run_once(args.path) for _ in range(args.repeat)]
+    statuses = sorted({timings["status"] for timings in runs})
+
+    results = {"path": args.path, "repeat": args.repeat, "status": statuses, "steps": {}}
+    print(f"{'step':<16} {'median ms':>10} {'max ms':>10}")
+    for step in STEPS:
+        values = [timings[step] * 1000 for timings in runs]
+        results["steps"][step] = {"median_ms": statistics.median(values), "max_ms": max(values)}
+        print(f"{step:<16} {statistics.median(values):>10.1f} {max(values):>10.1f}")
+    if statuses != [200]:
+        print(f"\nWarning: {args.path} answered with status {', '.join(map(str, statuses))}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_results(baseline, results, args.tolerance):
+            sys.exit(1)
+
+
+def compare_results(before, after, tolerance):
+    """Print the median changes between two runs, returning the steps slower than the tolerance"""
+    regressions = []
+    print(f"\n{'step':<16} {'before':>10} {'after':>10} {'change':>8}")
+    for step, result in after["steps"].items():
+        old = before.get("steps", {}).get(step)
+        if old is None:
+            continue
+        change = result["median_ms"] / old["median_ms"] - 1 if old["median_ms"] else 0.0
+        flag = ""
+        if change > tolerance:
+            regressions.append(step)
+            flag = "  REGRESSION"
+        print(f"{step:<16} {old['median_ms']:>10.1f} {result['median_ms']:>10.1f} {change:>+8.0%}{flag}")
+
+    if before.get("path") != after.get("path"):
+        print("\nWarning: the runs requested different paths")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the time from import to the first response of the app")
+    parser.add_argument("--path", default="/", help="Path of the first request")
+    parser.add_argument("--repeat", type=int, default=5, help="Processes started")
+    parser.add_argument("--output", help="Save the results as JSON")
+    parser.add_argument("--baseline", help="Compare with the results saved by an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Median slowdown reported as a regression (0.2 is 20%%)")
+    run(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    main()
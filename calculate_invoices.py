@@ -0,0 +1,67 @@
+import argparse
+import sys
+import time
+
+from app.config import INVOICE_WORKERS, INVOICE_PARTITION_SIZE
+from app.database import SessionLocal
+from app.utils.invoice_batch import calculate_invoices, iter_invoices_ndjson
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Calculate the invoices of many clients for a month as NDJSON")
+    parser.add_argument("year", type=int, help="Year to invoice")
+    parser.add_argument("month", type=int, help="Month to invoice (1-12)")
+    parser.add_argument("--clients", type=int, nargs="+", help="Only invoice these client IDs")
+    parser.add_argument("--market", type=int, help="Only invoice clients of this market")
+    parser.add_argument("--voltage-level", type=int, help="Only invoice clients with this voltage level")
+    parser.add_argument("--output", help="File to write the invoices to (defaults to stdout)")
+    parser.add_argument("--workers", type=int, default=INVOICE_WORKERS,
+                        help="Processes building the invoices in parallel (0 builds them in this process)")
+    parser.add_argument("--partition-size", type=positive_int, default=INVOICE_PARTITION_SIZE,
+                        help="Services loaded and sent to a worker at a time")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    db = SessionLocal()
+    start = time.perf_counter()
+    count = 0
+
+    try:
+        invoices = calculate_invoices(
+            db,
+            args.year,
+            args.month,
+            client_ids=args.clients,
+            id_market=args.market,
+            voltage_level=args.voltage_level,
+            workers=args.workers,
+            partition_size=args.partition_size
+        )
+        for line in iter_invoices_ndjson(invoices):
+            output.write(line)
+            count += 1
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        db.close()
+        if args.output:
+            output.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Calculated {count} invoices in {elapsed:.2f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
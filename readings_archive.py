@@ -0,0 +1,66 @@
+import argparse
+import sys
+import time
+from datetime import datetime
+
+from app.database import SessionLocal
+from app.utils.columnar import FILE_FORMATS, PARTITIONINGS, READINGS_CHUNK_SIZE, export_readings, import_readings
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export or import readings as Parquet or Arrow IPC files")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Write readings to a directory")
+    export_parser.add_argument("path", help="Directory to write the files to")
+    export_parser.add_argument("--start", type=parse_date, help="First day to export (YYYY-MM-DD)")
+    export_parser.add_argument("--end", type=parse_date, help="Day after the last one to export (YYYY-MM-DD)")
+    export_parser.add_argument("--clients", type=int, nargs="+", help="Only export these client IDs")
+    export_parser.add_argument("--partitioning", choices=list(PARTITIONINGS), default="service-month",
+                               help="Directory layout of the files")
+
+    import_parser = commands.add_parser("import", help="Load readings from an exported file or directory")
+    import_parser.add_argument("path", help="File or directory to read")
+
+    for command_parser in (export_parser, import_parser):
+        command_parser.add_argument("--format", choices=list(FILE_FORMATS), default="parquet", help="File format")
+        command_parser.add_argument("--chunk-size", type=int, default=READINGS_CHUNK_SIZE,
+                                    help="Rows read and written at a time")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    db = SessionLocal()
+    start = time.perf_counter()
+
+    try:
+        if args.command == "export":
+            rows = export_readings(
+                db,
+                args.path,
+                file_format=args.format,
+                partitioning=args.partitioning,
+                start=args.start,
+                end=args.end,
+                client_ids=args.clients,
+                chunk_size=args.chunk_size
+            )
+            action = "Exported"
+        else:
+            rows = import_readings(db, args.path, file_format=args.format, chunk_size=args.chunk_size)
+            action = "Imported"
+    finally:
+        db.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"{action} {rows} readings in {elapsed:.2f}s ({rows / elapsed if elapsed else 0:,.0f} rows/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
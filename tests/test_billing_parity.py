@@ -0,0 +1,139 @@
+"""
+Parity of the vectorized EE2 allocation and pricing with the original per-hour loop.
+
+reference_ee2 is the loop compute_EE2 ran before the vectorization, over a dict of the
+hours with injection readings and a dict of rates by hour, kept here as the reference.
+"""
+import numpy as np
+import pytest
+
+from app.utils.billing import (
+    HOURS_PER_DAY,
+    InvoiceInputs,
+    TariffRates,
+    allocate_hourly_excess,
+    compute_EE2
+)
+
+TARIFF = TariffRates(1, 1, 1, 300.0, 40.0, 200.0, 20.0, 50.0, 40.0, 650.0)
+
+
+def reference_ee2(hourly_injections, total_consumption, total_injection, hourly_rates):
+    """Return the excess by hour and the quantity, rate and total of EE2, as the original loop did"""
+    ee2_quantity = 0
+    ee2_rate = 0
+    total_ee2 = 0
+    excess_by_hour = {}
+
+    if total_injection > total_consumption:
+        ee2_quantity = total_injection - total_consumption
+
+        accumulated_injection = 0
+        consumption_threshold = total_consumption
+        for hour in sorted(hourly_injections.keys()):
+            injection_value = hourly_injections.get(hour, 0)
+            accumulated_injection += injection_value
+
+            if accumulated_injection > consumption_threshold:
+                excess = min(injection_value, accumulated_injection - consumption_threshold)
+                if excess > 0:
+                    excess_by_hour[hour] = excess
+                    consumption_threshold += excess
+
+        hourly_totals = {}
+        for hour, excess in excess_by_hour.items():
+            hourly_totals[hour] = excess * hourly_rates.get(hour, 0)
+
+        total_ee2 = sum(hourly_totals.values())
+        ee2_rate = total_ee2 / ee2_quantity if ee2_quantity > 0 else 0
+
+    return excess_by_hour, (ee2_quantity, ee2_rate, total_ee2)
+
+
+def to_array(values_by_hour):
+    array = np.zeros(HOURS_PER_DAY)
+    for hour, value in values_by_hour.items():
+        array[hour] = value
+    return array
+
+
+def make_inputs(hourly_injections, total_consumption, hourly_rates):
+    return InvoiceInputs(
+        client_id=1,
+        year=2023,
+        month=1,
+        tariff=TARIFF,
+        total_consumption=total_consumption,
+        total_injection=sum(hourly_injections.values()),
+        hourly_injections=to_array(hourly_injections),
+        hourly_rates=None if hourly_rates is None else to_array(hourly_rates)
+    )
+
+
+def assert_parity(hourly_injections, total_consumption, hourly_rates):
+    inputs = make_inputs(hourly_injections, total_consumption, hourly_rates)
+    expected_excess, expected = reference_ee2(
+        hourly_injections, total_consumption, inputs.total_injection, hourly_rates
+    )
+
+    excess = allocate_hourly_excess(inputs.hourly_injections, total_consumption)
+    assert excess.tolist() == to_array(expected_excess).tolist()
+    assert tuple(compute_EE2(inputs)) == expected
+
+
+RATES = {hour: 100.0 + 10 * hour for hour in range(HOURS_PER_DAY)}
+
+
+def test_no_excess():
+    injections = {hour: 1.5 for hour in range(HOURS_PER_DAY)}
+    assert_parity(injections, 36.0, RATES)
+    assert_parity(injections, 50.0, RATES)
+    assert not allocate_hourly_excess(to_array(injections), 50.0).any()
+
+
+def test_crossing_hour():
+    # The running total reaches 20 at hour 3 and passes 25 during hour 4
+    injections = {0: 5.0, 1: 5.0, 2: 5.0, 3: 5.0, 4: 8.0, 5: 2.0, 6: 4.0}
+    assert_parity(injections, 25.0, RATES)
+
+    excess = allocate_hourly_excess(to_array(injections), 25.0)
+    assert excess[:4].tolist() == [0.0] * 4
+    assert excess[4] == 3.0
+    assert excess[5] == 2.0
+
+
+def test_crossing_in_first_hour():
+    assert_parity({0: 30.0, 1: 1.0, 23: 2.0}, 10.0, RATES)
+
+
+def test_hours_without_injection():
+    # Hours missing from the readings, and hours with zero injection after the crossing
+    injections = {2: 4.0, 7: 0.0, 9: 6.0, 13: 0.0, 18: 3.5}
+    assert_parity(injections, 5.0, RATES)
+    assert_parity({}, 0.0, RATES)
+
+
+def test_missing_rates():
+    injections = {hour: 2.0 for hour in range(8, 18)}
+    # Hours without a rate are priced at 0, as the original lookup did
+    assert_parity(injections, 5.0, {hour: rate for hour, rate in RATES.items() if hour % 3})
+    assert_parity(injections, 5.0, {})
+
+    with pytest.raises(ValueError):
+        compute_EE2(make_inputs(injections, 5.0, None))
+
+
+def test_missing_rates_without_excess():
+    # Rates are not needed when there is no excess
+    assert tuple(compute_EE2(make_inputs({0: 1.0}, 5.0, None))) == (0.0, 0.0, 0.0)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_services(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(200):
+        hours = rng.choice(HOURS_PER_DAY, size=rng.integers(0, HOURS_PER_DAY + 1), replace=False)
+        injections = {int(hour): float(value) for hour, value in zip(hours, rng.gamma(1.5, 3.0, len(hours)))}
+        total_consumption = float(rng.uniform(0, 1.2) * sum(injections.values()))
+        rates = {hour: float(rate) for hour, rate in enumerate(rng.uniform(50, 900, HOURS_PER_DAY))}
+        assert_parity(injections, total_consumption, rates)
@@ -0,0 +1,101 @@
+"""
+Reading sets: slicing by time, totals and hourly totals, and loading from the database.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app.models.models import Base, Consumption, Injection, Record, Service
+from app.utils.billing import HOURS_PER_DAY
+from app.utils.readings import ReadingSet, load_reading_set, to_epoch
+
+START = datetime(2023, 9, 1)
+
+
+def make_set(timestamps, values):
+    return ReadingSet(
+        np.array([to_epoch(timestamp) for timestamp in timestamps], dtype=np.int64),
+        np.array(values, dtype=np.float64)
+    )
+
+
+# Every 30 minutes for two days, then one reading on the first day of the next month
+TIMESTAMPS = [START + timedelta(minutes=30 * index) for index in range(96)] + [datetime(2023, 10, 1, 5)]
+VALUES = [float(index) for index in range(len(TIMESTAMPS))]
+
+
+def test_between():
+    readings = make_set(TIMESTAMPS, VALUES)
+    hour = readings.between(datetime(2023, 9, 1, 3), datetime(2023, 9, 1, 4))
+    assert hour.values.tolist() == [6.0, 7.0]
+    # End not included
+    assert len(readings.between(START, START + timedelta(minutes=30))) == 1
+    assert len(readings.between(datetime(2023, 12, 1), datetime(2024, 1, 1))) == 0
+    # Slices share the arrays of the set
+    assert np.shares_memory(hour.values, readings.values)
+
+
+def test_bucket():
+    readings = make_set(TIMESTAMPS, VALUES)
+    assert len(readings.bucket(datetime(2023, 9, 2, 13, 45), "day")) == 48
+    assert len(readings.bucket(datetime(2023, 9, 15), "month")) == 96
+    assert readings.bucket(datetime(2023, 10, 20), "month").values.tolist() == [96.0]
+    assert readings.bucket(datetime(2023, 9, 1, 23, 59), "hour").values.tolist() == [46.0, 47.0]
+
+
+def test_totals_ignore_missing_values():
+    values = list(VALUES)
+    values[3] = np.nan
+    readings = make_set(TIMESTAMPS, values)
+    assert readings.total() == sum(VALUES) - 3.0
+
+    hourly = readings.hourly_totals()
+    assert hourly.shape == (HOURS_PER_DAY,)
+    # Hour 1 has the readings at 01:00 and 01:30 of both days; the one at 01:30 of the first is missing
+    assert hourly[1] == 2.0 + 50.0 + 51.0
+    # The reading of the next month falls in hour 5
+    assert hourly[5] == 10.0 + 11.0 + 58.0 + 59.0 + 96.0
+    assert hourly.sum() == readings.total()
+
+
+def test_empty_set():
+    readings = make_set([], [])
+    assert len(readings) == 0
+    assert readings.total() == 0.0
+    assert readings.hourly_totals().tolist() == [0.0] * HOURS_PER_DAY
+
+
+def test_load_reading_set():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        db.add_all([Service(id_service=1), Service(id_service=2)])
+        # Inserted out of order, with a reading of another service and one without injection
+        for id_record, (id_service, timestamp, consumption, injection) in enumerate([
+            (1, datetime(2023, 9, 2), 2.0, 0.5),
+            (1, datetime(2023, 9, 1), 1.0, None),
+            (2, datetime(2023, 9, 1, 12), 9.0, 9.0),
+            (1, datetime(2023, 9, 30, 23), 3.0, 1.5),
+            (1, datetime(2023, 10, 1), 4.0, 2.0),
+        ], start=1):
+            db.add(Record(id_record=id_record, id_service=id_service, record_timestamp=timestamp))
+            db.add(Consumption(id_record=id_record, value=consumption))
+            if injection is not None:
+                db.add(Injection(id_record=id_record, value=injection))
+        db.commit()
+
+        end = datetime(2023, 9, 30, 23, 59, 59)
+        consumption = load_reading_set(db, Consumption.value, 1, START, end, chunk_size=2)
+        assert consumption.values.tolist() == [1.0, 2.0, 3.0]
+        assert consumption.timestamps.tolist() == [
+            to_epoch(datetime(2023, 9, 1)), to_epoch(datetime(2023, 9, 2)), to_epoch(datetime(2023, 9, 30, 23))
+        ]
+
+        injection = load_reading_set(db, Injection.value, 1, START, end)
+        assert injection.values.tolist() == [0.5, 1.5]
+        assert injection.hourly_totals()[23] == pytest.approx(1.5)
+
+        assert len(load_reading_set(db, Consumption.value, 3, START, end)) == 0